@@ -1,9 +1,27 @@
 from cgatcore import pipeline as P
+import sys
 import os
 import sqlite3
 import re
 import pandas as pd
 import gzip
+import math
+import collections
+import array
+import shutil
+import tempfile
+import multiprocessing
+import hashlib
+import fcntl
+import json
+import urllib.request
+import datetime
+import time
+import errno
+import numpy as np
+import pysam
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipeline_shared"))
+import PipelineShared as PS
 
 # Pipeline configuration
 P.get_parameters(
@@ -41,112 +59,13 @@ def isPaired(files):
 
 def writeGreat(locations,basalup,basaldown,maxext,outfile,half=False):
     ''' write out a bed file of great promoters from input gene locations
-         locations is [contig,gstart,gend,strand,gene_id] '''
-
-    # Gene regulatory domain definition: 
-    # Each gene is assigned a basal regulatory domain of a 
-    # minimum distance upstream and downstream of the TSS 
-    # (regardless of other nearby genes). 
-    # The gene regulatory domain is extended in both directions 
-    # to the nearest gene's basal domain but no more than the 
-    # maximum extension in one direction
-
-    genome = {}
-    for location in locations:
-        chrom, gstart, gend, strand_int, gid = location
-        if strand_int == "-": 
-            strand = "minus" 
-            tss = gend
-        else: 
-            strand = "plus"
-            tss = gstart
-        record = [tss,strand,gid]
-        if chrom[3:5]=="NT" or chrom[3:]=="M": continue
-        if chrom not in genome: 
-            genome[chrom] = [ record ]
-        else: genome[chrom].append(record)
-
-    #add the ends of the chromosomes
-    contigs = gzip.open(PARAMS["annotations_dir"]+"/assembly.dir/contigs.bed.gz","rt")
+         locations is [contig,gstart,gend,strand,gene_id] or a DataFrame '''
 
-    
-    nmatched = 0
-    for contig_entry in contigs:
-        contig, start, end = contig_entry.strip().split("\t")
-        
-        if contig in genome.keys():
-            genome[contig].append([int(end),"end","end"])
-            nmatched+=1
-    if nmatched < 21:
-        raise ValueError("writeGreat: not enough chromosome ends registered")
-
-    #sort the arrays
-    for key in genome.keys():
-        genome[key].sort( key = lambda entry: entry[0] )
-        
-    #now we can walk over the regions and make the regulatory regions.
-
-    greatBed = []
-   
-    for contig in genome.keys():
-
-        locs = genome[contig]
-        contig_end = locs[-1][0]
-        for i in range(0,len(locs)):
-
-            l,strand,gid = locs[i]
-
-            if strand == "end": continue
-
-            #get the positions of the neighbouring basal domains.
-
-            # - upstream
-            if i == 0: frontstop = 0
-            else:
-                pl, pstrand, pgid = locs[i-1]
-                if pstrand == "plus": frontstop = pl + basaldown
-                else: frontstop = pl + basalup
-            # - downstream
-            nl, nstrand, ngid = locs[i+1]
-            if nstrand == "plus": backstop = nl - basalup
-            else: backstop = nl - basaldown
-
-            # define basal domain
-            if strand=="plus":
-                basalstart = l - basalup
-                basalend = min( l + basaldown, contig_end )
-            else:
-                basalstart = l - basaldown
-                basalend = min( l + basalup, contig_end )
-
-            # upstream extension
-            if frontstop > basalstart:
-                regstart = basalstart
-            else:
-                if half == True:
-                    frontext = min( maxext, (l - frontstop) / 2 )
-                else:
-                    frontext = min( maxext, l - frontstop )
-                regstart = l - frontext
-
-            # downstream extension
-            if backstop < basalend:
-                regend = basalend
-            else:
-                if half == True:
-                    backext = min( maxext, ( backstop - l ) / 2 )
-                else:
-                    backext = min( maxext, backstop - l )
-                regend = l + backext
+    PS.writeGreat(locations, basalup, basaldown, maxext, outfile, half,
+                  contigs=PARAMS["annotations_dir"]+"/assembly.dir/contigs.bed.gz",
+                  cache=PARAMS.get("great_cache"))
 
-            # greatBed.append(["chr"+contig,str(regstart),str(regend),gid])
-            greatBed.append([contig,str(regstart),str(regend),gid])
-        
-    outfh = open(outfile,"w")
-    outfh.write("\n".join(["\t".join(x) for x in greatBed])+"\n")
-    outfh.close()
 
-    
 def getTSS(start,end,strand):
     if strand == 1 or strand == "+": tss = start
     elif strand == -1 or strand == "-": tss = end
@@ -167,26 +86,2420 @@ def fetch(query, dbhandle=None, attach=False):
     return sqlresult
 
 
-def fetch_DataFrame(query,
-                    dbhandle=db):
-    '''Fetch query results and returns them as a pandas dataframe'''
+def fetch_DataFrame(query, dbhandle=db, **kwargs):
+    '''Fetch query results and returns them as a pandas dataframe, over a
+       cached read-only connection (see PipelineShared.fetch_DataFrame)'''
 
-    dbhandle = sqlite3.connect(dbhandle)
+    return PS.fetch_DataFrame(query, dbhandle, **kwargs)
 
-    cc = dbhandle.cursor()
-    sqlresult = cc.execute(query).fetchall()
-    cc.close()
 
-    # see http://pandas.pydata.org/pandas-docs/dev/generated/
-    # pandas.DataFrame.from_records.html#pandas.DataFrame.from_records
-    # this method is design to handle sql_records with proper type
-    # conversion
+def load(infiles, outfile, **kwargs):
+    '''Load tab-separated infile(s) into the database through the
+       single-writer load queue (see PipelineShared.load)'''
+
+    return PS.load(infiles, outfile, PARAMS["load_queue"], db,
+                   batch=PARAMS["load_batch"], **kwargs)
+
+
+#####################################################
+####              BAM processing                 ####
+#####################################################
+
+def isCoordinateSorted(bam):
+    '''Check the header of an open pysam AlignmentFile for SO:coordinate'''
+
+    header = bam.header.to_dict()
+
+    return header.get("HD", {}).get("SO", None) == "coordinate"
+
+
+def keepContigs(bam, exclude=[]):
+    '''Return contigs from the BAM header, in header (sort) order,
+       with excluded contigs removed'''
+
+    return [c for c in bam.references if c not in exclude]
+
+
+def passesFilter(read, mapq):
+    '''Equivalent of samtools view -q, unmapped reads never pass'''
+
+    return not read.is_unmapped and read.mapping_quality >= mapq
+
+
+def readsIn(bam, contig=None):
+    '''Iterate over all reads in file order, or those on one contig
+       (using the index)'''
+
+    if contig is None:
+        return bam.fetch(until_eof=True)
+    else:
+        return bam.fetch(contig)
+
+
+def filterBam(infile, outfile, mapq=10, exclude=["chrM"], threads=2):
+    '''Stream a coordinate sorted BAM, removing reads with MAPQ < mapq and
+       reads aligned to excluded contigs. Contigs are matched on reference
+       id, not on text, so reads are kept if only their mate or tags mention
+       an excluded contig. Sort order is preserved, the output is indexed and
+       never re-sorted'''
+
+    inbam = pysam.AlignmentFile(infile, "rb", threads=threads)
+
+    if not isCoordinateSorted(inbam):
+        raise ValueError("filterBam: %s is not coordinate sorted" % infile)
+
+    outbam = pysam.AlignmentFile(outfile, "wb", template=inbam, threads=threads)
+
+    if inbam.has_index():
+        # skip excluded contigs entirely using the index
+        for contig in keepContigs(inbam, exclude):
+            for read in inbam.fetch(contig):
+                if passesFilter(read, mapq):
+                    outbam.write(read)
+    else:
+        filterReads(inbam, outbam, mapq, exclude)
+
+    outbam.close()
+    inbam.close()
+
+    pysam.index(outfile)
+
+
+def filterReads(inbam, outbam, mapq=10, exclude=["chrM"], unfiltered=None):
+    '''Write reads from inbam passing the MAPQ & contig filters to outbam,
+       in the order they are read. All reads are also written to unfiltered,
+       if given'''
+
+    excluded = set(inbam.get_tid(c) for c in exclude if c in inbam.references)
+
+    for read in inbam.fetch(until_eof=True):
+        if unfiltered is not None:
+            unfiltered.write(read)
+
+        if read.reference_id not in excluded and passesFilter(read, mapq):
+            outbam.write(read)
+
+
+def openFifo(path, timeout=60):
+    '''Wait up to timeout seconds for a reader of the fifo at path, returns a
+       write descriptor holding it open. Raises OSError if no reader opens it
+       (e.g. its process died), where a blocking open would hang'''
+
+    deadline = time.time() + timeout
+
+    while True:
+        try:
+            return os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as error:
+            if error.errno != errno.ENXIO or time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def filterBamStream(infile="-", outfile="-", mapq=10, exclude=["chrM"], genome=None,
+                    timeout=60):
+    '''Filter an unsorted SAM/BAM stream, e.g. bowtie2 stdout, writing
+       uncompressed BAM to be piped straight into samtools sort.
+       If genome is specified (e.g. a fifo read by a second samtools sort)
+       the unfiltered reads are written there too, failing if nothing reads
+       the fifo within timeout seconds'''
+
+    inbam = pysam.AlignmentFile(infile, "r")
+    outbam = pysam.AlignmentFile(outfile, "wbu", template=inbam)
+
+    if genome:
+        # the reader is open once this returns, so pysam's blocking open cannot hang
+        fd = openFifo(genome, timeout)
+        unfiltered = pysam.AlignmentFile(genome, "wbu", template=inbam)
+        os.close(fd)
+    else:
+        unfiltered = None
+
+    filterReads(inbam, outbam, mapq, exclude, unfiltered)
+
+    if unfiltered is not None:
+        unfiltered.close()
+    outbam.close()
+    inbam.close()
+
+
+def writePrepBams(infile, outfile, size_outfile=None, insert_size=150, threads=2,
+                  dedup=False, contig=None):
+    '''Stream a coordinate sorted BAM once, writing all reads not marked as
+       duplicates to outfile and, if size_outfile is given, reads from
+       fragments < insert_size to size_outfile (as the previous awk TLEN
+       filter, reads with TLEN 0 are kept). Both outputs stay sorted and are
+       indexed. With dedup duplicates are removed in the same pass (see
+       removeDuplicates) and Picard style duplication metrics returned.
+       If contig is given only reads on that contig are written (a shard),
+       and outputs are not indexed'''
+
+    inbam = pysam.AlignmentFile(infile, "rb", threads=threads)
+
+    allbam = pysam.AlignmentFile(outfile, "wb", template=inbam, threads=threads)
+
+    if size_outfile:
+        sizebam = pysam.AlignmentFile(size_outfile, "wb", template=inbam, threads=threads)
+    else:
+        sizebam = None
+
+    if dedup:
+        if not isCoordinateSorted(inbam):
+            raise ValueError("writePrepBams: %s is not coordinate sorted" % infile)
+
+        metrics = dict.fromkeys(DUPLICATION_COUNTS, 0)
+        reads = removeDuplicates(inbam, metrics, contig=contig)
+    else:
+        metrics = None
+        reads = (x for x in readsIn(inbam, contig) if not x.is_duplicate)
+
+    for read in reads:
+        allbam.write(read)
+
+        if sizebam is not None and abs(read.template_length) < insert_size:
+            sizebam.write(read)
+
+    allbam.close()
+    if sizebam is not None:
+        sizebam.close()
+
+    if contig is None:
+        pysam.index(outfile)
+        if size_outfile:
+            pysam.index(size_outfile)
+
+    inbam.close()
+
+    return metrics
+
+
+#####################################################
+####           Duplicate removal                 ####
+#####################################################
+
+# columns of the duplicate window, one row per fragment.
+# Pairs are keyed on both unclipped 5' ends & orientation (0-3), single reads
+# (SE, orphaned mates & mates on other contigs) on one 5' end with orient 4/5,
+# so the two never collapse together
+POS_LO, POS_HI, ORIENT, SCORE, ORD1, ORD2 = range(6)
+
+# Picard DuplicationMetrics counted by removeDuplicates
+DUPLICATION_COUNTS = ["UNPAIRED_READS_EXAMINED", "READ_PAIRS_EXAMINED",
+                      "SECONDARY_OR_SUPPLEMENTARY_RDS", "UNMAPPED_READS",
+                      "UNPAIRED_READ_DUPLICATES", "READ_PAIR_DUPLICATES"]
+
+
+def fivePrime(read):
+    '''Unclipped 5' position & strand (0 = +, 1 = -) of an aligned read'''
+
+    cigar = read.cigartuples
+
+    if read.is_reverse:
+        clip = sum(n for op, n in reversed(cigar[-2:]) if op in (4, 5))
+        return read.reference_end + clip, 1
+    else:
+        clip = sum(n for op, n in cigar[:2] if op in (4, 5))
+        return read.reference_start - clip, 0
+
+
+def baseQualitySum(read):
+    '''Sum of base qualities >= 15, as Picard SUM_OF_BASE_QUALITIES'''
+
+    quals = read.query_qualities
+
+    if quals is None:
+        return 0
+
+    quals = np.frombuffer(quals, dtype=np.uint8)
+
+    return int(quals[quals >= 15].sum())
+
+
+def resolveDuplicates(window, bound):
+    '''Find duplicates among fragments whose 5' ends all lie before bound,
+       no later fragment can share their key. The highest scoring fragment
+       of each key is kept, ties going to the first seen.
+       Returns (duplicate fragments, unresolved fragments)'''
+
+    done = np.maximum(window[:, POS_LO], window[:, POS_HI]) < bound
+
+    resolved = window[done]
+
+    order = np.lexsort((resolved[:, ORD1], -resolved[:, SCORE],
+                        resolved[:, ORIENT], resolved[:, POS_HI], resolved[:, POS_LO]))
+    resolved = resolved[order]
+
+    keys = resolved[:, [POS_LO, POS_HI, ORIENT]]
+    first = np.ones(len(resolved), dtype=bool)
+    first[1:] = (keys[1:] != keys[:-1]).any(axis=1)
+
+    return resolved[~first], window[~done]
+
+
+def removeDuplicates(inbam, metrics, chunk=10000, contig=None):
+    '''Yield the reads of a coordinate sorted BAM in order, less PCR
+       duplicates (and reads already marked as such), in a single pass.
+       Fragments are keyed on (contig, both unclipped 5' ends, orientation),
+       duplicates are scored on summed base qualities as Picard.
+       Only a sliding window of fragments, as int64 rows, is held in memory;
+       it is resolved every chunk fragments up to the leftmost position a
+       later read could still share a key with. Reads are buffered from the
+       first one of a fragment still in the window, so the buffer spans the
+       window. If contig is given only that contig is read.
+       Picard style counts (DUPLICATION_COUNTS) are added to metrics'''
+
+    window = np.zeros((0, 6), dtype=np.int64)
+    rows = []
+    pending = {}  # first seen mates; qname -> (start, mate_start, pos, strand, score, n)
+    buffered = collections.deque()  # (record number, read) not yet yielded
+    duplicates = set()
+    current = None
+    maxlen = 0
+
+    def single(pos, strand, score, n):
+        metrics["UNPAIRED_READS_EXAMINED"] += 1
+        rows.append((pos, -1, 4 + strand, score, n, -1))
+
+    def pair(mate, pos, strand, score, n):
+        metrics["READ_PAIRS_EXAMINED"] += 1
+        lo, hi = sorted([(mate[2], mate[3]), (pos, strand)])
+        rows.append((lo[0], hi[0], lo[1] * 2 + hi[1], mate[4] + score, mate[5], n))
+
+    def orphan(start):
+        # mates which should have been seen before start were filtered out
+        for qname in [q for q, p in pending.items() if p[1] < start]:
+            single(*pending.pop(qname)[2:])
+
+    def resolve(window, bound):
+        if len(rows) > 0:
+            window = np.concatenate([window, np.array(rows, dtype=np.int64)])
+            del rows[:]
+
+        dups, window = resolveDuplicates(window, bound)
+
+        paired = dups[:, ORD2] >= 0
+        metrics["READ_PAIR_DUPLICATES"] += int(paired.sum())
+        metrics["UNPAIRED_READ_DUPLICATES"] += int((~paired).sum())
+
+        duplicates.update(dups[:, ORD1].tolist())
+        duplicates.update(dups[paired, ORD2].tolist())
+
+        return window
+
+    def release(window):
+        # reads before the first read of an unresolved fragment are final
+        first = [p[5] for p in pending.values()]
+        if len(window) > 0:
+            first.append(int(window[:, ORD1].min()))
+        first = min(first, default=float("inf"))
+
+        while len(buffered) > 0 and buffered[0][0] < first:
+            n, read = buffered.popleft()
+
+            if n in duplicates:
+                duplicates.remove(n)
+            elif not read.is_duplicate:
+                yield read
+
+    for n, read in enumerate(readsIn(inbam, contig)):
+        if read.is_unmapped:
+            metrics["UNMAPPED_READS"] += 1
+            buffered.append((n, read))
+            continue
+
+        if read.is_secondary or read.is_supplementary:
+            metrics["SECONDARY_OR_SUPPLEMENTARY_RDS"] += 1
+            buffered.append((n, read))
+            continue
+
+        if read.reference_id != current:
+            # all mates on the previous contig have been seen
+            orphan(float("inf"))
+            window = resolve(window, float("inf"))
+            yield from release(window)
+            current = read.reference_id
+
+        buffered.append((n, read))
+
+        start = read.reference_start
+        pos, strand = fivePrime(read)
+        score = baseQualitySum(read)
+        maxlen = max(maxlen, read.infer_read_length())
+
+        paired = read.is_paired and not read.mate_is_unmapped and \
+            read.next_reference_id == read.reference_id
+
+        if not paired:
+            single(pos, strand, score, n)
+
+        elif read.query_name in pending:
+            pair(pending.pop(read.query_name), pos, strand, score, n)
+
+        elif read.next_reference_start < start:
+            # mate was filtered out
+            single(pos, strand, score, n)
+
+        else:
+            pending[read.query_name] = (start, read.next_reference_start, pos, strand, score, n)
+
+        if len(rows) >= chunk:
+            orphan(start)
+            # pending mates may still become orphans keyed on their own 5' end
+            leftmost = min([start] + [p[0] for p in pending.values()])
+            window = resolve(window, leftmost - maxlen)
+            yield from release(window)
+
+    orphan(float("inf"))
+    window = resolve(window, float("inf"))
+    yield from release(window)
+
+
+def estimateLibrarySize(pairs, unique_pairs):
+    '''Picard (Lander-Waterman) estimate of the number of unique molecules'''
+
+    def f(x, c, n):
+        return c / x - 1 + math.exp(-n / x)
+
+    if pairs == 0 or unique_pairs >= pairs:
+        return ""
+
+    m, M = 1.0, 100.0
+
+    while f(M * unique_pairs, unique_pairs, pairs) > 0:
+        M *= 10.0
+
+    for i in range(40):
+        r = (m + M) / 2.0
+        u = f(r * unique_pairs, unique_pairs, pairs)
+
+        if u == 0:
+            break
+        elif u > 0:
+            m = r
+        else:
+            M = r
+
+    return int(unique_pairs * (m + M) / 2.0)
+
+
+def writeDuplicationMetrics(metrics, outfile, infile):
+    '''Write duplication metrics in the Picard MarkDuplicates METRICS_FILE
+       format (.picardmetrics). Optical duplicates are not detected'''
+
+    m = dict(metrics)
+    m["LIBRARY"] = "Unknown Library"
+    m["READ_PAIR_OPTICAL_DUPLICATES"] = 0
+
+    examined = m["UNPAIRED_READS_EXAMINED"] + m["READ_PAIRS_EXAMINED"] * 2
+    duplicates = m["UNPAIRED_READ_DUPLICATES"] + m["READ_PAIR_DUPLICATES"] * 2
+
+    if examined > 0:
+        m["PERCENT_DUPLICATION"] = round(duplicates / examined, 6)
+    else:
+        m["PERCENT_DUPLICATION"] = 0
+
+    pairs = m["READ_PAIRS_EXAMINED"]
+    unique_pairs = pairs - m["READ_PAIR_DUPLICATES"]
+    m["ESTIMATED_LIBRARY_SIZE"] = estimateLibrarySize(pairs, unique_pairs)
+
+    cols = ["LIBRARY", "UNPAIRED_READS_EXAMINED", "READ_PAIRS_EXAMINED",
+            "SECONDARY_OR_SUPPLEMENTARY_RDS", "UNMAPPED_READS",
+            "UNPAIRED_READ_DUPLICATES", "READ_PAIR_DUPLICATES",
+            "READ_PAIR_OPTICAL_DUPLICATES", "PERCENT_DUPLICATION",
+            "ESTIMATED_LIBRARY_SIZE"]
+
+    with open(outfile, "w") as o:
+        o.write("## htsjdk.samtools.metrics.StringHeader\n")
+        o.write("# PipelineAtac.removeDuplicates INPUT=%s\n" % infile)
+        o.write("## htsjdk.samtools.metrics.StringHeader\n")
+        o.write("# Started on: %s\n\n" % datetime.datetime.now().ctime())
+        o.write("## METRICS CLASS\tpicard.sam.DuplicationMetrics\n")
+        o.write("\t".join(cols) + "\n")
+        o.write("\t".join(str(m[c]) for c in cols) + "\n\n")
+
+        # return on investment of sequencing x times deeper
+        lib_size = m["ESTIMATED_LIBRARY_SIZE"]
+        if lib_size != "" and unique_pairs > 0:
+            o.write("## HISTOGRAM\tjava.lang.Double\n")
+            o.write("BIN\tVALUE\n")
+            for x in range(1, 101):
+                roi = lib_size * (1 - math.exp(-(x * pairs) / lib_size)) / unique_pairs
+                o.write("%.1f\t%f\n" % (x, roi))
+            o.write("\n")
+
+
+#####################################################
+####        Per contig sharded execution         ####
+#####################################################
+
+def runShards(worker, jobs, processes):
+    '''Run shard jobs across a process pool, results are returned in job
+       order'''
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        results = pool.map(worker, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def catShards(shards, outfile):
+    '''Concatenate per contig BAMs, which share a header, in contig
+       order - the result is coordinate sorted without a re-sort'''
+
+    pysam.cat("-o", outfile, *shards)
+    pysam.index(outfile)
+
+
+def contigShards(infile, tmpdir, exclude=[]):
+    '''Check infile can be sharded & return (contigs, shard directory)'''
+
+    inbam = pysam.AlignmentFile(infile, "rb")
+
+    if not isCoordinateSorted(inbam) or not inbam.has_index():
+        raise ValueError("contigShards: %s must be coordinate sorted & indexed" % infile)
+
+    contigs = keepContigs(inbam, exclude)
+    inbam.close()
+
+    return contigs, tempfile.mkdtemp(dir=tmpdir)
+
+
+def filterShard(job):
+    '''filterBam worker for one contig'''
+
+    infile, shard, contig, mapq = job
+
+    inbam = pysam.AlignmentFile(infile, "rb")
+    outbam = pysam.AlignmentFile(shard, "wb", template=inbam)
+
+    for read in inbam.fetch(contig):
+        if passesFilter(read, mapq):
+            outbam.write(read)
+
+    outbam.close()
+    inbam.close()
+
+
+def filterBamSharded(infile, outfile, mapq=10, exclude=["chrM"], processes=4, tmpdir=None):
+    '''filterBam split by contig across processes'''
+
+    contigs, shard_dir = contigShards(infile, tmpdir, exclude)
+    shards = [os.path.join(shard_dir, "%06i.bam" % i) for i in range(len(contigs))]
+
+    jobs = [(infile, shard, contig, mapq) for shard, contig in zip(shards, contigs)]
+    runShards(filterShard, jobs, processes)
+
+    catShards(shards, outfile)
+    shutil.rmtree(shard_dir)
+
+
+def prepShard(job):
+    '''writePrepBams worker for one contig. Duplicate windows are flushed
+       at contig ends, so results match a single pass'''
+
+    infile, shard, size_shard, contig, insert_size, dedup = job
+
+    return writePrepBams(infile, shard, size_shard, insert_size, 1, dedup, contig)
+
+
+def writePrepBamsSharded(infile, outfile, size_outfile=None, insert_size=150,
+                         metrics_file=None, processes=4, tmpdir=None):
+    '''writePrepBams, removing duplicates if metrics_file is given, split by
+       contig across processes'''
+
+    contigs, shard_dir = contigShards(infile, tmpdir)
+    shards = [os.path.join(shard_dir, "%06i.all.bam" % i) for i in range(len(contigs))]
+
+    if size_outfile:
+        size_shards = [x.replace(".all.bam", ".size_filt.bam") for x in shards]
+    else:
+        size_shards = [None] * len(shards)
+
+    jobs = [(infile, shard, size_shard, contig, insert_size, metrics_file is not None)
+            for shard, size_shard, contig in zip(shards, size_shards, contigs)]
+    results = runShards(prepShard, jobs, processes)
+
+    if metrics_file:
+        metrics = dict.fromkeys(results[0], 0)
+        for result in results:
+            for key, value in result.items():
+                metrics[key] += value
+
+        writeDuplicationMetrics(metrics, metrics_file, infile)
+
+    catShards(shards, outfile)
+    if size_outfile:
+        catShards(size_shards, size_outfile)
+
+    shutil.rmtree(shard_dir)
+
+
+#####################################################
+####                 BAM QC                      ####
+#####################################################
+
+# samtools flagstat categories, in output order
+FLAGSTAT = ["in total (QC-passed reads + QC-failed reads)", "secondary", "supplementary",
+            "duplicates", "mapped", "paired in sequencing", "read1", "read2",
+            "properly paired", "with itself and mate mapped", "singletons",
+            "with mate mapped to a different chr", "with mate mapped to a different chr (mapQ>=5)"]
+
+# Picard default adapters (single end, paired end, indexed) & Nextera
+ADAPTERS = ["AATGATACGGCGACCACCGACAGGTTCAGAGTTCTACAGTCCGACG",
+            "ATCTCGTATGCCGTCTTCTGCTTG",
+            "AATGATACGGCGACCACCGAGATCTACACTCTTTCCCTACACGACGCTCTTCCGATCT",
+            "AGATCGGAAGAGCGGTTCAGCAGGAATGCCGAGACCGATCTCGTATGCCGTCTTCTGCTTG",
+            "AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC",
+            "CTGTCTCTTATACACATCTCCGAGCCCACGAGAC",
+            "CTGTCTCTTATACACATCTGACGCTGCCGACGA"]
+
+ADAPTER_MATCH_LENGTH = 16
+
+# alignment summary counters
+ALIGNMENT_COUNTS = ["TOTAL_READS", "PF_READS", "PF_READS_ALIGNED", "PF_ALIGNED_BASES",
+                    "PF_HQ_ALIGNED_READS", "PF_HQ_ALIGNED_BASES", "READ_LENGTH",
+                    "READS_ALIGNED_IN_PAIRS", "PF_READS_IMPROPER_PAIRS",
+                    "POSITIVE_STRAND", "CHIMERAS", "ADAPTER"]
+
+
+def adapterKmers(adapters=ADAPTERS, k=ADAPTER_MATCH_LENGTH):
+    '''All adapter (& reverse complement) prefixes of length k, with up to
+       one mismatch, as a set for constant time lookup'''
+
+    complement = str.maketrans("ACGTN", "TGCAN")
+
+    prefixes = [a[:k] for a in adapters] + \
+               [a.translate(complement)[::-1][:k] for a in adapters]
+
+    kmers = set()
+    for prefix in prefixes:
+        for i in range(k):
+            for base in "ACGTN":
+                kmers.add(prefix[:i] + base + prefix[i + 1:])
+
+    return kmers
+
+
+def pairOrientation(read):
+    '''Picard SamPairUtil pair orientation (FR, RF, TANDEM)'''
+
+    if read.is_reverse == read.mate_is_reverse:
+        return "TANDEM"
+
+    if read.is_reverse:
+        positive = read.next_reference_start
+        negative = read.reference_end
+    else:
+        positive = read.reference_start
+        negative = read.reference_start + read.template_length
+
+    if positive < negative:
+        return "FR"
+    else:
+        return "RF"
+
+
+def collectBamQC(infile, threads=2):
+    '''Collect samtools flagstat & idxstats counts, Picard alignment
+       summary counts and the Picard insert size histogram in a single pass.
+       Returns a dict of results for the write* functions'''
+
+    inbam = pysam.AlignmentFile(infile, "rb", threads=threads)
+
+    flagstat = [[0] * len(FLAGSTAT), [0] * len(FLAGSTAT)]
+    mapped = [0] * inbam.nreferences
+    unmapped = [0] * inbam.nreferences
+    unplaced = 0
+    categories = {}
+    inserts = {}
+    kmers = adapterKmers()
+    paired_end = False
+
+    for read in inbam.fetch(until_eof=True):
+        fs = flagstat[1 if read.is_qcfail else 0]
+
+        # samtools flagstat
+        fs[0] += 1
+        if read.is_secondary:
+            fs[1] += 1
+        elif read.is_supplementary:
+            fs[2] += 1
+        elif read.is_paired:
+            fs[5] += 1
+            if read.is_proper_pair and not read.is_unmapped:
+                fs[8] += 1
+            if read.is_read1:
+                fs[6] += 1
+            if read.is_read2:
+                fs[7] += 1
+            if read.mate_is_unmapped and not read.is_unmapped:
+                fs[10] += 1
+            if not read.is_unmapped and not read.mate_is_unmapped:
+                fs[9] += 1
+                if read.next_reference_id != read.reference_id:
+                    fs[11] += 1
+                    if read.mapping_quality >= 5:
+                        fs[12] += 1
+        if not read.is_unmapped:
+            fs[4] += 1
+        if read.is_duplicate:
+            fs[3] += 1
+
+        # samtools idxstats
+        if read.reference_id < 0:
+            unplaced += 1
+        elif read.is_unmapped:
+            unmapped[read.reference_id] += 1
+        else:
+            mapped[read.reference_id] += 1
+
+        if read.is_secondary or read.is_supplementary:
+            continue
+
+        # Picard CollectAlignmentSummaryMetrics, by read category
+        if read.is_paired:
+            paired_end = True
+            category = "FIRST_OF_PAIR" if read.is_read1 else "SECOND_OF_PAIR"
+        else:
+            category = "UNPAIRED"
+
+        if category not in categories:
+            categories[category] = dict.fromkeys(ALIGNMENT_COUNTS, 0)
+        c = categories[category]
+
+        c["TOTAL_READS"] += 1
+
+        if read.is_qcfail:
+            continue
+
+        c["PF_READS"] += 1
+        c["READ_LENGTH"] += read.infer_read_length() or 0
+
+        if read.is_unmapped:
+            seq = read.query_sequence
+            if seq is not None and seq[:ADAPTER_MATCH_LENGTH] in kmers:
+                c["ADAPTER"] += 1
+            continue
+
+        aligned_bases = sum(n for op, n in read.cigartuples if op in (0, 7, 8))
+
+        c["PF_READS_ALIGNED"] += 1
+        c["PF_ALIGNED_BASES"] += aligned_bases
+        if not read.is_reverse:
+            c["POSITIVE_STRAND"] += 1
+
+        in_pair = read.is_paired and not read.mate_is_unmapped
+
+        if in_pair:
+            c["READS_ALIGNED_IN_PAIRS"] += 1
+            if not read.is_proper_pair:
+                c["PF_READS_IMPROPER_PAIRS"] += 1
+
+        if read.mapping_quality >= 20:
+            c["PF_HQ_ALIGNED_READS"] += 1
+            c["PF_HQ_ALIGNED_BASES"] += aligned_bases
+            if read.has_tag("SA") or (in_pair and (read.next_reference_id != read.reference_id or
+                                                   abs(read.template_length) > 100000)):
+                c["CHIMERAS"] += 1
+
+        # Picard CollectInsertSizeMetrics, one read (the second) per pair
+        if not in_pair or read.is_read1 or read.is_duplicate or read.template_length == 0:
+            continue
+
+        orientation = pairOrientation(read)
+        if orientation not in inserts:
+            inserts[orientation] = {}
+        size = abs(read.template_length)
+        inserts[orientation][size] = inserts[orientation].get(size, 0) + 1
+
+    contigs = [[contig, length, mapped[i], unmapped[i]] for i, (contig, length) in
+               enumerate(zip(inbam.references, inbam.lengths))]
+    contigs.append(["*", 0, 0, unplaced])
+
+    inbam.close()
+
+    # PAIR is the sum of both reads of pairs
+    if paired_end:
+        categories["PAIR"] = dict.fromkeys(ALIGNMENT_COUNTS, 0)
+        for category in ["FIRST_OF_PAIR", "SECOND_OF_PAIR"]:
+            for key, value in categories.get(category, {}).items():
+                categories["PAIR"][key] += value
+
+    return {"flagstat": flagstat, "contigs": contigs,
+            "alignment": categories, "inserts": inserts}
+
+
+def writeFlagstat(qc, outfile):
+    '''Write flagstat counts as samtools (1.9) flagstat'''
+
+    passed, failed = qc["flagstat"]
+
+    def pct(n, total):
+        return "%.2f%%" % (100.0 * n / total) if total > 0 else "N/A"
+
+    with open(outfile, "w") as o:
+        for i, category in enumerate(FLAGSTAT):
+            line = "%i + %i %s" % (passed[i], failed[i], category)
+
+            if category in ["mapped", "properly paired", "singletons"]:
+                total = 0 if category == "mapped" else 5
+                line = line + " (%s : %s)" % (pct(passed[i], passed[total]),
+                                              pct(failed[i], failed[total]))
+            o.write(line + "\n")
+
+
+def writeContigCounts(qc, outfile, name):
+    '''Write per contig counts as samtools idxstats, plus sample name column'''
+
+    with open(outfile, "w") as o:
+        for row in qc["contigs"]:
+            o.write("\t".join(str(x) for x in row + [name]) + "\n")
+
+
+def writeAlignmentSummary(qc, outfile):
+    '''Write the Picard CollectAlignmentSummaryMetrics table (without "#"
+       header lines). Reference dependent mismatch/error rates are not
+       calculated'''
+
+    cols = ["CATEGORY", "TOTAL_READS", "PF_READS", "PCT_PF_READS", "PF_NOISE_READS",
+            "PF_READS_ALIGNED", "PCT_PF_READS_ALIGNED", "PF_ALIGNED_BASES",
+            "PF_HQ_ALIGNED_READS", "PF_HQ_ALIGNED_BASES", "MEAN_READ_LENGTH",
+            "READS_ALIGNED_IN_PAIRS", "PCT_READS_ALIGNED_IN_PAIRS",
+            "PF_READS_IMPROPER_PAIRS", "PCT_PF_READS_IMPROPER_PAIRS",
+            "STRAND_BALANCE", "PCT_CHIMERAS", "PCT_ADAPTER",
+            "SAMPLE", "LIBRARY", "READ_GROUP"]
+
+    def divide(a, b):
+        return round(a / b, 6) if b > 0 else 0
+
+    with open(outfile, "w") as o:
+        o.write("\n" + "\t".join(cols) + "\n")
+
+        for category in ["FIRST_OF_PAIR", "SECOND_OF_PAIR", "PAIR", "UNPAIRED"]:
+            if category not in qc["alignment"]:
+                continue
+            c = qc["alignment"][category]
+
+            row = [category, c["TOTAL_READS"], c["PF_READS"],
+                   divide(c["PF_READS"], c["TOTAL_READS"]), 0,
+                   c["PF_READS_ALIGNED"], divide(c["PF_READS_ALIGNED"], c["PF_READS"]),
+                   c["PF_ALIGNED_BASES"], c["PF_HQ_ALIGNED_READS"], c["PF_HQ_ALIGNED_BASES"],
+                   divide(c["READ_LENGTH"], c["PF_READS"]),
+                   c["READS_ALIGNED_IN_PAIRS"],
+                   divide(c["READS_ALIGNED_IN_PAIRS"], c["PF_READS_ALIGNED"]),
+                   c["PF_READS_IMPROPER_PAIRS"],
+                   divide(c["PF_READS_IMPROPER_PAIRS"], c["PF_READS_ALIGNED"]),
+                   divide(c["POSITIVE_STRAND"], c["PF_READS_ALIGNED"]),
+                   divide(c["CHIMERAS"], c["PF_HQ_ALIGNED_READS"]),
+                   divide(c["ADAPTER"], c["PF_READS"]), "", "", ""]
+
+            o.write("\t".join(str(x) for x in row) + "\n")
+
+        o.write("\n\n")
+
+
+def histogramMedian(sizes, counts):
+    '''Median of a histogram, as Picard Histogram.getMedian'''
+
+    total = counts.sum()
+
+    if total == 0:
+        return 0
+
+    cumulative = np.cumsum(counts)
+
+    if total % 2 == 0:
+        mid_low, mid_high = total / 2, total / 2 + 1
+    else:
+        mid_low = mid_high = math.ceil(total / 2)
+
+    low = sizes[np.searchsorted(cumulative, mid_low)]
+    high = sizes[np.searchsorted(cumulative, mid_high)]
+
+    return (low + high) / 2
+
+
+def insertSizeMetrics(histogram, deviations=10):
+    '''Picard InsertSizeMetrics for one orientation's histogram
+       (dict of insert size: count). Returns (metrics, trimmed histogram)'''
+
+    sizes = np.array(sorted(histogram), dtype=np.int64)
+    counts = np.array([histogram[x] for x in sizes], dtype=np.int64)
+    total = counts.sum()
+
+    median = histogramMedian(sizes, counts)
+
+    deviation = np.abs(sizes - median)
+    order = np.argsort(deviation, kind="stable")
+    mad = histogramMedian(deviation[order], counts[order])
+
+    metrics = {"MEDIAN_INSERT_SIZE": median,
+               "MEDIAN_ABSOLUTE_DEVIATION": mad,
+               "MIN_INSERT_SIZE": int(sizes.min()),
+               "MAX_INSERT_SIZE": int(sizes.max()),
+               "READ_PAIRS": int(total)}
+
+    # width of the window around the median covering 10..99% of inserts
+    covered = np.cumsum(np.bincount(np.abs(sizes - int(median)), weights=counts))
+    for pct in [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99]:
+        distance = min(np.searchsorted(covered, total * pct / 100.0), len(covered) - 1)
+        metrics["WIDTH_OF_%i_PERCENT" % pct] = int(distance) * 2 + 1
+
+    # trim outliers before mean & standard deviation
+    keep = sizes <= int(median + deviations * mad)
+    sizes, counts = sizes[keep], counts[keep]
+
+    mean = (sizes * counts).sum() / counts.sum()
+    variance = (counts * (sizes - mean) ** 2).sum() / max(counts.sum() - 1, 1)
+
+    metrics["MEAN_INSERT_SIZE"] = round(float(mean), 6)
+    metrics["STANDARD_DEVIATION"] = round(float(math.sqrt(variance)), 6)
+
+    return metrics, dict(zip(sizes.tolist(), counts.tolist()))
+
+
+def writeInsertSizes(qc, metrics_file, histogram_file, min_pct=0.5):
+    '''Write Picard CollectInsertSizeMetrics tables (first metrics row &
+       histogram, without "#" header lines) for orientations with at least
+       min_pct of all pairs'''
+
+    cols = ["MEDIAN_INSERT_SIZE", "MEDIAN_ABSOLUTE_DEVIATION", "MIN_INSERT_SIZE",
+            "MAX_INSERT_SIZE", "MEAN_INSERT_SIZE", "STANDARD_DEVIATION", "READ_PAIRS",
+            "PAIR_ORIENTATION"] + \
+           ["WIDTH_OF_%i_PERCENT" % x for x in [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99]] + \
+           ["SAMPLE", "LIBRARY", "READ_GROUP"]
+
+    inserts = qc["inserts"]
+    total = sum(sum(h.values()) for h in inserts.values())
+
+    rows, histograms = [], {}
+    for orientation in ["FR", "RF", "TANDEM"]:
+        if orientation not in inserts or sum(inserts[orientation].values()) < total * min_pct:
+            continue
+
+        metrics, histogram = insertSizeMetrics(inserts[orientation])
+        metrics["PAIR_ORIENTATION"] = orientation
+        metrics["SAMPLE"], metrics["LIBRARY"], metrics["READ_GROUP"] = "", "", ""
+
+        rows.append([metrics[c] for c in cols])
+        histograms["All_Reads.%s_count" % orientation.lower()] = histogram
+
+    with open(metrics_file, "w") as o:
+        o.write("\t".join(cols) + "\n")
+        # Picard tables were loaded from the first metrics row only
+        for row in rows[:1]:
+            o.write("\t".join(str(x) for x in row) + "\n")
+
+    with open(histogram_file, "w") as o:
+        names = list(histograms)
+        o.write("\t".join(["insert_size"] + names) + "\n")
+
+        sizes = sorted(set().union(*[histograms[n].keys() for n in names]))
+        for size in sizes:
+            o.write("\t".join(str(x) for x in [size] + [histograms[n].get(size, 0) for n in names]) + "\n")
+        o.write("\n")
+
+
+#####################################################
+####           Tn5 insertion index               ####
+#####################################################
+
+# Tn5 binds as a dimer & inserts adapters 9 b.p. apart, read 5' ends are
+# shifted to the centre of the duplication
+TN5_SHIFT = {False: 4, True: -5}
+
+# longest fragment length stored, larger values are clipped
+MAX_FRAGMENT = np.iinfo(np.uint16).max
+
+
+def insertionSite(read):
+    '''0-based Tn5 insertion position of a mapped read, + strand starts
+       are shifted +4, - strand (exclusive) ends -5, so both reads from
+       one insertion event give the same position'''
+
+    if read.is_reverse:
+        return read.reference_end + TN5_SHIFT[True]
+    else:
+        return read.reference_start + TN5_SHIFT[False]
+
+
+def insertionFile(index_dir, contig, column):
+    return os.path.join(index_dir, "%s.%s.npy" % (contig, column))
+
+
+def writeInsertions(index_dir, contig, positions, fragments, strands):
+    '''Sort a contigs insertions by position & save each column as .npy'''
+
+    positions = np.frombuffer(positions, dtype=np.int64)
+    order = np.argsort(positions, kind="stable")
+
+    columns = {"pos": np.clip(positions[order], 0, None).astype(np.uint32),
+               "frag": np.clip(np.frombuffer(fragments, dtype=np.int64)[order],
+                               0, MAX_FRAGMENT).astype(np.uint16),
+               "rev": np.frombuffer(strands, dtype=np.uint8)[order].astype(np.bool_)}
+
+    for column, values in columns.items():
+        np.save(insertionFile(index_dir, contig, column), values)
+
+    return len(order)
+
+
+def buildInsertionIndex(infile, index_dir, threads=2):
+    '''Extract Tn5 insertion sites, fragment length (0 if unpaired) & strand
+       from every mapped primary read in a prep BAM, in one pass.
+       Each contig is saved as sorted fixed width columns (uint32 position,
+       uint16 fragment length, bool reverse strand) which np.load can memory
+       map, so queries never decode the BAM. Columns are not zlib compressed
+       as this would prevent memory mapping.
+       contigs.tsv lists contig, length & number of insertions'''
+
+    os.makedirs(index_dir, exist_ok=True)
+
+    inbam = pysam.AlignmentFile(infile, "rb", threads=threads)
+
+    counts = dict.fromkeys(inbam.references, 0)
+    current = None
+
+    for read in inbam.fetch(until_eof=True):
+        if read.is_unmapped or read.is_secondary or read.is_supplementary:
+            continue
+
+        if read.reference_name != current:
+            if current is not None:
+                counts[current] = writeInsertions(index_dir, current, positions, fragments, strands)
+
+            current = read.reference_name
+            positions, fragments, strands = array.array("q"), array.array("q"), array.array("B")
+
+        positions.append(insertionSite(read))
+        fragments.append(abs(read.template_length))
+        strands.append(read.is_reverse)
+
+    if current is not None:
+        counts[current] = writeInsertions(index_dir, current, positions, fragments, strands)
+
+    lengths = dict(zip(inbam.references, inbam.lengths))
+    inbam.close()
+
+    with open(os.path.join(index_dir, "contigs.tsv"), "w") as o:
+        o.write("contig\tlength\tinsertions\n")
+        for contig, n in counts.items():
+            o.write("%s\t%i\t%i\n" % (contig, lengths[contig], n))
+
+
+def insertionContigs(index_dir):
+    '''contigs.tsv of an insertion index as a DataFrame'''
+
+    return pd.read_csv(os.path.join(index_dir, "contigs.tsv"), sep="\t",
+                       dtype={"contig": str}).set_index("contig")
+
+
+def loadInsertions(index_dir, contig, min_frag=None, max_frag=None, strand=None):
+    '''Sorted insertion positions on contig, memory mapped. Optionally only
+       from fragments >= min_frag and/or < max_frag b.p., and/or one strand
+       ("+" or "-"), subsets are copied into memory'''
+
+    if not os.path.exists(insertionFile(index_dir, contig, "pos")):
+        return np.zeros(0, dtype=np.uint32)
+
+    pos = np.load(insertionFile(index_dir, contig, "pos"), mmap_mode="r")
+
+    if min_frag is None and max_frag is None and strand is None:
+        return pos
+
+    keep = np.ones(len(pos), dtype=np.bool_)
+
+    if min_frag is not None or max_frag is not None:
+        frag = np.load(insertionFile(index_dir, contig, "frag"), mmap_mode="r")
+        if min_frag is not None:
+            keep &= frag >= min_frag
+        if max_frag is not None:
+            keep &= frag < max_frag
+
+    if strand is not None:
+        rev = np.load(insertionFile(index_dir, contig, "rev"), mmap_mode="r")
+        keep &= rev == (strand == "-")
+
+    return pos[keep]
+
+
+def countInsertions(index_dir, contig, starts, ends, min_frag=None, max_frag=None):
+    '''Number of insertions in each 0-based half open interval on contig'''
+
+    pos = loadInsertions(index_dir, contig, min_frag, max_frag)
+
+    return np.searchsorted(pos, ends, side="left") - np.searchsorted(pos, starts, side="left")
+
+
+def countIntervalInsertions(index_dir, intervals, min_frag=None, max_frag=None):
+    '''Insertion counts for a DataFrame of intervals (contig, start, end
+       columns, any order), returned in the same order'''
+
+    counts = np.zeros(len(intervals), dtype=np.int64)
+
+    for contig, rows in intervals.groupby("contig", sort=False).indices.items():
+        counts[rows] = countInsertions(index_dir, contig,
+                                       intervals["start"].values[rows],
+                                       intervals["end"].values[rows],
+                                       min_frag, max_frag)
+
+    return counts
+
+
+def insertionProfile(index_dir, contig, start, end, min_frag=None, max_frag=None, strand=None):
+    '''Per base insertion counts over contig:start-end'''
+
+    pos = loadInsertions(index_dir, contig, min_frag, max_frag, strand)
+    lo, hi = np.searchsorted(pos, [start, end], side="left")
+
+    return np.bincount(np.asarray(pos[lo:hi], dtype=np.int64) - start, minlength=end - start)
+
+
+def totalInsertions(index_dir, min_frag=None, max_frag=None):
+    '''Total insertions in an index, all contigs'''
+
+    if min_frag is None and max_frag is None:
+        return int(insertionContigs(index_dir)["insertions"].sum())
+
+    return sum(len(loadInsertions(index_dir, contig, min_frag, max_frag))
+               for contig in insertionContigs(index_dir).index)
+
+
+#####################################################
+####        Peak to nearest gene assignment      ####
+#####################################################
+
+# closestGene.bed columns, TSSdist is signed (+ve: peak upstream of the TSS)
+CLOSEST_GENE_COLUMNS = ["contig", "peak_start", "peak_end", "peak_id", "peak_score",
+                        "peak_width", "peak_centre", "TSSdist", "gene_id", "TSS"]
+
+
+def greatCandidates(greatfile, genes):
+    '''GREAT domains (contig, start, end, gene_id) joined to gene TSSs,
+       genes is a DataFrame of gene_id, start, end, strand'''
+
+    domains = pd.read_csv(greatfile, sep="\t", header=None, dtype={0: str, 3: str},
+                          names=["contig", "start", "end", "gene_id"])
+
+    genes = genes.drop_duplicates(["gene_id", "start", "end", "strand"])
+    genes = genes.assign(tss=np.where(genes["strand"].isin(["-", -1]), genes["end"], genes["start"]),
+                         plus=~genes["strand"].isin(["-", -1]))
+
+    return domains.merge(genes[["gene_id", "tss", "plus"]], on="gene_id")
+
+
+def nearestContig(pstart, pend, tss, dstart, dend):
+    '''For peaks on one contig, index of the nearest TSS (sorted) whose GREAT
+       domain overlaps the peak, -1 if none. Flanking TSSs are found by
+       searchsorted & both sides walked outwards together for all peaks,
+       until a member domain is found or no domain could reach the peak'''
+
+    centre = (pstart + pend) / 2
+    reach = np.maximum(tss - dstart, dend - tss).max()
+
+    best = np.full(len(pstart), -1)
+    bestdist = np.full(len(pstart), np.inf)
+
+    right = np.searchsorted(tss, centre)
+
+    # left first, so ties go to the upstream TSS
+    for j, step in ((right - 1, -1), (right, 1)):
+        todo = np.arange(len(pstart))
+
+        while len(todo) > 0:
+            jj = j[todo]
+            todo, jj = todo[(jj >= 0) & (jj < len(tss))], jj[(jj >= 0) & (jj < len(tss))]
+
+            dist = np.abs(tss[jj] - centre[todo])
+            live = ((tss[jj] > pstart[todo] - reach) & (tss[jj] < pend[todo] + reach)
+                    & (dist < bestdist[todo]))
+            todo, jj, dist = todo[live], jj[live], dist[live]
+
+            member = (dstart[jj] < pend[todo]) & (dend[jj] > pstart[todo])
+            best[todo[member]] = jj[member]
+            bestdist[todo[member]] = dist[member]
+
+            todo = todo[~member]
+            j[todo] += step
+
+    return best
+
+
+def nearestGenes(peaks, candidates):
+    '''Assign each peak (contig, start, end, peak_id, peak_score, peak_width,
+       peak_centre) the gene with the nearest TSS among those whose GREAT
+       domain overlaps it. Peaks outside every domain are dropped.
+       Returns a DataFrame of CLOSEST_GENE_COLUMNS'''
+
+    tables = []
+
+    for contig, p in peaks.groupby("contig", sort=True):
+        c = candidates[candidates["contig"] == contig].sort_values("tss", kind="mergesort")
+
+        if len(c) == 0:
+            continue
+
+        tss = c["tss"].values.astype(np.int64)
+        pstart, pend = p["start"].values.astype(np.int64), p["end"].values.astype(np.int64)
+
+        best = nearestContig(pstart, pend, tss, c["start"].values, c["end"].values)
+        hit = best >= 0
+        best = best[hit]
+
+        centre = (pstart[hit] + pend[hit]) / 2
+        tssdist = np.where(c["plus"].values[best], tss[best] - centre, centre - tss[best])
+
+        table = p[hit].rename(columns={"start": "peak_start", "end": "peak_end"})
+        table = table.assign(TSSdist=tssdist, gene_id=c["gene_id"].values[best], TSS=tss[best])
+
+        tables.append(table[CLOSEST_GENE_COLUMNS])
+
+    if len(tables) == 0:
+        return pd.DataFrame(columns=CLOSEST_GENE_COLUMNS)
+
+    return pd.concat(tables).sort_values(["contig", "peak_start"], kind="mergesort")
+
+
+def writeClosestGenes(peakfile, greatfile, genes, outfile):
+    '''Write the closestGene.bed table (no header) of peaks in a merged peaks
+       bed & their nearest GREAT regulated gene'''
+
+    peaks = pd.read_csv(peakfile, sep="\t", header=None, usecols=[0, 1, 2, 3, 4, 6, 7],
+                        dtype={0: str, 3: str})
+    peaks.columns = ["contig", "start", "end", "peak_id", "peak_score", "peak_width", "peak_centre"]
+
+    closest = nearestGenes(peaks, greatCandidates(greatfile, genes))
+    closest.to_csv(outfile, sep="\t", header=False, index=False)
+
+
+#####################################################
+####           Peak count matrix                 ####
+#####################################################
+
+# closestGene.bed columns kept as count matrix row metadata, named as in the
+# counts tables (peak_center, where closestGene.bed has peak_centre)
+PEAK_COLUMNS = ["chromosome", "start", "end", "peak_id", "peak_score",
+                "peak_width", "peak_center", "gene_id"]
+
+
+def stablePeakIds(infile, outfile, previous=None, prefix="merged_peaks_"):
+    '''Write a merged peaks bed (peak_id in column 4) keeping the peak_ids of
+       a previous version for peaks with identical coordinates, new or
+       changed peaks are numbered on from the highest previous id.
+       Returns (kept, new) numbers of peaks'''
+
+    # read as text so other columns are written back unchanged
+    peaks = pd.read_csv(infile, sep="\t", header=None, dtype=str)
+
+    if previous is None or not os.path.exists(previous) or os.path.getsize(previous) == 0:
+        kept = np.zeros(len(peaks), dtype=np.bool_)
+        ids = pd.Series([None] * len(peaks), dtype=object)
+        start = 1
+    else:
+        old = pd.read_csv(previous, sep="\t", header=None, dtype=str)
+
+        key = lambda df: df[0] + ":" + df[1] + "-" + df[2]
+
+        ids = pd.Series(old[3].values, index=key(old)).reindex(key(peaks))
+        kept = ids.notna().values
+
+        numbers = pd.to_numeric(old[3].str[len(prefix):], errors="coerce")
+        start = int(numbers.max()) + 1 if numbers.notna().any() else 1
+
+    new = ~kept
+    peaks.loc[kept, 3] = ids.values[kept]
+    peaks.loc[new, 3] = [prefix + str(x) for x in range(start, start + new.sum())]
+
+    peaks.to_csv(outfile, sep="\t", header=False, index=False)
+
+    return int(kept.sum()), int(new.sum())
+
+
+def readPeaks(infile):
+    '''Peaks from a closestGene.bed file as a DataFrame of PEAK_COLUMNS'''
+
+    peaks = pd.read_csv(infile, sep="\t", header=None, dtype={0: str})
+    peaks = peaks[[0, 1, 2, 3, 4, 5, 6, 8]]
+    peaks.columns = PEAK_COLUMNS
+
+    return peaks
+
+
+def countSample(job):
+    '''countMatrix worker, insertions per interval for one sample'''
+
+    index_dir, intervals = job
+
+    return countIntervalInsertions(index_dir, intervals).astype(np.uint32)
+
+
+def peakIntervals(peaks):
+    '''contig, start, end DataFrame of PEAK_COLUMNS peaks'''
+
+    return pd.DataFrame({"contig": peaks["chromosome"].values,
+                         "start": peaks["start"].values,
+                         "end": peaks["end"].values})
+
+
+def countMatrix(peaks, index_dirs, processes=4):
+    '''Count Tn5 insertions in every peak for every insertion index (one
+       column per sample), samples are counted in parallel processes.
+       Peaks are parsed once & counts are searchsorted over the memory mapped
+       indexes, so no BAMs are decoded. Returns a peaks x samples array'''
+
+    intervals = peakIntervals(peaks)
+
+    columns = runShards(countSample, [(x, intervals) for x in index_dirs], processes)
+
+    return np.column_stack(columns)
+
+
+def peakKeys(peaks):
+    '''peak_id & coordinates of PEAK_COLUMNS peaks, a peak is unchanged
+       between count matrices if its key is'''
+
+    return (peaks["peak_id"].astype(str) + ":" + peaks["chromosome"].astype(str) + ":" +
+            peaks["start"].astype(str) + "-" + peaks["end"].astype(str)).values
+
+
+def updateCountMatrix(peaks, index_dirs, samples, previous, processes=4):
+    '''countMatrix reusing the counts in a previous count matrix .npz. New
+       samples (or samples re-indexed since) are counted over all peaks,
+       the rest only over new or changed peaks.
+       Returns (peaks x samples array, number of intervals counted)'''
+
+    old_peaks, old_samples, old_counts = readCountMatrix(previous)
+
+    rows = pd.Series(np.arange(len(old_peaks)), index=peakKeys(old_peaks)).reindex(peakKeys(peaks))
+    known = rows.notna().values
+    rows = rows.values[known].astype(np.int64)
+
+    built = os.path.getmtime(previous)
+    intervals = peakIntervals(peaks)
+
+    counts = np.zeros((len(peaks), len(samples)), dtype=np.uint32)
+    jobs, columns = [], []
+
+    for n, (index_dir, sample) in enumerate(zip(index_dirs, samples)):
+        current = (sample in old_samples and
+                   os.path.getmtime(os.path.join(index_dir, "contigs.tsv")) < built)
+
+        if current:
+            counts[known, n] = old_counts[rows, old_samples.index(sample)]
+            subset = ~known
+        else:
+            subset = np.ones(len(peaks), dtype=np.bool_)
+
+        if subset.any():
+            jobs.append((index_dir, intervals[subset]))
+            columns.append((n, subset))
+
+    for (n, subset), column in zip(columns, runShards(countSample, jobs, processes)):
+        counts[subset, n] = column
+
+    return counts, sum(len(x[1]) for x in jobs)
+
+
+def writeCountMatrix(outfile, peaks, samples, counts, norm={}):
+    '''Save a count matrix with row (peak) & column (sample) metadata as
+       a compressed .npz, optionally with normaliseCounts matrices'''
+
+    # lists give fixed width unicode arrays for strings, which load without pickle
+    arrays = {"peak_" + c: np.array(peaks[c].tolist()) for c in PEAK_COLUMNS}
+    arrays.update({"norm_" + c: m for c, m in norm.items()})
+
+    np.savez_compressed(outfile, counts=counts, samples=np.array(samples, dtype=str), **arrays)
+
+
+def readCountMatrix(infile):
+    '''Read a writeCountMatrix .npz, returns (peaks, samples, counts)'''
+
+    npz = np.load(infile)
+
+    peaks = pd.DataFrame({c: npz["peak_" + c] for c in PEAK_COLUMNS})
+
+    return peaks, [str(x) for x in npz["samples"]], npz["counts"]
+
+
+def readNormMatrix(infile):
+    '''Read a writeCountMatrix .npz with normalised matrices, returns
+       (peaks, samples, counts, norm)'''
+
+    peaks, samples, counts = readCountMatrix(infile)
+
+    npz = np.load(infile)
+    norm = {c: npz["norm_" + c] for c in NORM_COLUMNS}
+
+    return peaks, samples, counts, norm
+
+
+def writeCountTable(outfile, peaks, samples, counts):
+    '''Write a count matrix as a wide tab seperated table for loading,
+       sample columns have "." replaced by "_"'''
+
+    table = peaks.copy()
+
+    for n, sample in enumerate(samples):
+        table[sample.replace(".", "_")] = counts[:, n]
+
+    table.to_csv(outfile, sep="\t", header=True, index=False)
+
+
+#####################################################
+####           Count normalisation               ####
+#####################################################
+
+# per sample normalisations appended to all_norm_counts, after the
+# original RPM & RPM_width_norm columns
+NORM_COLUMNS = ["RPM", "RPM_width_norm", "upper_quartile", "TMM", "CPM_peaks"]
+
+
+def geometricScale(factors):
+    '''Scale normalisation factors to a geometric mean of 1, as edgeR'''
+
+    return factors / np.exp(np.mean(np.log(factors)))
+
+
+def upperQuartileFactors(counts, p=0.75):
+    '''edgeR upper quartile factors, columns are samples. Peaks with no
+       counts in any sample are ignored'''
+
+    counts = counts[counts.sum(axis=1) > 0].astype(float)
+    factors = np.quantile(counts / counts.sum(axis=0), p, axis=0)
+
+    return geometricScale(factors)
+
+
+def tmmFactors(counts, logratio_trim=0.3, sum_trim=0.05):
+    '''edgeR (calcNormFactors) trimmed mean of M values factors, columns
+       are samples. The reference is the sample with upper quartile closest
+       to the mean. Peaks with no counts in any sample are ignored'''
+
+    counts = counts[counts.sum(axis=1) > 0].astype(float)
+    libs = counts.sum(axis=0)
+
+    quartiles = np.quantile(counts / libs, 0.75, axis=0)
+    ref = np.argmin(np.abs(quartiles - quartiles.mean()))
+
+    factors = np.ones(counts.shape[1])
+
+    for n in range(counts.shape[1]):
+        obs, nO = counts[:, n], libs[n]
+        exp, nR = counts[:, ref], libs[ref]
+
+        finite = (obs > 0) & (exp > 0)
+        obs, exp = obs[finite], exp[finite]
+
+        logR = np.log2((obs / nO) / (exp / nR))
+        absE = (np.log2(obs / nO) + np.log2(exp / nR)) / 2
+        v = (nO - obs) / nO / obs + (nR - exp) / nR / exp
+
+        if len(logR) == 0 or np.max(np.abs(logR)) < 1e-6:
+            continue
+
+        k = len(logR)
+        loL, loS = math.floor(k * logratio_trim) + 1, math.floor(k * sum_trim) + 1
+        hiL, hiS = k + 1 - loL, k + 1 - loS
+
+        rankR = pd.Series(logR).rank().values
+        rankE = pd.Series(absE).rank().values
+        keep = (rankR >= loL) & (rankR <= hiL) & (rankE >= loS) & (rankE <= hiS)
+
+        factors[n] = 2 ** (np.sum(logR[keep] / v[keep]) / np.sum(1 / v[keep]))
+
+    return geometricScale(factors)
+
+
+def normaliseCounts(counts, widths, library_sizes):
+    '''Normalise a peaks x samples count matrix with whole column NumPy
+       operations. library_sizes are mapped reads (millions) per sample.
+       Returns a dict of NORM_COLUMNS matrices:
+         RPM - counts per million mapped reads
+         RPM_width_norm - RPM / peak width
+         upper_quartile, TMM - CPM of reads in peaks scaled by edgeR factors
+         CPM_peaks - counts per million reads in peaks'''
+
+    counts = counts.astype(float)
+    widths = np.where(widths > 0, widths, 1).astype(float)[:, None]
+
+    in_peaks = counts.sum(axis=0) / 1E06
+    in_peaks[in_peaks == 0] = np.nan
+
+    norm = {"RPM": counts / np.asarray(library_sizes, dtype=float)}
+    norm["RPM_width_norm"] = norm["RPM"] / widths
+    norm["CPM_peaks"] = counts / in_peaks
+    norm["upper_quartile"] = norm["CPM_peaks"] / upperQuartileFactors(counts)
+    norm["TMM"] = norm["CPM_peaks"] / tmmFactors(counts)
+
+    return norm
+
+
+def countsSampleId(name):
+    '''(sample_id, size_filt) of all_norm_counts for a sample name, as
+       previously derived per row'''
+
+    name = name.rstrip("_prep")
+    size_filt = "<150bp" if "size_filt" in name else "all_fragments"
+
+    return name.strip("_size_filt"), size_filt
+
+
+def normCountsTable(peaks, samples, counts, norm):
+    '''Long format all_norm_counts table, samples stacked in order'''
+
+    n = len(peaks)
+
+    table = pd.DataFrame({c: np.tile(peaks[c].values, len(samples)) for c in PEAK_COLUMNS})
+    table["total"] = counts.ravel(order="F")
+
+    for c in NORM_COLUMNS[:2]:
+        table[c] = norm[c].ravel(order="F")
+
+    ids = [countsSampleId(x.replace(".", "_")) for x in samples]
+    table["sample_id"] = np.repeat([x[0] for x in ids], n)
+    table["size_filt"] = np.repeat([x[1] for x in ids], n)
+
+    for c in NORM_COLUMNS[2:]:
+        table[c] = norm[c].ravel(order="F")
+
+    return table
+
+
+#####################################################
+####           Wide norm_counts tables           ####
+#####################################################
+
+# measures stored as one wide table each, norm_counts_<measure>
+NORM_MEASURES = ["total"] + NORM_COLUMNS
+
+
+def normCountsSchema(samples, chunk_types):
+    '''CREATE TABLE statements for the wide norm_counts tables'''
+
+    statements = ["""CREATE TABLE norm_counts_samples (sample_code INTEGER PRIMARY KEY,
+                     sample TEXT, sample_id TEXT, size_filt TEXT)""",
+                  """CREATE TABLE norm_counts_peaks (peak_code INTEGER PRIMARY KEY,
+                     peak_id TEXT, chromosome TEXT, start INTEGER, end INTEGER,
+                     peak_score REAL, peak_width INTEGER, peak_center INTEGER, gene_id TEXT)""",
+                  "CREATE INDEX norm_counts_peaks_peak_id ON norm_counts_peaks(peak_id)"]
+
+    for measure in NORM_MEASURES:
+        columns = ", ".join("s%i %s" % (n, chunk_types[measure]) for n in range(len(samples)))
+        statements.append("CREATE TABLE norm_counts_%s (peak_code INTEGER PRIMARY KEY, %s)" % (measure, columns))
+
+    return statements
+
+
+def writeNormCountsDb(dbfile, infiles, chunk=50000):
+    '''Store normalised count matrices (readNormMatrix .npz files, rows
+       appended in file order) in dbfile as typed, wide tables:
+         norm_counts_samples - integer sample_code per sample, with sample_id
+                               & size_filt (categorical, stored per sample)
+         norm_counts_peaks - integer peak_code & peak metadata, peak_id indexed
+         norm_counts_<measure> - peak_code & one column (s<sample_code>) per sample
+       Rows are written in chunks, so the long table is never built'''
+
+    types = dict.fromkeys(NORM_MEASURES, "REAL")
+    types["total"] = "INTEGER"
+
+    dbh = sqlite3.connect(dbfile)
+    cc = dbh.cursor()
+
+    for table in ["samples", "peaks"] + NORM_MEASURES:
+        cc.execute("DROP TABLE IF EXISTS norm_counts_%s" % table)
+
+    offset = 0
+
+    for n, infile in enumerate(infiles):
+        peaks, samples, counts, norm = readNormMatrix(infile)
+        norm["total"] = counts
+
+        if n == 0:
+            for statement in normCountsSchema(samples, types):
+                cc.execute(statement)
+
+            ids = [countsSampleId(x.replace(".", "_")) for x in samples]
+            cc.executemany("INSERT INTO norm_counts_samples VALUES (?, ?, ?, ?)",
+                           [(i, x, ids[i][0], ids[i][1]) for i, x in enumerate(samples)])
+            first = samples
+
+        elif samples != first:
+            raise ValueError("writeNormCountsDb: %s has different samples to %s" % (infile, infiles[0]))
+
+        codes = np.arange(offset, offset + len(peaks))
+        metadata = peaks[["peak_id", "chromosome", "start", "end", "peak_score",
+                          "peak_width", "peak_center", "gene_id"]]
+
+        for start in range(0, len(peaks), chunk):
+            end = start + chunk
+
+            rows = zip(codes[start:end].tolist(), *[metadata[c].values[start:end].tolist()
+                                                    for c in metadata.columns])
+            cc.executemany("INSERT INTO norm_counts_peaks VALUES (%s)" % ", ".join("?" * 9), rows)
+
+            for measure in NORM_MEASURES:
+                values = norm[measure][start:end]
+                if types[measure] == "INTEGER":
+                    values = values.astype(np.int64).tolist()
+                else:
+                    # NaN (no library size) is stored as NULL
+                    values = np.where(np.isnan(values), None, values).tolist()
+
+                cc.executemany("INSERT INTO norm_counts_%s VALUES (%s)" %
+                               (measure, ", ".join("?" * (len(samples) + 1))),
+                               [[code] + row for code, row in zip(codes[start:end].tolist(), values)])
+
+        offset += len(peaks)
+
+    dbh.commit()
+    cc.close()
+    dbh.close()
+
+
+def readNormCounts(dbfile=db, measure="total", size_filt="all_fragments"):
+    '''Wide peaks x samples DataFrame (index peak_id, columns sample_id) of
+       one norm_counts measure, for samples with size_filt ("all_fragments"
+       or "<150bp"). Replaces querying all_norm_counts & pivoting'''
+
+    dbh = sqlite3.connect(dbfile)
+    cc = dbh.cursor()
+
+    samples = cc.execute("""SELECT sample_code, sample_id FROM norm_counts_samples
+                            WHERE size_filt = ? ORDER BY sample_code""", (size_filt,)).fetchall()
+
+    columns = ", ".join("m.s%i" % code for code, sample_id in samples)
+
+    sqlresult = cc.execute("""SELECT p.peak_id, %s FROM norm_counts_%s AS m
+                              INNER JOIN norm_counts_peaks AS p ON m.peak_code = p.peak_code
+                              ORDER BY m.peak_code""" % (columns, measure)).fetchall()
+    cc.close()
+    dbh.close()
+
+    df = pd.DataFrame.from_records(sqlresult, columns=["peak_id"] + [x[1] for x in samples])
+    df = df.set_index("peak_id")
+    df.index.name = None
+
+    return df
+
+
+#####################################################
+####           Replicate peak merging            ####
+#####################################################
+
+# filtered MACS2 peak (.peaks.bed) columns
+PEAK_BED_COLUMNS = ["contig", "start", "end", "peak_id", "peak_score", "strand",
+                    "FC", "pval", "qval", "summit"]
+
+
+def readPeakSets(infiles):
+    '''Concatenate peak files, adding the replicate (file) number, sorted
+       as sort -k1,1 -k2,2n'''
+
+    peaks = []
+
+    for n, infile in enumerate(infiles):
+        df = pd.read_csv(infile, sep="\t", header=None, names=PEAK_BED_COLUMNS,
+                         usecols=range(len(PEAK_BED_COLUMNS)), dtype={0: str, 3: str, 5: str})
+        df["replicate"] = n
+        peaks.append(df)
+
+    peaks = pd.concat(peaks, ignore_index=True)
+
+    return peaks.sort_values(["contig", "start"], kind="mergesort").reset_index(drop=True)
+
+
+def mergeContigPeaks(peaks):
+    '''Merge overlapping or book-ended peaks on one contig (sorted by
+       start) in a single sweep, as bedtools merge -c 4,5,6,7,8,9,10
+       -o collapse,mean,first,mean,min,min,mean. Also returns the number of
+       distinct replicates supporting each merged region'''
+
+    starts, ends = peaks["start"].values, peaks["end"].values
+
+    # a region starts where no earlier peak reaches this start
+    reach = np.maximum.accumulate(ends)
+    first = np.ones(len(peaks), dtype=np.bool_)
+    first[1:] = starts[1:] > reach[:-1]
+
+    bounds = np.flatnonzero(first)
+    region = np.cumsum(first) - 1
+    sizes = np.diff(np.append(bounds, len(peaks)))
+
+    def mean(column):
+        return np.add.reduceat(peaks[column].values.astype(float), bounds) / sizes
+
+    # replicates as bits, so support is the popcount of the OR over the region
+    bits = np.bitwise_or.reduceat(np.left_shift(1, peaks["replicate"].values.astype(np.int64)), bounds)
+    support = np.zeros(len(bounds), dtype=np.int64)
+    for n in range(int(peaks["replicate"].max()) + 1):
+        support += (bits >> n) & 1
+
+    merged = pd.DataFrame({"contig": peaks["contig"].values[bounds],
+                           "start": starts[bounds],
+                           "end": np.maximum.reduceat(ends, bounds),
+                           "peak_id": peaks.groupby(region, sort=False)["peak_id"].agg(",".join).values,
+                           "peak_score": mean("peak_score"),
+                           "strand": peaks["strand"].values[bounds],
+                           "FC": mean("FC"),
+                           "pval": np.minimum.reduceat(peaks["pval"].values, bounds),
+                           "qval": np.minimum.reduceat(peaks["qval"].values, bounds),
+                           "summit": mean("summit")})
+
+    return merged, support
+
+
+def mergeReplicatePeaks(infiles, outfile, min_overlap=2):
+    '''Merge peaks from any number of replicates, keeping regions detected
+       in >= min_overlap replicates. Contigs are swept in turn & appended to
+       outfile'''
+
+    peaks = readPeakSets(infiles)
+    kept = []
+
+    with open(outfile, "w") as o:
+        for contig, df in peaks.groupby("contig", sort=False):
+            merged, support = mergeContigPeaks(df)
+            merged = merged[support >= min_overlap]
+            merged.to_csv(o, sep="\t", header=False, index=False)
+
+            kept.append(merged[["start", "end", "peak_score", "summit"]])
+
+    kept = pd.concat(kept) if len(kept) > 0 else pd.DataFrame(columns=["start", "end", "peak_score", "summit"])
+
+    writePeakStats(outfile, peakStats(kept["start"].values, kept["end"].values,
+                                      kept["peak_score"].values, kept["summit"].values))
+
+
+#####################################################
+####           Blacklist cache                   ####
+#####################################################
+
+def fileHash(infile):
+    '''sha1 of the (decompressed if gzipped) contents of a file'''
+
+    sha = hashlib.sha1()
+
+    with openMaybeGzip(infile) as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def openMaybeGzip(infile):
+    '''Open a file for binary reading, decompressing if gzipped'''
+
+    with open(infile, "rb") as f:
+        magic = f.read(2)
+
+    if magic == b"\x1f\x8b":
+        return gzip.open(infile, "rb")
+    else:
+        return open(infile, "rb")
+
+
+def blacklistDir(cache, genome):
+    '''Directory of a genomes blacklists in the cache'''
+
+    path = os.path.join(os.path.expanduser(cache), genome)
+    os.makedirs(path, exist_ok=True)
+
+    return path
+
+
+def blacklistSources(cache, genome):
+    '''source (URL or path) -> content hash of cached blacklists'''
+
+    sources = os.path.join(blacklistDir(cache, genome), "sources.tsv")
+
+    if not os.path.exists(sources):
+        return {}
+
+    # shared lock, so a line being appended by addBlacklist is never read
+    with open(sources) as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        return dict(line.rstrip("\n").split("\t") for line in f if len(line.strip()) > 0)
+
+
+def cacheIntervalIndex(infile, index_dir):
+    '''Build an interval index for infile at index_dir if missing. Built in a
+       tmp dir then moved, so concurrent pipelines never load a partial index'''
+
+    if os.path.exists(os.path.join(index_dir, "contigs.tsv")):
+        return
+
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(index_dir))
+    buildIntervalIndex(infile, tmp)
+
+    try:
+        os.rename(tmp, index_dir)
+    except OSError:
+        shutil.rmtree(tmp)
+
+
+def addBlacklist(source, cache, genome):
+    '''Copy (or download, if source is a URL) a blacklist into the cache as
+       <sha1>.bed.gz with its interval index, returns the hash'''
+
+    path = blacklistDir(cache, genome)
+    tmp = tempfile.NamedTemporaryFile(dir=path, delete=False).name
+
+    if re.match(r"^(https?|ftp)://", source):
+        urllib.request.urlretrieve(source, tmp)
+    else:
+        shutil.copyfile(os.path.expanduser(source), tmp)
+
+    sha = fileHash(tmp)
+    bed = os.path.join(path, sha + ".bed.gz")
+
+    if not os.path.exists(bed):
+        # compressed to a tmp file then renamed, so the bed is never seen partial
+        gz = tempfile.NamedTemporaryFile(dir=path, suffix=".bed.gz", delete=False).name
+        with openMaybeGzip(tmp) as f, gzip.open(gz, "wb") as o:
+            shutil.copyfileobj(f, o)
+        os.rename(gz, bed)
+
+    os.remove(tmp)
+
+    cacheIntervalIndex(bed, bed.replace(".bed.gz", ".index"))
+
+    # appended under an exclusive lock, so concurrent adds never interleave
+    line = "%s\t%s\n" % (source, sha)
+
+    with open(os.path.join(path, "sources.tsv"), "a+") as o:
+        fcntl.flock(o, fcntl.LOCK_EX)
+        o.seek(0)
+        if line not in o.readlines():
+            o.write(line)
+
+    return sha
+
+
+def cachedBlacklist(source, cache, genome):
+    '''Path of a blacklist in the cache, only fetched if not already cached'''
+
+    sha = blacklistSources(cache, genome).get(source)
+
+    if sha is None or not os.path.exists(os.path.join(blacklistDir(cache, genome), sha + ".bed.gz")):
+        sha = addBlacklist(source, cache, genome)
+
+    return os.path.join(blacklistDir(cache, genome), sha + ".bed.gz")
+
+
+def blacklistIndex(infile, cache, genome):
+    '''Interval index directory for a blacklist file, looked up by content
+       hash & built in the cache if missing'''
+
+    index_dir = os.path.join(blacklistDir(cache, genome), fileHash(infile) + ".index")
+    cacheIntervalIndex(infile, index_dir)
+
+    return index_dir
+
+
+def buildIntervalIndex(infile, index_dir):
+    '''Merge a BED files intervals per contig & save as sorted starts/ends
+       .npy (memory mappable), with contigs.tsv of row offsets'''
+
+    intervals = PS.mergeIntervals(infile)
+
+    rows = []
+    offset = 0
+
+    for contig, (s, e) in intervals.items():
+        rows.append((contig, offset, len(s)))
+        offset += len(s)
+
+    empty = [np.zeros(0, dtype=np.int64)]
+
+    os.makedirs(index_dir, exist_ok=True)
+
+    np.save(os.path.join(index_dir, "starts.npy"), np.concatenate([x[0] for x in intervals.values()] or empty))
+    np.save(os.path.join(index_dir, "ends.npy"), np.concatenate([x[1] for x in intervals.values()] or empty))
+
+    pd.DataFrame(rows, columns=["contig", "offset", "n"]).to_csv(
+        os.path.join(index_dir, "contigs.tsv"), sep="\t", index=False)
+
+
+def loadIntervalIndex(index_dir):
+    '''contig -> (starts, ends) memory mapped views of an interval index'''
+
+    starts = np.load(os.path.join(index_dir, "starts.npy"), mmap_mode="r")
+    ends = np.load(os.path.join(index_dir, "ends.npy"), mmap_mode="r")
+    contigs = pd.read_csv(os.path.join(index_dir, "contigs.tsv"), sep="\t", dtype={"contig": str})
+
+    return {c: (starts[o:o + n], ends[o:o + n]) for c, o, n in contigs.itertuples(index=False)}
+
+
+def filterPeakFiles(infiles, outfiles, index_dirs):
+    '''Remove peaks overlapping any blacklist interval index from a batch
+       of peak files in one process, as intersectBed -wa -v. Kept lines are
+       written unchanged'''
+
+    indexes = [loadIntervalIndex(x) for x in index_dirs]
+
+    for infile, outfile in zip(infiles, outfiles):
+        try:
+            peaks = pd.read_csv(infile, sep="\t", header=None, dtype=str)
+        except pd.errors.EmptyDataError:
+            open(outfile, "w").close()
+            writePeakStats(outfile, peakStats([], [], [], []))
+            continue
+
+        contigs = peaks[0].values.astype(str)
+        starts, ends = peaks[1].astype(np.int64).values, peaks[2].astype(np.int64).values
+
+        blacklisted = np.zeros(len(peaks), dtype=np.bool_)
+        for index in indexes:
+            blacklisted |= PS.overlapsIndex(index, contigs, starts, ends)
+
+        kept = ~blacklisted
+        peaks[kept].to_csv(outfile, sep="\t", header=False, index=False)
+
+        # narrowPeak score & summit offset
+        writePeakStats(outfile, peakStats(starts[kept], ends[kept],
+                                          peaks[4].values[kept].astype(float),
+                                          peaks[9].values[kept].astype(float)))
+
+
+#####################################################
+####           Peak set statistics               ####
+#####################################################
+
+# peak width histogram bins (b.p.), the last bin collects wider peaks
+PEAK_WIDTH_BINS = list(range(0, 5001, 50)) + [np.iinfo(np.int64).max]
+
+
+def histogram(values, bins):
+    '''{"bins": edges, "counts": counts} of values, JSON serialisable'''
+
+    counts, edges = np.histogram(values, bins=bins)
+
+    return {"bins": np.asarray(edges).tolist(), "counts": counts.tolist()}
+
+
+def summarise(values, bins):
+    '''Summary statistics & histogram of one peak column'''
+
+    values = np.asarray(values, dtype=float)
+
+    if len(values) == 0:
+        return {"min": None, "median": None, "mean": None, "max": None,
+                "hist": histogram(values, bins if not isinstance(bins, int) else [0, 1])}
+
+    return {"min": float(values.min()), "median": float(np.median(values)),
+            "mean": float(values.mean()), "max": float(values.max()),
+            "hist": histogram(values, bins)}
+
+
+def peakStats(starts, ends, scores, summits=None):
+    '''Peak count, covered b.p. & width, score and (relative) summit
+       position distributions of a peak set'''
+
+    widths = np.asarray(ends) - np.asarray(starts)
+
+    stats = {"no_peaks": int(len(widths)),
+             "bp": int(widths.sum()),
+             "width": summarise(widths, PEAK_WIDTH_BINS),
+             "score": summarise(scores, 50),
+             "summit": None}
+
+    if summits is not None:
+        # summit offset as a fraction of peak width
+        relative = np.asarray(summits, dtype=float) / np.where(widths > 0, widths, 1)
+        stats["summit"] = summarise(relative, np.linspace(0, 1, 21))
+
+    return stats
+
+
+def peakStatsFile(bedfile):
+    return bedfile + ".stats.json"
+
+
+def writePeakStats(bedfile, stats):
+    '''Write a peak sets statistics sidecar, <bedfile>.stats.json'''
+
+    with open(peakStatsFile(bedfile), "w") as o:
+        json.dump(stats, o)
+
+
+def readPeakStats(bedfile):
+    '''Read the statistics sidecar of a peak file'''
+
+    with open(peakStatsFile(bedfile)) as f:
+        return json.load(f)
+
+
+def writePeakFileStats(bedfile, score=4, summit=None):
+    '''Sidecar for a peak file written by an external tool, score & summit
+       are 0-based column numbers'''
+
+    try:
+        bed = pd.read_csv(bedfile, sep="\t", header=None)
+    except pd.errors.EmptyDataError:
+        bed = pd.DataFrame(columns=range(max(score, summit or 0) + 1))
+
+    summits = bed[summit].values if summit is not None else None
+
+    writePeakStats(bedfile, peakStats(bed[1].values, bed[2].values, bed[score].values, summits))
+
+
+#####################################################
+####                   FRIP                      ####
+#####################################################
+
+def fripCounts(index_dir, peaksets):
+    '''Reads in peaks & total reads for several peak sets of one sample
+       in a single sweep over its Tn5 insertion index (one insertion per
+       read). peaksets is a list of (peak file, max_frag), max_frag (or None)
+       restricts reads to fragments < max_frag b.p. as the size_filt BAMs.
+       Totals without a fragment filter come from the index contigs.tsv.
+       Returns a list of (in_peaks, total)'''
+
+    intervals = [PS.mergeIntervals(peaks) for peaks, max_frag in peaksets]
+    contigs = insertionContigs(index_dir)
+
+    in_peaks = [0] * len(peaksets)
+    totals = [int(contigs["insertions"].sum()) if max_frag is None else 0
+              for peaks, max_frag in peaksets]
+
+    for contig in contigs.index[contigs["insertions"] > 0]:
+        pos = loadInsertions(index_dir, contig)
+        frag = None
+
+        for n, (peaks, max_frag) in enumerate(peaksets):
+            sites = pos
+
+            if max_frag is not None:
+                if frag is None:
+                    frag = np.load(insertionFile(index_dir, contig, "frag"), mmap_mode="r")
+                sites = pos[frag < max_frag]
+                totals[n] += len(sites)
+
+            if contig in intervals[n]:
+                starts, ends = intervals[n][contig]
+                in_peaks[n] += int(np.sum(np.searchsorted(sites, ends, side="left") -
+                                          np.searchsorted(sites, starts, side="left")))
+
+    return list(zip(in_peaks, totals))
+
+
+def writeFrip(index_dir, peaksets, sample, outfile):
+    '''Write FRIP rows (FRIP, sample_id, size_filt) of frip_table.txt for
+       a list of (peak file, max_frag, size_filt label)'''
+
+    counts = fripCounts(index_dir, [(peaks, max_frag) for peaks, max_frag, label in peaksets])
+
+    with open(outfile, "w") as o:
+        for (in_peaks, total), (peaks, max_frag, label) in zip(counts, peaksets):
+            frip = in_peaks / total if total > 0 else 0
+            o.write("%s\t%s\t%s\n" % ("%g" % frip, sample, label))
+
+
+#####################################################
+####           Coverage tracks                   ####
+#####################################################
+
+# track -> bigwig suffix, nfr & nucleosome tracks need PE fragment lengths
+TRACK_SUFFIX = {"coverage": ".coverage.bw",
+                "nfr": ".nfr.bw",
+                "nucleosome": ".nucleosome.coverage.bw",
+                "insertions": ".insertions.bw"}
+
+
+def indexFragments(index_dir, contig, extend=200):
+    '''Fragment (starts, lengths) on contig from a Tn5 insertion index. PE
+       fragments are rebuilt from their + strand read (start is the
+       insertion - 4), SE reads are extended to extend b.p.'''
+
+    pos = np.asarray(loadInsertions(index_dir, contig), dtype=np.int64)
+
+    if len(pos) == 0:
+        return pos, pos
+
+    frag = np.load(insertionFile(index_dir, contig, "frag")).astype(np.int64)
+    rev = np.load(insertionFile(index_dir, contig, "rev"))
+
+    paired = (frag > 0) & ~rev
+    single = frag == 0
+
+    # SE - strand insertions are the read end - 5
+    se_starts = np.where(rev[single], pos[single] - TN5_SHIFT[True] - extend,
+                         pos[single] - TN5_SHIFT[False])
+
+    starts = np.concatenate([pos[paired] - TN5_SHIFT[False], se_starts])
+    lengths = np.concatenate([frag[paired], np.full(len(se_starts), extend)])
+
+    return starts, lengths
+
+
+def trackFragments(track, lengths, fragments):
+    '''Mask of fragments in a tracks (min, max) length range'''
+
+    min_frag, max_frag = fragments.get(track, (0, None))
+
+    keep = lengths >= min_frag
+    if max_frag is not None:
+        keep &= lengths < max_frag
+
+    return keep
+
+
+def contigTotals(job):
+    '''coverageTracks worker, fragments per fragment track on one contig.
+       Only fragment lengths & strands are read (memory mapped), insertion
+       totals come from contigs.tsv'''
+
+    index_dir, contig, tracks, fragments, extend = job
+
+    frag = np.load(insertionFile(index_dir, contig, "frag"), mmap_mode="r")
+    rev = np.load(insertionFile(index_dir, contig, "rev"), mmap_mode="r")
+
+    # PE fragments are counted from their + strand read, SE reads are extended
+    paired = frag[(frag > 0) & ~rev]
+    single = int(np.count_nonzero(frag == 0))
+
+    return {track: int(trackFragments(track, paired, fragments).sum()) +
+            single * int(trackFragments(track, np.array([extend]), fragments)[0])
+            for track in tracks}
+
+
+def fragmentBins(starts, ends, nbins, binsize):
+    '''Number of fragments overlapping each bin'''
+
+    depth = np.zeros(nbins + 1, dtype=np.int32)
+    np.add.at(depth, np.clip(starts // binsize, 0, nbins), 1)
+    np.add.at(depth, np.clip((ends - 1) // binsize + 1, 0, nbins), -1)
+
+    return np.cumsum(depth[:-1], dtype=np.int32)
+
+
+def smoothBins(values, window):
+    '''Moving average over window bins'''
+
+    if window <= 1:
+        return values
+
+    return np.convolve(values, np.ones(window, dtype=values.dtype) / window, mode="same")
+
+
+def binRuns(values, binsize, length):
+    '''Run length encode bins as (starts, ends, values), omitting zero runs'''
+
+    change = np.ones(len(values), dtype=np.bool_)
+    change[1:] = values[1:] != values[:-1]
+    first = np.flatnonzero(change)
+
+    starts = first * binsize
+    ends = np.append(first[1:] * binsize, length)
+    runs = values[first]
+
+    keep = runs != 0
+
+    return starts[keep], ends[keep], runs[keep]
+
+
+def contigTracks(job):
+    '''coverageTracks worker, each track on one contig binned, smoothed over
+       window bins, scaled by scales[track] & run length encoded, so only
+       float32 (starts, ends, values) runs are returned'''
+
+    index_dir, contig, length, tracks, binsize, fragments, extend, scales, window = job
+
+    nbins = -(-length // binsize)
+    runs = {}
+
+    if any(track != "insertions" for track in tracks):
+        starts, lengths = indexFragments(index_dir, contig, extend)
+
+    for track in tracks:
+        if track == "insertions":
+            pos = loadInsertions(index_dir, contig)
+            bins = np.bincount(np.clip(pos // binsize, 0, nbins - 1), minlength=nbins)
+        else:
+            keep = trackFragments(track, lengths, fragments)
+            bins = fragmentBins(starts[keep], starts[keep] + lengths[keep], nbins, binsize)
+
+        values = smoothBins(bins.astype(np.float32), window) * np.float32(scales[track])
+        del bins
+
+        runs[track] = binRuns(values, binsize, length)
+
+    return runs
+
+
+def coverageTracks(index_dir, outprefix, tracks, binsize=5, smooth=20, fragments={},
+                   extend=200, processes=4):
+    '''Write RPKM normalised bigwig tracks (outprefix + TRACK_SUFFIX) from a
+       Tn5 insertion index, so the BAM is not read again per track. Contigs
+       are binned in parallel processes & written in order. tracks are any
+       of coverage (all fragments), nfr & nucleosome (fragments with
+       fragments[track] = (min, max) b.p.) & insertions (insertion sites),
+       each normalised to the fragments (or insertions) it contains.
+       smooth is a moving average window (b.p.) as deeptools --smoothLength'''
+
+    # only needed here, not by the BAM processing scripts importing this module
+    import pyBigWig
+
+    contigs = insertionContigs(index_dir)
+    contigs = contigs[contigs["length"] > 0]
+
+    # contigs without insertions have no entries, but are in the header
+    covered = contigs[contigs["insertions"] > 0]
+    fragment_tracks = [track for track in tracks if track != "insertions"]
+
+    window = max(1, smooth // binsize)
+    bigwigs = {}
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        # totals first (fragment lengths only), workers then write-ready runs per contig
+        totals = dict.fromkeys(tracks, 0)
+        totals["insertions"] = int(covered["insertions"].sum())
+
+        if fragment_tracks:
+            jobs = [(index_dir, contig, fragment_tracks, fragments, extend) for contig in covered.index]
+            for counts in pool.imap_unordered(contigTotals, jobs):
+                for track, n in counts.items():
+                    totals[track] += n
+
+        scales = {track: 1e9 / (totals[track] * binsize) if totals[track] > 0 else 0
+                  for track in tracks}
+
+        for track in tracks:
+            bigwigs[track] = pyBigWig.open(outprefix + TRACK_SUFFIX[track], "w")
+            bigwigs[track].addHeader([(contig, int(length)) for contig, length in contigs["length"].items()])
+
+        jobs = [(index_dir, contig, int(length), tracks, binsize, fragments, extend, scales, window)
+                for contig, length in covered["length"].items()]
+
+        for job, runs in zip(jobs, pool.imap(contigTracks, jobs)):
+            contig = job[1]
+
+            for track, (starts, ends, values) in runs.items():
+                if len(starts) > 0:
+                    bigwigs[track].addEntries([contig] * len(starts), starts.tolist(),
+                                              ends=ends.tolist(), values=values.tolist())
+    finally:
+        pool.close()
+        pool.join()
+
+        for bigwig in bigwigs.values():
+            bigwig.close()
+
+
+#####################################################
+####           TSS enrichment                    ####
+#####################################################
+
+def tssInsertions(index_dir, contig, tss, minus, flank):
+    '''(TSS, offset) of every insertion within flank b.p. of each TSS on
+       contig, offsets are oriented by strand (-ve upstream)'''
+
+    pos = loadInsertions(index_dir, contig)
+
+    lo = np.searchsorted(pos, tss - flank, side="left")
+    hi = np.searchsorted(pos, tss + flank, side="right")
+
+    row, position = PS.expandRanges(lo, hi)
+    offset = pos[position].astype(np.int64) - tss[row]
+    offset[minus[row]] *= -1
+
+    return row, offset
+
+
+def tssEnrichment(index_dir, gene_index_dir, flank=2000, end_flank=100, smooth=50,
+                  heatmap_bin=50, heatmap_rows=500):
+    '''ENCODE style TSS enrichment from a Tn5 insertion index: insertions at
+       each b.p. +/- flank around all unique TSSs (gene index), normalised
+       to the mean of the end_flank b.p. at both ends & smoothed (moving
+       average of smooth b.p.), the score is the profile maximum.
+       The heatmap is insertions per heatmap_bin b.p. per TSS, ordered by
+       total signal & averaged down to heatmap_rows rows.
+       Returns a dict of score, profile (raw), norm (normalised) & heatmap'''
+
+    genes, index = PS.loadGeneIndex(gene_index_dir)
+    tsss = genes[["contig", "tss", "strand"]].drop_duplicates()
+
+    width = 2 * flank + 1
+    ncols = -(-width // heatmap_bin)
+
+    profile = np.zeros(width, dtype=np.int64)
+    heatmap = np.zeros((len(tsss), ncols), dtype=np.float64)
+
+    contigs = insertionContigs(index_dir)
+    offset = 0
+
+    for contig, df in tsss.groupby("contig", sort=False):
+        n = len(df)
+
+        if contig in contigs.index:
+            row, site = tssInsertions(index_dir, contig, df["tss"].values.astype(np.int64),
+                                      df["strand"].isin(["-", -1]).values, flank)
+
+            profile += np.bincount(site + flank, minlength=width)
+            np.add.at(heatmap, (row + offset, (site + flank) // heatmap_bin), 1)
+
+        offset += n
+
+    background = np.concatenate([profile[:end_flank], profile[-end_flank:]]).mean()
+    norm = profile / background if background > 0 else np.zeros(width)
+
+    window = max(1, smooth)
+    norm = np.convolve(norm, np.ones(window) / window, mode="same")
+
+    # strongest TSSs first, averaged into heatmap_rows groups
+    order = np.argsort(-heatmap.sum(axis=1), kind="stable")
+    groups = np.arange(len(order)) * min(heatmap_rows, len(order)) // max(len(order), 1)
+    rows = np.zeros((min(heatmap_rows, len(order)), ncols))
+    np.add.at(rows, groups, heatmap[order])
+    rows /= np.maximum(np.bincount(groups, minlength=len(rows)), 1)[:, None]
+
+    return {"score": float(norm.max()), "profile": profile, "norm": norm, "heatmap": rows}
+
+
+def writeTSSEnrichment(index_dir, gene_index_dir, outfile, **kwargs):
+    '''Save tssEnrichment arrays as .npz'''
+
+    np.savez(outfile, **tssEnrichment(index_dir, gene_index_dir, **kwargs))
+
+
+def readTSSEnrichment(infile):
+    '''dict of score, profile, norm & heatmap from writeTSSEnrichment'''
+
+    tss = dict(np.load(infile))
+    tss["score"] = float(tss["score"])
+
+    return tss
+
+
+#####################################################
+####           Report data bundle                ####
+#####################################################
+
+# report data bundle version, bumped when tables or columns change so the
+# notebooks can refuse a bundle written by another pipeline version
+REPORT_BUNDLE_VERSION = 1
+
+# report tables queried from csvdb as is
+REPORT_QUERIES = {
+    "sample_info": """select * from sample_info""",
+    "alignment_summary": """select READS_ALIGNED_IN_PAIRS/2 as MAPPED_PAIRS, PCT_READS_ALIGNED_IN_PAIRS,
+                            TOTAL_READS, PCT_ADAPTER, sample_id from picardAlignmentSummary
+                            where CATEGORY = "PAIR" """,
+    "insert_size_histogram": """select * from picardInsertSizeHistogram where sample_id like "%prep" """,
+    "insert_size_metrics": """select * from picardInsertSizeMetrics where sample_id like "%prep" """,
+    "tss_enrichment": """select * from TSS_enrichment""",
+    "peak_stats": """select a.no_peaks, a.size_filt, b.FRIP, b.sample_id from no_peaks a,
+                     frip_table b where a.sample_id=b.sample_id and a.size_filt=b.size_filt""",
+    "merged_peaks": """select * from no_peaks where merged like "%merged" """,
+    "peak_genes": """select distinct a.gene_name, a.gene_id, b.peak_id from
+                     ensemblGeneset a, merged_peaks_GREAT_closestGene b
+                     where a.gene_id = b.gene_id"""}
+
+# norm_counts measures written as peaks x samples matrices, per size_filt
+REPORT_MEASURES = ["total", "RPM_width_norm"]
+REPORT_SIZE_FILT = {"all": "all_fragments", "size_filt": "<150bp"}
+
+
+def writeFrame(outfile, df):
+    '''Save a DataFrame column-wise as an uncompressed .npz, one array per
+       column with strings as fixed width unicode, so it loads without
+       pickle: pd.DataFrame(dict(np.load(outfile)))'''
+
+    arrays = {}
+    for c in df.columns:
+        if pd.api.types.is_numeric_dtype(df[c]):
+            arrays[str(c)] = df[c].values
+        else:
+            arrays[str(c)] = np.array(df[c].fillna("").astype(str).tolist(), dtype=str)
+
+    np.savez(outfile, **arrays)
+
+
+def readFrame(infile):
+    '''Read a writeFrame .npz as a DataFrame'''
+
+    return pd.DataFrame(dict(np.load(infile)))
+
+
+def chrMContamination(dbfile=db):
+    '''Reads mapped to chrM per sample from allContig, pivoted to
+       chrM, total_mapped_reads, sample_id & pct_chrM'''
+
+    contigs = fetch_DataFrame("""select * from allContig""", dbfile)
+    contigs = contigs.pivot(index="sample_id", columns="contig", values="mapped_reads")
+
+    chrm = pd.DataFrame({"chrM": contigs["chrM"] if "chrM" in contigs else 0,
+                         "total_mapped_reads": contigs.sum(axis=1)})
+    chrm["sample_id"] = chrm.index.values
+    chrm["pct_chrM"] = chrm["chrM"] / chrm["total_mapped_reads"] * 100
+    chrm.reset_index(drop=True, inplace=True)
+
+    return chrm
+
+
+def tssDistances(samples, dbfile=db):
+    '''Signed peak distance to the closest gene TSS, one row per merged peak
+       per size_filt counted (rather than per sample, which repeats each peak)'''
+
+    dist = fetch_DataFrame("""select distinct peak_id, TSSdist from merged_peaks_GREAT_closestGene""", dbfile)
+
+    size_filts = sorted(set(countsSampleId(x.replace(".", "_"))[1] for x in samples))
+
+    return pd.concat([dist.assign(size_filt=x) for x in size_filts], ignore_index=True)
+
+
+def reportMatrices(infiles):
+    '''Wide peaks x samples DataFrames (peak_id & sample_id columns) of the
+       REPORT_MEASURES per REPORT_SIZE_FILT, from readNormMatrix .npz files
+       with rows appended in file order, as written by writeNormCountsDb'''
+
+    parts = [readNormMatrix(x) for x in infiles]
+    samples = parts[0][1]
+
+    peak_ids = np.concatenate([peaks["peak_id"].values for peaks, _, _, _ in parts])
+    ids = [countsSampleId(x.replace(".", "_")) for x in samples]
+
+    matrices = {}
+    for measure in REPORT_MEASURES:
+        values = np.concatenate([counts if measure == "total" else norm[measure]
+                                 for _, _, counts, norm in parts])
+
+        for filt, size_filt in REPORT_SIZE_FILT.items():
+            columns = [i for i, x in enumerate(ids) if x[1] == size_filt]
+
+            df = pd.DataFrame(values[:, columns], columns=[ids[i][0] for i in columns])
+            df.insert(0, "peak_id", peak_ids)
+
+            matrices["counts_%s_%s" % (measure, filt)] = df
+
+    return matrices
+
+
+def writeReportBundle(dbfile, infiles, outdir):
+    '''Write the tables read by the report notebooks to outdir, queried,
+       joined & pivoted once, as writeFrame .npz files. The manifest
+       (bundle.tsv: version, table, rows) is written last'''
+
+    tables = {name: fetch_DataFrame(query, dbfile) for name, query in REPORT_QUERIES.items()}
+    tables["chrM"] = chrMContamination(dbfile)
+    tables["tss_distance"] = tssDistances(readCountMatrix(infiles[0])[1], dbfile)
+    tables.update(reportMatrices(infiles))
+
+    for name, df in tables.items():
+        writeFrame(os.path.join(outdir, name + ".npz"), df)
+
+    manifest = pd.DataFrame({"version": REPORT_BUNDLE_VERSION,
+                             "table": list(tables.keys()),
+                             "rows": [len(x) for x in tables.values()]})
 
-    field_names = [d[0] for d in cc.description]
-    pandas_DataFrame = pd.DataFrame.from_records(
-        sqlresult,
-        columns=field_names)
-    return pandas_DataFrame
+    manifest.to_csv(os.path.join(outdir, "bundle.tsv"), sep="\t", index=False)
 
 
 # ---------------------------------------------------
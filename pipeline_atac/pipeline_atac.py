@@ -67,17 +67,18 @@ from cgat.BamTools import bamtools
 
 import sys
 import os
+import shutil
 import sqlite3
 import re
 import glob
 import gzip
 import pandas as pd
 import numpy as np
-from pybedtools import BedTool
 import seaborn as sns
 from matplotlib import pyplot as plt
 
 import PipelineAtac as A
+import PipelineShared as PS
 
 # Pipeline configuration
 P.get_parameters(
@@ -115,6 +116,12 @@ def connect():
 # Configure pipeline global variables
 Unpaired = A.isPaired(glob.glob("data.dir/*fastq*gz"))
 
+# pipe bowtie2 output straight through filtering & sorting
+Stream = PARAMS["bowtie2_stream"]
+
+# all_norm_counts storage, wide typed tables or a long text table
+Storage = PARAMS["read_counts_storage"]
+
 #####################################################
 ####            Sample Info Table                ####
 #####################################################
@@ -168,6 +175,7 @@ def makeSampleInfoTable(infile, outfile):
 #####################################################
 ####                Mapping                      ####
 #####################################################
+@active_if(Stream == False)
 @follows(makeSampleInfoTable, mkdir("bowtie2.dir"))
 @transform("data.dir/*.fastq.1.gz",
            regex(r"data.dir/(.*).fastq.1.gz"),
@@ -204,7 +212,7 @@ def mapBowtie2_PE(infile, outfile):
     P.run(statement,job_memory="2G",job_threads=12)
 
 
-@active_if(Unpaired)
+@active_if(Unpaired and Stream == False)
 @transform("data.dir/*.fastq.gz",
            regex(r"data.dir/(.*).fastq.gz"),
            r"bowtie2.dir/\1.genome.bam")
@@ -235,83 +243,184 @@ def mapBowtie2_SE(infile, outfile):
 
     P.run(statement,job_memory="2G",job_threads=12)
 
+
+def streamStatement(outfile):
+    '''Statement to pipe bowtie2 SAM output through MAPQ/contig filtering
+       into a multithreaded samtools sort, writing .filt.bam directly.
+       If keep_genome_bam is set unfiltered reads are sorted to .genome.bam
+       in parallel, read from a fifo so nothing uncompressed hits scratch'''
+
+    script = PARAMS["pipeline_dir"] + "python/filterBam.py"
+    mapq = PARAMS["filter_mapq"]
+    exclude = PARAMS["filter_exclude_contigs"]
+    threads = PARAMS["bowtie2_sort_threads"]
+    genome = outfile.replace(".filt.bam", ".genome.bam")
+
+    if PARAMS["bowtie2_keep_genome_bam"]:
+        genome_sort = f'''mkfifo $tmp/genome.fifo &&
+                         {{ samtools sort -@ {threads} -T $tmp/genome -O BAM -o {genome} $tmp/genome.fifo & }} &&
+                         sort_pid=$! &&
+                         sleep 1 && kill -0 $sort_pid &&'''
+        genome_opt = "--genome $tmp/genome.fifo"
+        genome_index = f"wait $sort_pid && samtools index {genome} &&"
+        # a failed stream must not leave the background sort waiting on the fifo
+        genome_kill = "|| { kill $sort_pid 2> /dev/null; false; }"
+    else:
+        genome_sort, genome_opt, genome_index, genome_kill = "", "", "", ""
+
+    filter_sort = f'''python {script}
+                       --infile -
+                       --outfile -
+                       --mapq {mapq}
+                       --exclude {exclude}
+                       {genome_opt} |
+                     samtools sort -@ {threads} -T $tmp/filt -O BAM -o {outfile} - &&
+                     {genome_index}
+                     samtools index {outfile} &&
+                     rm -r $tmp
+                     {genome_kill}'''
+
+    return genome_sort, filter_sort
+
+
+@active_if(Stream)
+@follows(makeSampleInfoTable, mkdir("bowtie2.dir"))
+@transform("data.dir/*.fastq.1.gz",
+           regex(r"data.dir/(.*).fastq.1.gz"),
+           r"bowtie2.dir/\1.filt.bam")
+def mapFilterBowtie2_PE(infile, outfile):
+    '''Map reads with Bowtie2, filter & sort in a single stream'''
+
+    read1 = infile
+    read2 = infile.replace(".1.gz", ".2.gz")
+
+    log = outfile.replace(".filt.bam", ".genome.bam") + "_bowtie2.log"
+    tmp_dir = "$SCRATCH_DIR"
+
+    options = PARAMS["bowtie2_options"]
+    genome = os.path.join(PARAMS["bowtie2_genomedir"], PARAMS["bowtie2_genome"])
+
+    genome_sort, filter_sort = streamStatement(outfile)
+
+    statement = f'''tmp=`mktemp -d -p {tmp_dir}` &&
+                   {genome_sort}
+                   bowtie2
+                     --quiet
+                     --threads 12
+                     -x {genome}
+                     -1 {read1}
+                     -2 {read2}
+                     {options}
+                     2> {log} |
+                   {filter_sort}'''
+
+    P.run(statement, job_memory="2G", job_threads=12)
+
+
+@active_if(Unpaired and Stream)
+@follows(makeSampleInfoTable, mkdir("bowtie2.dir"))
+@transform("data.dir/*.fastq.gz",
+           regex(r"data.dir/(.*).fastq.gz"),
+           r"bowtie2.dir/\1.filt.bam")
+def mapFilterBowtie2_SE(infile, outfile):
+    '''Map reads with Bowtie2, filter & sort in a single stream'''
+
+    log = outfile.replace(".filt.bam", ".genome.bam") + "_bowtie2.log"
+    tmp_dir = "$SCRATCH_DIR"
+
+    options = PARAMS["bowtie2_options"]
+    genome = os.path.join(PARAMS["bowtie2_genomedir"], PARAMS["bowtie2_genome"])
+
+    genome_sort, filter_sort = streamStatement(outfile)
+
+    statement = f'''tmp=`mktemp -d -p {tmp_dir}` &&
+                   {genome_sort}
+                   bowtie2
+                     --quiet
+                     --threads 12
+                     -x {genome}
+                     -U {infile}
+                     {options}
+                     2> {log} |
+                   {filter_sort}'''
+
+    P.run(statement, job_memory="2G", job_threads=12)
+
     
+@active_if(Stream == False)
 @follows(mapBowtie2_PE, mapBowtie2_SE)
 @transform("bowtie2.dir/*.genome.bam", suffix(r".genome.bam"), r".filt.bam")
 def filterBam(infile, outfile):
-    '''filter bams on MAPQ >10, & remove reads mapping to chrM before peakcalling'''
+    '''filter bams on MAPQ (default >=10), & remove reads mapping to chrM before peakcalling'''
 
-    local_tmpdir = "/gfs/scratch/"
-        
-    statement = f'''tmp=`mktemp -p {local_tmpdir}` && 
-                   head=`mktemp -p {local_tmpdir}` &&
-                   samtools view -h {infile} | grep "^@" - > $head  && 
-                   samtools view -q10 {infile} | 
-                     grep -v "chrM" - | 
-                     cat $head - |
-                     samtools view -h -o $tmp -  && 
-                   samtools sort -O BAM -o {outfile} $tmp  &&
-                   samtools index {outfile} &&
-                   rm $tmp $head'''  
+    script = PARAMS["pipeline_dir"] + "python/filterBam.py"
 
-    P.run(statement, job_memory="10G", job_threads=2)
+    mapq = PARAMS["filter_mapq"]
+    exclude = PARAMS["filter_exclude_contigs"]
+
+    processes = PARAMS["filter_processes"]
+
+    # reads are streamed through pysam in coordinate order, one process per
+    # contig shard, shards are concatenated in order so are not re-sorted
+    statement = f'''python {script}
+                     --infile {infile}
+                     --outfile {outfile}
+                     --mapq {mapq}
+                     --exclude {exclude}
+                     --processes {processes}
+                     --tmpdir bowtie2.dir
+                     --threads 2'''
+
+    P.run(statement, job_memory="2G", job_threads=max(2, processes))
     
 
-@transform(filterBam,
+# PE data is split by fragment size in the same pass as duplicate removal
+if Unpaired:
+    PrepBams = [r"\1.all.prep.bam"]
+else:
+    PrepBams = [r"\1.all.prep.bam", r"\1.size_filt.prep.bam"]
+
+
+@follows(filterBam, mapFilterBowtie2_PE, mapFilterBowtie2_SE)
+@transform("bowtie2.dir/*.filt.bam",
            regex(r"(.*).filt.bam"),
-           r"\1.all.prep.bam")
-def removeDuplicates(infile, outfile):
-    '''PicardTools remove duplicates'''
+           PrepBams)
+def removeDuplicates(infile, outfiles):
+    '''Remove duplicate fragments, writing Picard style metrics, then in
+       the same job write all fragments & fragments < insert_size (PE only),
+       sorted & indexed'''
 
+    outfile = outfiles[0]
+    
     metrics_file = outfile + ".picardmetrics"
-    log = outfile + ".picardlog"
-    tmp_dir = "$SCRATCH_DIR"
+    script = PARAMS["pipeline_dir"] + "python/prepBam.py"
 
-    statement = f'''tmp=`mktemp -p {tmp_dir}` && 
-                   MarkDuplicates 
-                     INPUT={infile} 
-                     ASSUME_SORTED=true 
-                     REMOVE_DUPLICATES=true 
-                     QUIET=true 
-                     OUTPUT=$tmp 
-                     METRICS_FILE={metrics_file} 
-                     VALIDATION_STRINGENCY=SILENT
-                     TMP_DIR=/gfs/scratch/
-                     2> {log}  && 
-                   mv $tmp {outfile} && 
-                   samtools index {outfile}'''
-
-    P.run(statement, job_memory="12G", job_threads=2)
+    insert_size = PARAMS["bowtie2_insert_size"]
 
-    
-@active_if(Unpaired == False)
-@transform(removeDuplicates,
-           suffix(r".all.prep.bam"),
-           r".size_filt.prep.bam")
-def size_filterBam(infile, outfile):
-    '''filter bams on insert size (max size specified in ini)'''
-
-    local_tmpdir = "$SCRATCH_DIR"
-
-    insert_size_filter_F = PARAMS["bowtie2_insert_size"]
-    insert_size_filter_R = "-" + str(insert_size_filter_F) # reverse reads have "-" prefix for TLEN
-
-    statement = f'''tmp=`mktemp -p {local_tmpdir}` && 
-                   head=`mktemp -p {local_tmpdir}` && 
-                   samtools view -h {infile} | grep "^@" - > $head  && 
-                   samtools view {infile} | 
-                     awk 'BEGIN {{OFS="\\t"}} {{if ($9 ~ /^-/ && $9 > {insert_size_filter_R}) print $0 ;
-                       else if ($9 ~ /^[0-9]/ && $9 < {insert_size_filter_F}) print $0}}' - |     
-                     cat $head - |
-                     samtools view -h -o $tmp -  && 
-                   samtools sort -O BAM -o {outfile} $tmp  && 
-                   samtools index {outfile} &&
-                   rm $tmp $head'''  
+    if len(outfiles) > 1:
+        size_opt = f"--size_outfile {outfiles[1]} --insert_size {insert_size}"
+    else:
+        size_opt = ""
+
+    # fragments are keyed on both 5' ends & orientation in a sliding window
+    # over the sorted BAM, read once to remove duplicates & write both prep
+    # BAMs (see PipelineAtac.removeDuplicates), no JVM required.
+    # Windows never span contigs so each contig can be a separate process
+    processes = PARAMS["filter_processes"]
+
+    statement = f'''python {script}
+                     --infile {infile}
+                     --outfile {outfile}
+                     --metrics {metrics_file}
+                     {size_opt}
+                     --processes {processes}
+                     --tmpdir bowtie2.dir
+                     --threads 2'''
 
-    P.run(statement, job_memory="10G", job_threads=2)
+    P.run(statement, job_memory="3G", job_threads=max(2, processes))
 
     
-@follows(size_filterBam)
+@follows(removeDuplicates)
 @transform("bowtie2.dir/*.bam", suffix(r".bam"), r".bam.bai")
 def indexBam(infile, outfile):
     '''index bams, if index failed to be generated'''
@@ -320,29 +429,77 @@ def indexBam(infile, outfile):
 
     P.run(statement)
 
+
+@follows(indexBam)
+@transform("bowtie2.dir/*.prep.bam",
+           regex(r"(.*).prep.bam"),
+           r"\1.prep.tn5/contigs.tsv")
+def insertionIndex(infile, outfile):
+    '''Build a memory mappable index of Tn5 insertion sites (+4/-5 shifted),
+       fragment lengths & strands for each prep BAM, so downstream counting
+       is a searchsorted over arrays rather than another BAM decode'''
+
+    script = PARAMS["pipeline_dir"] + "python/insertionIndex.py"
+    outdir = os.path.dirname(outfile)
+
+    statement = f'''python {script}
+                     --infile {infile}
+                     --outdir {outdir}
+                     --threads 2'''
+
+    P.run(statement, job_memory="4G", job_threads=2)
+
     
 ####################################################
 #####               Mapping QC                 #####
 ####################################################
+# insert size metrics only for PE data
+if Unpaired:
+    QCFiles = [r"\1.flagstats.txt", r"\1.picardAlignmentStats.txt"]
+else:
+    QCFiles = [r"\1.flagstats.txt", r"\1.picardAlignmentStats.txt",
+               r"\1.picardInsertSizeMetrics.txt", r"\1.picardInsertSizeHistogram.txt"]
+
+
 @follows(indexBam)
-@transform("bowtie2.dir/*.genome.bam",
-           regex(r"(.*).genome.bam"),
-           r"\1.contigs.counts")
-def contigReadCounts(infile, outfile):
-    '''count reads mapped to each contig'''
+@transform("bowtie2.dir/*.bam",
+           regex(r"(.*).bam"),
+           QCFiles)
+def bamQC(infile, outfiles):
+    '''Collect samtools flagstat, contig read counts (genome bams only),
+       Picard style alignment summary & insert size metrics in a single
+       pass over each bam'''
 
-    tmp_dir = "$SCRATCH_DIR"
-    name = os.path.basename(infile).rstrip(".bam")
-    
-    statement =  f'''tmp=`mktemp -p {tmp_dir}` && 
-                    samtools idxstats {infile} > $tmp &&
-                    awk 'BEGIN {{OFS="\\t"}} {{print $0,"{name}"}}' $tmp > {outfile} &&
-                    rm $tmp'''
+    script = PARAMS["pipeline_dir"] + "python/bamQC.py"
 
-    P.run(statement)
+    flagstats, alignment = outfiles[0:2]
+
+    if len(outfiles) > 2:
+        insert_metrics, insert_histogram = outfiles[2:4]
+        insert_opt = f"--insert_metrics {insert_metrics} --insert_histogram {insert_histogram}"
+    else:
+        insert_opt = ""
+
+    # contig counts are used to report reads mapping to chrM before filtering
+    if infile.endswith(".genome.bam"):
+        contigs = infile.replace(".genome.bam", ".contigs.counts")
+        name = os.path.basename(infile).replace(".bam", "")
+        contig_opt = f"--contigs {contigs} --name {name}"
+    else:
+        contig_opt = ""
 
+    statement = f'''python {script}
+                     --infile {infile}
+                     --flagstats {flagstats}
+                     --alignment_summary {alignment}
+                     {insert_opt}
+                     {contig_opt}
+                     --threads 2'''
 
-@follows(contigReadCounts)
+    P.run(statement, job_memory="2G", job_threads=2)
+
+
+@follows(bamQC)
 @merge("bowtie2.dir/*.contigs.counts", "allContig.counts")
 def mergeContigCounts(infiles, outfile):
 
@@ -356,20 +513,11 @@ def mergeContigCounts(infiles, outfile):
 @transform(mergeContigCounts, suffix(r".counts"), r".load")
 def loadmergeContigCounts(infile, outfile):
 
-    P.load(infile, outfile, options='-H "contig,length,mapped_reads,unmapped_reads,sample_id" ')
+    A.load(infile, outfile, header=["contig", "length", "mapped_reads", "unmapped_reads", "sample_id"])
 
     
 @follows(loadmergeContigCounts)
-@transform("bowtie2.dir/*.bam", suffix(r".bam"), r".flagstats.txt")
-def flagstatBam(infile, outfile):
-    '''get samtools flagstats for bams'''
-
-    statement = f'''samtools flagstat {infile} > {outfile}'''
-    
-    P.run(statement)
-
-
-@merge(flagstatBam, "bowtie2.dir/flagstats.load")
+@merge("bowtie2.dir/*.flagstats.txt", "bowtie2.dir/flagstats.load")
 def loadflagstatBam(infiles, outfile):
     '''Summarize & load samtools flagstats'''
     
@@ -412,98 +560,49 @@ def loadflagstatBam(infiles, outfile):
     table_txt = outfile.replace(".load", ".txt")
     table.to_csv(table_txt, sep="\t", header=True, index=False)
 
-    P.load(table_txt, outfile)
+    A.load(table_txt, outfile)
             
 
 @follows(loadflagstatBam)
-@transform("bowtie2.dir/*.bam",
-           regex(r"(.*).bam"),
-           r"\1.picardAlignmentStats.txt")
-def picardAlignmentSummary(infile, outfile):
-    '''get aligntment summary stats with picard'''
-
-    tmp_dir = "$SCRATCH_DIR"
-    refSeq = os.path.join(PARAMS["genome_dir"], PARAMS["genome"] + ".fa")
-    
-    statement = f'''tmp=`mktemp -p {tmp_dir}` && 
-                   java -Xms12G -Xmx14G -jar /gfs/apps/bio/picard-tools-2.15.0/picard.jar CollectAlignmentSummaryMetrics
-                     R={refSeq}
-                     I={infile}
-                     O=$tmp && 
-                   cat $tmp | grep -v "#" > {outfile}'''
-
-    P.run(statement, job_memory="5G", job_threads=3)
-
-    
-@merge(picardAlignmentSummary,
+@merge("bowtie2.dir/*.picardAlignmentStats.txt",
        "picardAlignmentSummary.load")
 def loadpicardAlignmentSummary(infiles, outfile):
     '''load the complexity metrics to a single table in the db'''
 
-    P.concatenate_and_load(infiles, outfile,
-                         regex_filename=".*/(.*).picardAlignmentStats",
-                         cat="sample_id",
-                         options='-i "sample_id"')
+    A.load(infiles, outfile,
+           regex_filename=".*/(.*).picardAlignmentStats",
+           cat="sample_id",
+           indexes=["sample_id"])
 
 
 @active_if(Unpaired == False)
-@follows(flagstatBam)
-@transform("bowtie2.dir/*.bam",
-           regex(r"(.*).bam"),
-           r"\1.picardInsertSizeMetrics.txt")
-def picardInsertSizes(infile, outfile):
-    '''get aligntment summary stats with picard'''
-
-    tmp_dir = "$SCRATCH_DIR"
-
-    pdf = outfile.replace("Metrics.txt", "Histogram.pdf")
-    histogram = outfile.replace("Metrics.txt", "Histogram.txt")
-    
-    statement = f'''tmp=`mktemp -p {tmp_dir}` && 
-                   java -Xms12G -Xmx45G -jar /gfs/apps/bio/picard-tools-2.15.0/picard.jar CollectInsertSizeMetrics
-                     TMP_DIR=/gfs/scratch/
-                     I={infile} 
-                     O=$tmp
-                     H={pdf}
-                     M=0.5 && 
-                   cat $tmp | 
-                     grep -A`wc -l $tmp | 
-                     tr "[[:blank:]]" "\\n" | 
-                     head -n 1` "## HISTOGRAM" $tmp | 
-                     grep -v "#" > {histogram} &&
-                   cat $tmp | 
-                     grep -A 2 "## METRICS CLASS" $tmp | 
-                     grep -v "#" > {outfile} &&
-                   rm $tmp'''
-
-    
-    P.run(statement, job_memory="10G", job_threads=5)
-
-    
-@merge(picardInsertSizes,
+@follows(bamQC)
+@merge("bowtie2.dir/*.picardInsertSizeMetrics.txt",
        "picardInsertSizeMetrics.load")
 def loadpicardInsertSizeMetrics(infiles, outfile):
     '''load the insert size metrics to a single table in the db'''
 
-    P.concatenate_and_load(infiles, outfile,
-                         regex_filename=".*/(.*).picardInsertSizeMetrics",
-                         cat="sample_id",
-                         options='-i "sample_id"')
+    A.load(infiles, outfile,
+           regex_filename=".*/(.*).picardInsertSizeMetrics",
+           cat="sample_id",
+           indexes=["sample_id"])
 
 
-@follows(picardInsertSizes)
+@active_if(Unpaired == False)
+@follows(bamQC)
 @merge("bowtie2.dir/*.picardInsertSizeHistogram.txt",
        "picardInsertSizeHistogram.load")
 def loadpicardInsertSizeHistogram(infiles, outfile):
     '''load the insert size metrics to a single table in the db'''
 
-    P.concatenate_and_load(infiles, outfile,
-                         regex_filename=".*/(.*).picardInsertSizeHistogram",
-                         cat="sample_id",
-                         options='-i "sample_id"')
+    A.load(infiles, outfile,
+           regex_filename=".*/(.*).picardInsertSizeHistogram",
+           cat="sample_id",
+           indexes=["sample_id"])
 
     
-@follows(loadpicardAlignmentSummary, loadpicardInsertSizeMetrics, loadpicardInsertSizeHistogram)
+@follows(loadpicardAlignmentSummary, loadpicardInsertSizeMetrics, loadpicardInsertSizeHistogram,
+         insertionIndex)
 def mapping():
     pass
 
@@ -563,7 +662,7 @@ def getFragmentSize(infile, outfile):
 @active_if(Unpaired)
 @transform(getFragmentSize, suffix(r".txt"), r".load")
 def loadgetFragmentSize(infile, outfile):
-    P.load(infile, outfile, options='-H "sample, tag_size"')
+    A.load(infile, outfile, header=["sample", "tag_size"])
 
 
 @follows(loadgetFragmentSize)
@@ -620,47 +719,50 @@ def macs2callpeaks(infile, outfile):
 @follows(macs2callpeaks)
 @files(None, "blacklist_chip.mm10.bed.gz")
 def getChIPblacklist(infile, outfile):
-    '''Get Ensembl ChIP blacklisted regions'''
+    '''Get Ensembl ChIP blacklisted regions, from the blacklist cache if
+       already downloaded (or a local path)'''
 
     chip_blacklist = PARAMS["peak_filter_chip_blacklist"]
-    statement = f'''wget -O {outfile} {chip_blacklist}'''
+    blacklist = A.cachedBlacklist(chip_blacklist, PARAMS["peak_filter_cache"], PARAMS["genome"])
 
-    P.run(statement)
+    shutil.copyfile(blacklist, outfile)
 
     
 @follows(getChIPblacklist)
 @files(None, "blacklist_atac.mm10.bed.gz")
 def getATACblacklist(infile, outfile):
-    '''Get ATAC blacklist regions'''
+    '''Get ATAC blacklist regions, from the blacklist cache if already
+       downloaded (or a local path)'''
 
     atac_blacklist = PARAMS["peak_filter_atac_blacklist"]
-    
-    statement = f'''wget -q {atac_blacklist} | 
-                      gzip - > {outfile}'''
+    blacklist = A.cachedBlacklist(atac_blacklist, PARAMS["peak_filter_cache"], PARAMS["genome"])
 
-    P.run(statement)
+    shutil.copyfile(blacklist, outfile)
 
     
 @follows(getATACblacklist)
-@transform("macs2.dir/*_peaks.narrowPeak",
-           regex("(.*)_peaks.narrowPeak"),
-           add_inputs([getChIPblacklist, getATACblacklist]),
-           r"\1.peaks.bed")
-def filterPeaks(infiles, outfile):
-    '''subtract blacklist regions from peakset'''
+@split("macs2.dir/*_peaks.narrowPeak", "macs2.dir/*.peaks.bed")
+def filterPeaks(infiles, outfiles):
+    '''subtract blacklist regions from all peaksets in one job, using the
+       cached blacklist interval indexes'''
 
-    peak, blacklists = infiles
+    script = PARAMS["pipeline_dir"] + "python/filterPeaks.py"
 
-    blacklist = ' '.join(blacklists)
-    
-    statement = f'''intersectBed 
-                      -wa 
-                      -v 
-                      -a {peak} 
-                      -b <(zcat {blacklist} ) 
-                      > {outfile}'''
+    peaks = ",".join(infiles)
+    filtered = ",".join(re.sub(r"_peaks.narrowPeak$", ".peaks.bed", x) for x in infiles)
+    blacklists = "blacklist_chip.mm10.bed.gz,blacklist_atac.mm10.bed.gz"
+
+    cache = PARAMS["peak_filter_cache"]
+    genome = PARAMS["genome"]
+
+    statement = f'''python {script}
+                     --infiles {peaks}
+                     --outfiles {filtered}
+                     --blacklists {blacklists}
+                     --cache {cache}
+                     --genome {genome}'''
     
-    P.run(statement)
+    P.run(statement, job_memory="4G")
 
 
 def mergeReplicatePeaksGenerator():
@@ -703,94 +805,41 @@ def mergeReplicatePeaksGenerator():
         peaksets = [".all", ".size_filt"]
 
         for peaks in peaksets:
-            if peaks == ".all":
-                suffix = "_peaks.filt.bed"
-            if peaks == ".size_filt":
-                suffix = ".size_filt_peaks.filt.bed"
+            suffix = peaks + ".peaks.bed"
 
             for reps in replicates:
 
+                # replicate names, then the merged name
                 reps = reps.split(",")
 
-                if len(reps)==3:
-                    out = outDir + reps[2] + peaks + ".merged.bed"
-                    bed1 = outDir + reps[0] + suffix
-                    bed2 = outDir + reps[1] + suffix
-
-                    yield [ [bed1, bed2], out]
+                out = outDir + reps[-1] + peaks + ".merged.bed"
+                beds = [outDir + x + suffix for x in reps[:-1]]
 
-                if len(reps)>3:
-                    out = outDir + reps[-1] + peaks + ".merged.bed"
-                    bed1 = outDir + reps[0] + suffix
-                    bed2 = outDir + reps[1] + suffix
-                    bed3 = outDir + reps[2] + suffix
-
-                    yield [ [bed1, bed2, bed3], out]
+                yield [beds, out]
 
             
 @follows(filterPeaks)
 @files(mergeReplicatePeaksGenerator)
 def mergeReplicatePeaks(infiles, outfile):
-    '''Merge replicate peaks'''
-
-    tmp = outfile.replace(".bed", ".tmp")
+    '''Merge replicate peaks, any number of replicates, keeping regions
+       found in >= overlap replicates'''
 
     rep_overlaps = PARAMS["replicates_overlap"]
-    
-    if len(infiles)==2:
-        beda = BedTool(infiles[0])
-        bedb = BedTool(infiles[1])
-        
-        # cat peaks from all reps
-        bedab = beda.cat(bedb, postmerge=False)
 
-        # merge overlapping peaks, perform summary operations on additional cols
-        bedab = bedab.sort().merge(c="4,5,6,7,8,9,10", o="collapse,mean,first,mean,min,min,mean")
-        bedab.saveas(tmp) # save bed
-
-    if len(infiles)==3:
-        beda = BedTool(infiles[0])
-        bedb = BedTool(infiles[1])
-        bedc = BedTool(infiles[2])
-
-        bedab = beda.cat(bedb, postmerge=False)
-        bedabc = bedab.cat(bedc, postmerge=False)
-
-        bedabc = bedabc.sort().merge(c="4,5,6,7,8,9,10", o="collapse,mean,first,mean,min,min,mean")
-        bedabc.saveas(tmp)
-
-    with open(outfile, "w") as output:
-        with open(tmp, "r") as r:
-            for line in r:
-                cols = [x.rstrip("\n") for x in line.split("\t")]
-
-                [contig, start, end, peak_id, peak_score, strand, FC, pval, qval, summit] = cols
-
-                # get unique elements from list of replicates by converting to set
-                if len(set(peak_id.split(","))) >= rep_overlaps:
-                    # outfile
-                    bed = [contig, start, end, peak_id, peak_score, strand, FC, pval, qval, summit]
-                    bed = '\t'.join(bed) + '\n'
-
-                    output.write(bed)
-
-    statement = f'''rm {tmp}'''
-
-    P.run(statement)
+    A.mergeReplicatePeaks(infiles, outfile, rep_overlaps)
 
 
 @follows(mergeReplicatePeaks)
 @files(None, "macs2.dir/no_peaks.txt")
 def countPeaks(infiles, outfile):
+    '''Tabulate no. peaks & widths per peak set, from the statistics
+       sidecars written with each peak file'''
 
     beds = glob.glob("./macs2.dir/*.peaks.bed")
     merge_beds = glob.glob("./macs2.dir/*.merged.bed")
 
     peaksets = [beds, merge_beds]
 
-    if len(peaksets)==0:
-        pass
-    
     no_peaks = {}
 
     for peaks in peaksets:
@@ -800,9 +849,9 @@ def countPeaks(infiles, outfile):
             else:
                 name = os.path.basename(bed).replace(".peaks.bed", "")
 
-            df = pd.read_csv(bed, sep="\t", header=None)
+            stats = A.readPeakStats(bed)
 
-            no_peaks[name] = len(df)
+            no_peaks[name] = [stats["no_peaks"], stats["bp"], stats["width"]["median"]]
 
     peaks = pd.DataFrame.from_dict(no_peaks, orient="index")
 
@@ -810,7 +859,7 @@ def countPeaks(infiles, outfile):
     peaks["size_filt"] = peaks["sample_id"].apply(lambda x: "all_fragments" if "size_filt" not in x else "<150bp")
     peaks["merged"] = peaks.apply(lambda x: "merged" if "merged" in x.sample_id else "replicate", axis=1)
     peaks["sample_id"] = peaks["sample_id"].apply(lambda x: x.split(".")[0].rstrip("_merged"))
-    peaks = peaks.rename(columns={0:"no_peaks"})
+    peaks = peaks.rename(columns={0:"no_peaks", 1:"peak_bp", 2:"median_width"})
     peaks.reset_index(inplace=True, drop=True)
 
     peaks.to_csv(outfile, header=True, index=False, sep="\t")
@@ -818,7 +867,7 @@ def countPeaks(infiles, outfile):
     
 @transform(countPeaks, suffix(".txt"), ".load")
 def loadcountPeaks(infile, outfile):
-    P.load(infile, outfile, options='-i "sample_id" ')
+    A.load(infile, outfile, indexes=["sample_id"])
 
     
 @follows(loadcountPeaks)
@@ -910,102 +959,51 @@ def hmmratac(infile, outfile):
 ########################################################
 ####                    FRIP                        ####
 ########################################################
-def generate_FRIPcountBAM_jobs():
-    all_intervals = glob.glob("macs2.dir/*.peaks.bed")
-    all_bams = glob.glob("bowtie2.dir/*.prep.bam")
-        
-    outDir = "FRIP.dir/"
+def generate_FRIP_jobs():
+    '''One job per sample, with its all & size_filt peak sets'''
 
-    # group size filtered and non-size filtered files seperately
-    bams = [x for x in all_bams if "size_filt" in x]
-    intervals = [x for x in all_intervals if "size_filt" in x]
-    size_filt = [bams, intervals]
-    
-    bams = [x for x in all_bams if "size_filt" not in x]
-    intervals = [x for x in all_intervals if "size_filt" not in x]
-    non_size_filt = [intervals, bams]
-
-    # iterate over grouped files matching bams & peaks
-    for group in [size_filt, non_size_filt]:
-        group = sum(group, []) # first flatten list
-        intervals = [x for x in group if ".bed" in x]
-        bams = [x for x in group if "prep.bam" in x]
-
-        for interval in intervals:
-            match = ''.join(['.'.join(os.path.basename(i).split(".")[0:2]) for i in [interval] ])
-            for bam in bams:
-                bam_sample = bam.split("/")[-1].replace(".prep.bam", "")
-                
-                if match in bam and match in interval:
-                    bfile = ''.join([''.join(os.path.basename(b).split(".")[0:2]) for b in bam ])
-                    output = outDir + match + ".fripcounts" + ".txt"
-                    
-                    yield [ [interval, bam], output ] 
+    for index in glob.glob("bowtie2.dir/*.all.prep.tn5"):
+        sample = os.path.basename(index)[:-len(".all.prep.tn5")]
 
-                        
-@follows(mkdir("FRIP.dir"), peakcalling)
-@files(generate_FRIPcountBAM_jobs)
-def FRIPcountBAM(infiles, outfile):
-    '''use bedtools to count reads in bed intervals'''
+        peaks = ["macs2.dir/" + sample + x for x in [".all.peaks.bed", ".size_filt.peaks.bed"]]
 
-    interval, bam = infiles
+        # peak sets without peaks have no FRIP
+        peaks = [x for x in peaks if os.path.exists(x) and A.readPeakStats(x)["no_peaks"] > 0]
 
-    if bamtools.is_paired(bam):
-         # -p flag specifes only to count paired reads
+        if len(peaks) > 0:
+            yield [[index + "/contigs.tsv"] + peaks, "FRIP.dir/" + sample + ".frip.txt"]
 
-        statement = f'''bedtools multicov -p -q 10 -bams {bam} 
-                    -bed <( awk 'BEGIN {{OFS="\\t"}} {{print $1,$2,$3,$4,$5,$3-$2}}' {interval} ) 
-                    > {outfile} 
-                    && sed -i '1i \chromosome\\tstart\\tend\\tpeak_id\\tpeak_score\\tpeak_width\\ttotal' 
-                    {outfile}'''  
-
-    else:
-
-         statement = f'''bedtools multicov -q 10 -bams {bam} 
-                     -bed <( awk 'BEGIN {{OFS="\\t"}} {{print $1,$2,$3,$4,$5,$3-$2}}' {interval} ) 
-                     > {outfile} 
-                     && sed -i '1i \chromosome\\tstart\\tend\\tpeak_id\\tpeak_score\\tpeak_width\\ttotal' 
-                     {outfile} '''  
-
-    print(statement)
-         
-    P.run(statement)
-
-    
-@transform(FRIPcountBAM,
-           regex(r"(.*).fripcounts.txt"),
-           r"\1.frip.txt")
-def FRIP(infile, outfile):
-        '''Calculate fraction of read in peaks'''
-
-        insert_size = PARAMS["bowtie2_insert_size"]
         
-        if "size_filt" in infile:
-            size_filt = '''"<''' + str(insert_size) + '''bp"'''
+@follows(mkdir("FRIP.dir"), peakcalling)
+@files(generate_FRIP_jobs)
+def FRIP(infiles, outfile):
+    '''Calculate fraction of reads in peaks for a samples all & size_filt
+       peak sets in one pass over its Tn5 insertion index. Total reads are
+       taken from the index, not by decompressing the BAM'''
+
+    script = PARAMS["pipeline_dir"] + "python/frip.py"
+
+    index = os.path.dirname(infiles[0])
+    sample = os.path.basename(outfile).replace(".frip.txt", "")
+    insert_size = PARAMS["bowtie2_insert_size"]
+
+    peaks = []
+    for bed in infiles[1:]:
+        if "size_filt" in bed:
+            peaks.append(f"--size_filt_peaks {bed}")
         else:
-            size_filt = "all_fragments"
-
-        sample_name = os.path.basename(infile).replace(".fripcounts.txt", "")
-        sample_label = sample_name.split(".")[0]
-        bam = "bowtie2.dir/" + sample_name + ".prep.bam"
-        
+            peaks.append(f"--all_peaks {bed}")
+    peaks = " ".join(peaks)
 
-        statement = f'''total_reads=`samtools view {bam} | 
-                         wc -l` &&
-                       peak_reads=`awk 'BEGIN {{OFS="\\t"}}
-                         {{sum += $7;}} END 
-                         {{print sum;}}' {infile}` &&
-                       awk -v sample={sample_label} 
-                         -v isize={size_filt}
-                         -v t_reads=$total_reads
-                         -v p_reads=$peak_reads
-                         'BEGIN {{print p_reads / t_reads, sample, isize}}' | 
-                         tr -s "[[:blank:]]" "\\t" 
-                         > {outfile}'''
+    statement = f'''python {script}
+                     --index {index}
+                     --sample {sample}
+                     {peaks}
+                     --insert_size {insert_size}
+                     --outfile {outfile}'''
 
-        print(statement)
+    P.run(statement, job_memory="4G")
 
-        P.run(statement)
 
 @merge(FRIP, "FRIP.dir/frip_table.txt")
 def FRIP_table(infiles, outfile):
@@ -1026,7 +1024,7 @@ def FRIP_table(infiles, outfile):
 
 @transform(FRIP_table, suffix(".txt"), ".load")
 def loadFRIP_table(infile, outfile):
-    P.load(infile, outfile, options = '-i "sample_id"')
+    A.load(infile, outfile, indexes=["sample_id"])
 
 
 @follows(loadFRIP_table)
@@ -1040,7 +1038,8 @@ def frip():
 @follows(mkdir("BAM_counts.dir"), frip)
 @merge("macs2.dir/*.peaks.bed", "BAM_counts.dir/merged_peaks.bed")
 def mergePeaks(infiles, outfile):
-    '''cat all peak files, center over peak summit +/- 250 b.p., then merge peaks'''
+    '''cat all peak files, center over peak summit +/- 250 b.p., then merge peaks.
+       Peaks unchanged from a previous merged_peaks.bed keep their peak_id'''
 
     tmp_dir = "$SCRATCH_DIR"
     window_size = PARAMS["read_counts_window"]
@@ -1053,6 +1052,7 @@ def mergePeaks(infiles, outfile):
         infiles = [x for x in infiles if "size_filt" in x]
 
     infiles = ' '.join(infiles)
+    merged = outfile + ".tmp"
 
     statement = f'''tmp=`mktemp -p {tmp_dir}` &&
                    cat {infiles} | grep -v ^chrUn* - > $tmp &&
@@ -1061,11 +1061,19 @@ def mergePeaks(infiles, outfile):
                    awk 'BEGIN {{OFS="\\t"}} {{if (($2 < $3) && ($2 > 0)) print $0}}' - |
                      sort -k1,1 -k2,2n |
                      mergeBed -c 4,5 -o count,mean -i - |
-                     awk 'BEGIN {{OFS="\\t"}} {{print $1,$2,$3,"merged_peaks_"NR,$5,$4,$3-$2,sprintf("%%i", ($2+$3)/2)}}' - > {outfile} &&
+                     awk 'BEGIN {{OFS="\\t"}} {{print $1,$2,$3,"merged_peaks_"NR,$5,$4,$3-$2,sprintf("%%i", ($2+$3)/2)}}' - > {merged} &&
                    rm $tmp'''
 
     P.run(statement)
 
+    # incremental: unchanged peaks keep their previous peak_id, so their counts are reused
+    previous = outfile if PARAMS["read_counts_incremental"] else None
+    A.stablePeakIds(merged, outfile, previous)
+    os.remove(merged)
+
+    # merged peak score (mean) in column 5, no summit
+    A.writePeakFileStats(outfile, score=4)
+
     
 ########################################################
 ####                GREAT Peak2Gene                 ####
@@ -1097,36 +1105,34 @@ def fetchEnsemblGeneset(infile,outfile):
     
 @transform(fetchEnsemblGeneset,suffix(".txt"),".load")
 def uploadEnsGenes(infile,outfile):
-    '''Load the ensembl annotation including placeholder GO ID's'''
-    P.load(infile, outfile, options='-i "gene_id" -i "go_id" ')
+    '''Load the ensembl annotation'''
+    A.load(infile, outfile, indexes=["gene_id"])
 
     
-@follows(uploadEnsGenes)
+@transform(fetchEnsemblGeneset, suffix(".txt"), ".index")
+def geneIndex(infile, outfile):
+    '''Build (or reuse from the cache) the gene body & TSS index'''
+    PS.geneIndex(infile, outfile, cache=PARAMS["gene_index_cache"])
+
+
+@follows(uploadEnsGenes, geneIndex)
 def getGeneLists():
     pass
 
 
 @follows(getGeneLists, mkdir("greatBeds.dir"))
-@files(uploadEnsGenes, "greatBeds.dir/ens_great_prom.bed")
+@files("annotations.dir/ensemblGeneset.index", "greatBeds.dir/ens_great_prom.bed")
 def greatPromoters(infile,outfile):
-    ''' Make great promoters for the genes retrieved from Ensembl'''
-
-    dbh = sqlite3.connect(db)
-    cc = dbh.cursor()
+    ''' Make great promoters for the genes retrieved from Ensembl, read from
+        the gene index'''
 
     basalup = PARAMS["great_basal_up"]
     basaldown = PARAMS["great_basal_down"]
     maxext = PARAMS["great_max"]
-    half = PARAMS["great_half"]  
-    statement = '''select distinct contig, start,                                                                                                         
-                   end, strand, gene_id from ensemblGeneset '''
+    half = PARAMS["great_half"]
+
+    locations = PS.geneLocations(infile)
 
-    result = cc.execute(statement).fetchall()
-    
-    
-    locations = [ [ str(r[0]), int(r[1]), int(r[2]),str(r[3]), str(r[4]) ] 
-                   for r in result ]
-    
     A.writeGreat(locations,basalup,basaldown,maxext,outfile,half)
 
 
@@ -1148,7 +1154,7 @@ def filterEnsPromoters(infile,outfile):
 @transform(filterEnsPromoters,suffix(".bed"),".load")
 def loadGreatPromoters(infile, outfile):
     '''Load the great promoter regions'''
-    P.load(infile, outfile, options='-H "chr,start,end,gene_id" -i "gene_id"')
+    A.load(infile, outfile, header=["chr", "start", "end", "gene_id"], indexes=["gene_id"])
 
     
 @follows(loadGreatPromoters)
@@ -1159,105 +1165,65 @@ def GreatAnnotation():
 @follows(GreatAnnotation, mkdir("regulated_genes.dir"))
 @transform("BAM_counts.dir/merged_peaks.bed",
            regex(r"BAM_counts.dir/(.*).bed"),
-           add_inputs("greatBeds.dir/ens_great.bed"),
-           r"regulated_genes.dir/\1.GREAT.txt")
-def regulatedGenes(infiles,outfile):
-    '''Get all genes associated with peaks'''
+           add_inputs("greatBeds.dir/ens_great.bed", "annotations.dir/ensemblGeneset.index"),
+           r"regulated_genes.dir/\1.GREAT.closestGene.bed")
+def regulatedTables(infiles, outfile):
+    '''Assign each peak the gene with the nearest TSS among genes whose GREAT
+       domain overlaps it, with the signed TSS distance'''
 
-    infile, greatPromoters = infiles
+    infile, greatPromoters, index = infiles
 
-    # intersect infiles with great gene annotation beds to get peak associated genes
-    statement = f'''intersectBed 
-                      -wa 
-                      -wb 
-                      -a <(cut -f1-8 {infile}) 
-                      -b {greatPromoters} | 
-                      cut -f1-8,12 > {outfile}'''  
+    genes, _ = PS.loadGeneIndex(index)
 
-    # Filter on nearest peak 2 gene later
+    A.writeClosestGenes(infile, greatPromoters, genes, outfile)
 
-    P.run(statement)
 
-    
-@transform(regulatedGenes, suffix(r".txt"), r".load")
-def loadRegulatedGenes(infile, outfile):
-    P.load(infile, outfile, 
-           options='-H "contig,start,end,peak_id,peak_score,no_peaks,peak_width,peak_centre,gene_id" -i "peak_id"')
+@transform(regulatedTables, suffix(".bed"), ".load")
+def loadRegulatedTables(infile,outfile):
+    A.load(infile, outfile,
+           header=["contig", "peak_start", "peak_end", "peak_id", "peak_score", "peak_width",
+                   "peak_centre", "TSSdist", "gene_id", "TSS"],
+           indexes=["peak_id"])
 
-    
-@transform(loadRegulatedGenes,
-           suffix(r".load"),
-           add_inputs(loadGreatPromoters,uploadEnsGenes),
-           r".closestGene.bed")
-def regulatedTables(infiles, outfile):
-    '''Make an informative table about peaks and "regulated" genes'''
-    
-    regulated, great, ensGenes = [ P.to_table(x) for x in infiles ]
-
-    query = f'''select distinct r.contig,
-                  r.start, r.end, r.peak_id, r.peak_score,
-                  r.no_peaks, r.peak_width, r.peak_centre,
-                  g.gene_id, e.gene_name, e.strand,
-                  e.start, e.end
-                  from {regulated} as r
-                  inner join {great} as g
-                     on g.gene_id = r.gene_id 
-                  inner join {ensGenes} as e
-                     on g.gene_id = e.gene_id'''
 
-    dbh = sqlite3.connect(db)
-    cc = dbh.cursor()
-    sqlresult = cc.execute(query).fetchall()
+@follows(mkdir("annotations.dir"))
+@files(None, "annotations.dir/genome_partition")
+def genomePartition(infile, outfile):
+    '''Partition the genome into promoter, UTR, exon, TES-proximal, intron &
+       intergenic runs from the annotations geneset'''
 
-    sql_table = outfile.replace(".bed", ".txt")
-    
-    o = open(sql_table,"w")
-    o.write("\t".join ( 
-            ["chromosome","peak_start","peak_end","peak_id","peak_score",
-             "no_peaks","peak_width","peak_centre",
-             "dist2peak","gene_id", "TSS"]) + "\n" )
-
-    for r in sqlresult:
-        contig, pstart, pend, peak_id, peak_score, no_peaks, peak_width, peak_centre = r[0:8]
-        gene_id, gene_name, gene_strand, gene_start, gene_end = r[8:14]
-        
-        if gene_strand == "+": gstrand = 1
-        else: gstrand = 2
+    statement = '''select contig, feature, start, end, strand, transcript_id
+                   from geneset_all_gtf where feature in ("exon", "CDS")'''
 
-        tss = A.getTSS(gene_start,gene_end,gene_strand)
+    gtf = A.fetch_DataFrame(statement, PARAMS["annotations_database"])
 
-        pwidth = max(pstart,pend) - min(pstart,pend)
-        ploc = (pstart + pend)/2
+    PS.genomePartition(gtf, outfile, cache=PARAMS["partition_cache"],
+                       promoter_up=PARAMS["partition_promoter_up"],
+                       promoter_down=PARAMS["partition_promoter_down"],
+                       tes_up=PARAMS["partition_tes_up"],
+                       tes_down=PARAMS["partition_tes_down"])
 
-        if gstrand==1: tssdist = tss - ploc
-        else: tssdist = ploc - tss
 
-        columns = [ str(x) for x in
-                    [  contig, pstart, pend, peak_id, peak_score, peak_width, peak_centre, tssdist, gene_id, tss] ]
-        o.write("\t".join( columns  ) + "\n")
-    o.close()
+@follows(mkdir("regulated_genes.dir"))
+@transform("BAM_counts.dir/merged_peaks.bed",
+           regex(r"BAM_counts.dir/(.*).bed"),
+           add_inputs(genomePartition),
+           r"regulated_genes.dir/\1.partition.txt")
+def peakPartitions(infiles, outfile):
+    '''Label merged peaks by the genomic partition of their centre'''
 
-    # get closest genes 2 peaks, 1 gene per peak
-    tmp_dir = "$SCRATCH_DIR"
-    statement = f'''tmp=`mktemp -p {tmp_dir}` &&
-                    tail -n +2 {sql_table}  | sed 's/-//g' | 
-                      awk 'BEGIN {{OFS="\\t"}} {{print $4,$5,$6,$7,$8,$9,$10,$1,$2,$3}}' |
-                      sort -k8,8 -k9,9n -k7,7n |
-                      cat | 
-                      uniq -f7 > $tmp && 
-                    awk 'BEGIN {{OFS="\\t"}} {{print $8,$9,$10,$1,$2,$3,$4,$5,$6,$7}}' $tmp > {outfile}  && 
-                    rm {sql_table} $tmp'''
+    infile, partition = infiles
 
-    P.run(statement)
+    # merged peak centre in column 8
+    PS.writePeakPartitions(infile, partition, outfile, position=7)
 
-    
-@transform(regulatedTables, suffix(".bed"), ".load")
-def loadRegulatedTables(infile,outfile):
-    P.load(infile,outfile,
-           options='-H"contig,peak_start,peak_end,peak_id,peak_score,peak_width,peak_centre,TSSdist,gene_id,TSS" -i "peak_id" ')
+
+@transform(peakPartitions, suffix(".txt"), ".load")
+def loadPeakPartitions(infile, outfile):
+    A.load(infile, outfile, indexes=["peak_id"])
 
 
-@follows(loadRegulatedTables)
+@follows(loadRegulatedTables, loadPeakPartitions)
 def great():
     pass
 
@@ -1265,129 +1231,96 @@ def great():
 ########################################################
 ####     Differential Accessibility Read Counts     ####
 ########################################################
-@follows(great)
-@transform("bowtie2.dir/*.prep.bam",
-           regex(r"(.*).prep.bam"),
-           r"\1.prep.bam.bai")
-def indexBAM(infile, outfile):
-    '''Index input BAM files'''
-
-    statement = f'''samtools index {infile} {outfile}'''
-
-    P.run(statement)
-
-    
-def generate_scoreIntervalsBAM_jobs():
-    
-    # list of bed files & bam files, from which to create jobs
-    intervals = glob.glob("regulated_genes.dir/*closestGene.bed")
-    bams = glob.glob("bowtie2.dir/*.prep.bam")
-
-    outDir = "BAM_counts.dir/"
-
-    for interval in intervals:
-        #print interval
-        ifile = [i.split("/")[-1][:-len(".closestGene.bed")] for i in [interval] ]
-        # iterate over intervals generating infiles & partial filenames
-
-        for bam in bams:
-            bfile = [b.split("/")[-1][:-len(".prep.bam")] for b in [bam] ]
-            # for each interval, iterate over bams generating infiles & partial filenames
-            bedfile = ' '.join(str(x) for x in ifile )
-            bamfile = ' '.join(str(x) for x in bfile )
+@follows(great, insertionIndex)
+@transform("regulated_genes.dir/*closestGene.bed",
+           regex(r"regulated_genes.dir/(.*).closestGene.bed"),
+           r"BAM_counts.dir/\1.counts.npz")
+def countMatrix(infile, outfile):
+    '''Count Tn5 insertions in peaks for all prep BAMs in one job, from the
+       insertion indexes, writing a peaks x samples matrix & wide table.
+       With read_counts_incremental the previous matrix is updated'''
+
+    script = PARAMS["pipeline_dir"] + "python/countMatrix.py"
+
+    indexes = ",".join(sorted(glob.glob("bowtie2.dir/*.prep.tn5")))
+    table = outfile.replace(".npz", ".txt")
+    processes = PARAMS["read_counts_processes"]
+
+    # incremental: only new samples & new or changed peaks are counted
+    if PARAMS["read_counts_incremental"] and os.path.exists(outfile):
+        previous = f"--previous {outfile}"
+    else:
+        previous = ""
 
-            output = outDir + bedfile + "." + bamfile + ".counts.txt"
-            # output = outfiles. 1 for each bed/bam combination
+    statement = f'''python {script}
+                     --peaks {infile}
+                     --indexes {indexes}
+                     --outfile {outfile}
+                     --table {table}
+                     --processes {processes}
+                     {previous}'''
 
-            yield [ [interval, bam], output ] 
+    P.run(statement, job_memory="4G", job_threads=processes)
 
-            
-@follows(indexBAM)
-@files(generate_scoreIntervalsBAM_jobs)
-def scoreIntervalsBAM(infiles, outfile):
-    '''use bedtools to count reads in bed intervals'''
 
-    interval, bam = infiles
+@transform(countMatrix, suffix(r".npz"), r".load")
+def loadCountMatrix(infile, outfile):
+    A.load(infile.replace(".npz", ".txt"), outfile, indexes=["peak_id"])
 
-    tmp_dir = "$SCRATCH_DIR"
-    
-    if bamtools.is_paired(bam):
-        statement = f'''tmp=`mktemp -p {tmp_dir}` &&
-                        cut -f1-7,9 {interval} > $tmp &&
-                        bedtools multicov 
-                          -p 
-                          -q 10 
-                          -bams {bam} 
-                          -bed $tmp > {outfile} &&
-                        sed -i '1i \chromosome\\tstart\\tend\\tpeak_id\\tpeak_score\\tpeak_width\\tpeak_center\\tgene_id\\ttotal' {outfile} &&
-                        rm $tmp'''  
-        
-    else:
-         statement = f'''tmp=`mktemp -p {tmp_dir}` &&
-                         cut -f1-7,9 {interval} > $tmp &&
-                         bedtools multicov 
-                          -q 10 
-                          -bams {bam} 
-                          -bed $tmp > {outfile} && 
-                         sed -i '1i \chromosome\\tstart\\tend\\tpeak_id\\tpeak_score\\tpeak_width\\tpeak_center\\tgene_id\\ttotal' {outfile} &&
-                         rm $tmp'''  
 
-    P.run(statement)
-
-    
-@transform(scoreIntervalsBAM,
-           regex(r"(.*).counts.txt"),
-           r"\1.norm_counts.txt")
+@transform(countMatrix,
+           regex(r"BAM_counts.dir/(.*).counts.npz"),
+           r"BAM_counts.dir/\1.norm_counts.npz")
 def normaliseBAMcounts(infile, outfile):
-    '''normalise BAM counts for file size'''
-
-    # write this as a script and submit job to cluster
-    
-    counts = pd.read_csv(infile, sep="\t", header=0)
+    '''normalise the count matrix for library size (RPM, RPM/width) &
+       reads in peaks (CPM, upper quartile, TMM), all samples at once'''
 
-    name = os.path.basename(infile).replace(".counts.txt", "").replace("merged_peaks.GREAT.", "").replace(".", "_")
+    peaks, samples, counts = A.readCountMatrix(infile)
 
     if Unpaired == False:
-        query = f'''select (properly_paired/2)/1E06 as total from flagstats where QC_status = "pass" and sample_id = "{name}" '''  
+        query = '''select sample_id, (properly_paired/2)/1E06 as total from flagstats where QC_status = "pass" '''  
     else:
-        query = f'''select mapped/1E06 as total from flagstats where QC_status = "pass" and sample_id = "{name}" '''  
+        query = '''select sample_id, mapped/1E06 as total from flagstats where QC_status = "pass" '''  
 
-    total_counts = A.fetch_DataFrame(query, db)
-    norm_factor = total_counts["total"]
-    
-    counts["RPM"] = counts["total"].apply(lambda x: x/norm_factor)
-    counts["RPM_width_norm"] = counts.apply(lambda x: x.RPM/x.peak_width if x.peak_width > 0 else x.RPM/1, axis=1)
-    counts["sample_id"] = name.rstrip("_prep")
-    counts["size_filt"] = counts.apply(lambda x: "<150bp" if "size_filt" in x.sample_id else "all_fragments", axis=1)
-    counts["sample_id"] = counts["sample_id"].apply(lambda x: x.strip("_size_filt"))
-    
-    counts.to_csv(outfile, sep="\t", header=True, index=False)
+    totals = A.fetch_DataFrame(query, db).set_index("sample_id")["total"]
+    library_sizes = totals.reindex([x.replace(".", "_") for x in samples]).values
+
+    norm = A.normaliseCounts(counts, peaks["peak_width"].values, library_sizes)
+
+    A.writeCountMatrix(outfile, peaks, samples, counts, norm)
 
                 
-@follows(normaliseBAMcounts)
-@merge("BAM_counts.dir/*.norm_counts.txt", "all_norm_counts.txt")
+@active_if(Storage == "long")
+@merge(normaliseBAMcounts, "all_norm_counts.txt")
 def mergeNormCounts(infiles, outfile):
+    '''Write normalised counts for all peak sets as one long table'''
 
-    head = infiles[0]
-    infiles = ' '.join(infiles)
+    for n, infile in enumerate(infiles):
+        peaks, samples, counts, norm = A.readNormMatrix(infile)
+        table = A.normCountsTable(peaks, samples, counts, norm)
 
-    tmp_dir = "$SCRATCH_DIR"
-
-    statement = f'''tmp=`mktemp -p {tmp_dir}` &&
-                    head -n 1 {head} >  $tmp &&
-                    for i in {infiles}; 
-                      do tail -n +2 $i >> $tmp; 
-                      done;
-                    mv $tmp {outfile}'''
-    
-    P.run(statement)
+        table.to_csv(outfile, sep="\t", header=n == 0, index=False, mode="w" if n == 0 else "a")
     
 
+@active_if(Storage == "long")
 @transform(mergeNormCounts, suffix(r".txt"), r".load")
 def loadmergeNormCounts(infile, outfile):
-    P.load(infile, outfile, options='-i "peak_id" ')
+    A.load(infile, outfile, indexes=["peak_id"])
+
+
+@active_if(Storage == "wide")
+@merge(normaliseBAMcounts, "BAM_counts.dir/norm_counts.load")
+def loadNormCounts(infiles, outfile):
+    '''Load normalised counts as typed, wide norm_counts_* tables with
+       integer coded samples & peaks (see PipelineAtac.readNormCounts)'''
 
-@follows(loadmergeNormCounts)
+    with PS.writerLock(PARAMS["load_queue"]):
+        A.writeNormCountsDb(db, infiles)
+
+    iotools.touch_file(outfile)
+
+
+@follows(loadmergeNormCounts, loadNormCounts, loadCountMatrix)
 def count():
     pass
 
@@ -1407,85 +1340,41 @@ def indexPrepBam(infile, outfile):
     P.run(statement)
 
     
-@follows(indexPrepBam)
-@transform("bowtie2.dir/*.prep.bam",
-           regex(r"bowtie2.dir/(.*).prep.bam"),
+@follows(indexPrepBam, insertionIndex)
+@transform("bowtie2.dir/*.prep.tn5/contigs.tsv",
+           regex(r"bowtie2.dir/(.*).prep.tn5/contigs.tsv"),
            r"deeptools.dir/\1.coverage.bw")
 def bamCoverage(infile, outfile):
-    '''Make normalised bigwig tracks with deeptools'''
+    '''Make normalised bigwig tracks from the Tn5 insertion index in one pass:
+       all fragments (.coverage.bw) & insertion sites (.insertions.bw), plus
+       nucleosome free (.nfr.bw) & mononucleosome (.nucleosome.coverage.bw)
+       fragments for PE (not size filtered) samples'''
 
-    if bamtools.is_paired(infile):
+    script = PARAMS["pipeline_dir"] + "python/coverageTracks.py"
 
-        # PE reads filtered on sam flag 66 -> include only first read in properly mapped pairs
-        
-        statement = f'''bamCoverage 
-                          -b {infile} 
-                          -o {outfile}
-                          --binSize 5
-                          --smoothLength 20
-                          --centerReads
-                          --normalizeUsing RPKM
-                          --samFlagInclude 66
-                          -p "max"'''
-        
-    else:
+    index = os.path.dirname(infile)
+    outprefix = outfile[:-len(".coverage.bw")]
 
-        # SE reads filtered on sam flag 4 -> exclude unmapped reads
-        
-        statement = f'''bamCoverage 
-                          -b {infile} 
-                          -o {outfile}
-                          --binSize 5
-                          --smoothLength 20
-                          --centerReads
-                          --normalizeUsing RPKM
-                          --samFlagExclude 4
-                          -p "max"'''
-
-    # added smoothLength = 20 to try and get better looking plots...
-    # --minMappingQuality 10 optional argument, but unnecessary as bams are alredy filtered
-    # centerReads option and small binsize should increase resolution around enriched areas
-
-    P.run(statement, job_memory = "2G", job_threads=20)
-
-
-def generator_bamCoverage_mononuc():
-    bams = glob.glob("bowtie2.dir/*prep.bam")
-    if len(bams)==0:
-        pass
-    bams = [x for x in bams if "size_filt" not in x]
+    if Unpaired == False and "size_filt" not in outfile:
+        tracks = "coverage,nfr,nucleosome,insertions"
+    else:
+        tracks = "coverage,insertions"
 
-    for infile in bams:
-        outfile = "deeptools.dir/" + os.path.basename(infile).replace(".prep.bam", ".nucleosome.coverage.bw")
+    processes = PARAMS["coverage_processes"]
 
-        yield [infile, outfile]
+    statement = f'''python {script}
+                     --index {index}
+                     --outprefix {outprefix}
+                     --tracks {tracks}
+                     --binsize {PARAMS["coverage_binsize"]}
+                     --smooth {PARAMS["coverage_smooth"]}
+                     --nfr {PARAMS["coverage_nfr"]}
+                     --mononuc_min {PARAMS["coverage_mononuc_min"]}
+                     --mononuc_max {PARAMS["coverage_mononuc_max"]}
+                     --extend {PARAMS["coverage_extend"]}
+                     --processes {processes}'''
 
-        
-@follows(indexPrepBam)
-@active_if(Unpaired == False)
-@files(generator_bamCoverage_mononuc)
-def bamCoverage_mononuc(infile, outfile):
-    '''Make normalised bigwig tracks with deeptools'''
-
-    if bamtools.is_paired(infile):
-        
-        statement = f'''bamCoverage 
-                          -b {infile} 
-                          -o {outfile}
-                          --binSize 5
-                          --minFragmentLength 150
-                          --maxFragmentLength 300
-                          --smoothLength 20
-                          --centerReads
-                          --normalizeUsing RPKM
-                          --samFlagInclude 66
-                          -p "max"'''
-        
-    else:
-        
-        statement = f'''echo "Error - BAM must be PE to use --maxFragmentLength parameter" > {outfile}'''
-    
-    P.run(statement, job_memory="2G", job_threads=20)
+    P.run(statement, job_memory="4G", job_threads=processes)
 
     
 @follows(bamCoverage)
@@ -1493,173 +1382,128 @@ def coverage():
     pass
 
 
-@follows(coverage)
-@files(None, "regulated_genes.dir/TSS.bed")
-def TSSbed(infile, outfile):
-    '''Get TSSs for all genes'''
-    
-    query = '''select distinct contig, start, end, gene_name, strand
-                  from ensemblGeneset''' 
+@follows(coverage, geneIndex)
+@transform("bowtie2.dir/*.prep.tn5/contigs.tsv",
+           regex(r"bowtie2.dir/(.*).prep.tn5/contigs.tsv"),
+           add_inputs("annotations.dir/ensemblGeneset.index"),
+           r"deeptools.dir/\1.tss.npz")
+def TSSenrichment(infiles, outfile):
+    '''TSS enrichment score, insertion profile & heatmap over all TSSs from
+       the Tn5 insertion index'''
 
-    dbh = sqlite3.connect(db)
-    cc = dbh.cursor()
-    sqlresult = cc.execute(query).fetchall()
+    index, genes = infiles
 
-    o = open(outfile,"w")
-    
-    for r in sqlresult:
-        contig, start, end, gene_id, gene_strand = r[0:5]
-       
-        if gene_strand == "+": gstrand = 1
-        else: gstrand = 2
+    A.writeTSSEnrichment(os.path.dirname(index), genes, outfile,
+                         flank=PARAMS["tss_flank"],
+                         end_flank=PARAMS["tss_end_flank"],
+                         smooth=PARAMS["tss_smooth"],
+                         heatmap_bin=PARAMS["tss_heatmap_bin"],
+                         heatmap_rows=PARAMS["tss_heatmap_rows"])
 
-        tss = A.getTSS(start,end,gene_strand)
 
-        tss_start = tss -1
-        tss_end = tss +1
-        
-        columns = [ str(x) for x in
-                    [  contig, tss_start, tss_end, gene_id] ]
-        o.write("\t".join( columns  ) + "\n")
-    o.close()
+@merge(TSSenrichment, "deeptools.dir/TSS_enrichment.txt")
+def TSSenrichmentTable(infiles, outfile):
+    '''Table of TSS enrichment scores to load to csvdb'''
 
-    
-@transform(TSSbed,
-           regex("regulated_genes.dir/TSS.bed"),
-           add_inputs("deeptools.dir/*.coverage.bw"),
-           ["deeptools.dir/TSS.all.matrix.gz", "deeptools.dir/TSS.size_filt.matrix.gz"])
-def TSSmatrix(infiles, outfiles):
-
-    bed = infiles[0]
-    bws = [x for x in infiles if ".bw" in x]
-    job_threads = len(bws)
-    
-    all_reads = ' '.join([x for x in bws if "size_filt" not in x])
-    size_filt = ' '.join([x for x in bws if "size_filt" in x])
+    rows = []
+    for infile in infiles:
+        sample, size_filt = os.path.basename(infile)[:-len(".tss.npz")].rsplit(".", 1)
+        rows.append((sample, size_filt, A.readTSSEnrichment(infile)["score"]))
 
-    jobs = [all_reads, size_filt]
+    df = pd.DataFrame(rows, columns=["sample_id", "size_filt", "TSS_enrichment"])
+    df.to_csv(outfile, sep="\t", index=False)
 
-    names = ' '.join(list(set([os.path.basename(x).split(".")[0] for x in bws ]) ) )
-    
-    n = 0
-    for job in jobs:
-        n = n + 1
-        c = n -1
 
-        outfile = outfiles[c]
-        
-        statement = f'''computeMatrix reference-point
-                          -S {job}
-                          -R {bed}
-                          --missingDataAsZero
-                          -bs 10
-                          -a 2500
-                          -b 2500
-                          -p "max"
-                          --samplesLabel {names}
-                          -out {outfile}'''
-
-        P.run(statement)
+@transform(TSSenrichmentTable, suffix(".txt"), ".load")
+def loadTSSenrichment(infile, outfile):
+    A.load(infile, outfile, indexes=["sample_id"])
 
-    
-@transform(TSSmatrix,
-           regex("deeptools.dir/TSS.(.*).matrix.gz"),
-           ["deeptools.dir/TSS.all.profile.png", "deeptools.dir/TSS.size_filt.profile.png"])
+
+@merge(TSSenrichment, ["deeptools.dir/TSS.all.profile.png", "deeptools.dir/TSS.size_filt.profile.png"])
 def TSSprofile(infiles, outfiles):
-    '''Plot profile over TSS'''
+    '''Plot normalised insertion profiles over TSSs'''
 
-    bws = glob.glob("deeptools.dir/*.coverage.bw")
-    if len(bws) <= 6:
-        opts = "--perGroup"
-    else:
-        opts = " "
-        
-    n = 0
-    for infile in infiles:
-        n = n + 1
-        c = n - 1
+    titles = ["All fragments", "Size Filter"]
 
-        titles = ["All fragments", "Size Filter"]
-        title = "TSS enrichment - " + ''.join(titles[c])
-        
-        outfile = outfiles[c]
-        
-        statement = f'''plotProfile
-                           -m {infile}
-                           {opts}
-                           --plotTitle "{title}"
-                           --regionsLabel ""
-                           --yAxisLabel "ATAC signal (RPKM)"
-                           -out {outfile}'''
+    for outfile, group, title in zip(outfiles, ["all", "size_filt"], titles):
+        fig, ax = plt.subplots(figsize=(6, 4))
 
-        P.run(statement)
+        for infile in sorted([x for x in infiles if x.endswith("." + group + ".tss.npz")]):
+            tss = A.readTSSEnrichment(infile)
+            flank = len(tss["norm"]) // 2
+            ax.plot(np.arange(-flank, flank + 1), tss["norm"],
+                    label=os.path.basename(infile).split(".")[0])
 
-        
-@transform(TSSmatrix,
-           regex("deeptools.dir/TSS.(.*).matrix.gz"),
-           ["deeptools.dir/TSS.all.heatmap.png", "deeptools.dir/TSS.size_filt.heatmap.png"])
+        ax.set_title("TSS enrichment - " + title)
+        ax.set_xlabel("Distance to TSS (bp)")
+        ax.set_ylabel("Normalised Tn5 insertions")
+        ax.legend(fontsize="small", frameon=False)
+
+        fig.savefig(outfile, bbox_inches="tight")
+        plt.close(fig)
+
+
+@merge(TSSenrichment, ["deeptools.dir/TSS.all.heatmap.png", "deeptools.dir/TSS.size_filt.heatmap.png"])
 def TSSheatmap(infiles, outfiles):
-    '''Plot profile over TSS'''
+    '''Plot heatmaps of insertions over TSSs, strongest TSSs at the top'''
 
-    bws = glob.glob("deeptools.dir/*.coverage.bw")
+    titles = ["All fragments", "Size Filter"]
 
-    n = 0
-    for infile in infiles:
-        n = n + 1
-        c = n - 1
+    for outfile, group, title in zip(outfiles, ["all", "size_filt"], titles):
+        samples = sorted([x for x in infiles if x.endswith("." + group + ".tss.npz")])
 
-        titles = ["All fragments", "Size Filter"]
-        title = "TSS enrichment - " + ''.join(titles[c])
-        
-        outfile = outfiles[c]
-        
-        statement = f'''plotHeatmap
-                           -m {infile}
-                           --plotTitle "{title}"
-                           --regionsLabel ""
-                           --xAxisLabel ""
-                           --yAxisLabel "ATAC signal (RPKM)"
-                           --heatmapHeight 10
-                           -out {outfile}'''
+        fig, axes = plt.subplots(1, max(len(samples), 1), figsize=(2 * max(len(samples), 1), 6),
+                                 squeeze=False)
+
+        for ax, infile in zip(axes[0], samples):
+            tss = A.readTSSEnrichment(infile)
+            flank = len(tss["norm"]) // 2
+
+            ax.imshow(tss["heatmap"], aspect="auto", cmap="Reds", interpolation="nearest",
+                      extent=[-flank, flank, len(tss["heatmap"]), 0])
+            ax.set_title(os.path.basename(infile).split(".")[0], fontsize="small")
+            ax.set_yticks([])
 
-        P.run(statement)
+        fig.suptitle("TSS enrichment - " + title)
+        fig.savefig(outfile, bbox_inches="tight")
+        plt.close(fig)
 
         
-@follows(TSSprofile, TSSheatmap)
+@follows(TSSprofile, TSSheatmap, loadTSSenrichment)
 def TSSplot():
     pass        
 
 
-@follows(TSSplot)
+@follows(count, TSSplot, mkdir("report.dir"))
+@merge(normaliseBAMcounts, "report.dir/bundle.tsv")
+def reportData(infiles, outfile):
+    '''Write the report data bundle, the tables read by the notebooks queried,
+       joined & pivoted once & saved column-wise as .npz, so the reports only
+       load & plot (see PipelineAtac.writeReportBundle)'''
+
+    A.writeReportBundle(db, infiles, os.path.dirname(outfile))
+
+
+@follows(reportData)
 @files(None, "*.nbconvert.html")
 def report(infile, outfile):
-    '''Generate html report on pipeline results from ipynb template(s)'''
+    '''Generate html report on pipeline results from ipynb template(s), run
+       concurrently with cached cell outputs (see PipelineShared.executeNotebooks)'''
 
     templates = PARAMS["report_path"]
 
     if len(templates)==0:
         print("Specify Jupyter ipynb template path in pipeline.ini for html report generation")
-        pass
-    
-    for template in templates:
-        infile = os.path.basename(template)
-        outfile = infile.replace(".ipynb", ".nbconvert.html")
-        nbconvert = infile.replace(".ipynb", ".nbconvert.ipynb")
-        tmp = os.path.basename(template)
-        
-        statement = f'''cp {template} .  &&
-                        jupyter nbconvert 
-                          --to notebook 
-                          --allow-errors 
-                          --ExecutePreprocessor.timeout=-1
-                          --execute {infile} && 
-                        jupyter nbconvert 
-                          --to html 
-                          --ExecutePreprocessor.timeout=-1
-                          --execute {nbconvert} &&
-                        rm {tmp}'''
-
-        P.run(statement)
+        return
+
+    results = PS.executeNotebooks(templates, PARAMS["report_cache"],
+                                  processes=PARAMS["report_processes"],
+                                  inputs=PARAMS["report_inputs"],
+                                  outputs=PARAMS["report_outputs"],
+                                  execute=PARAMS["report_execute"])
+
+    for html, cached, cells in results:
+        E.info("report: %s, %i of %i code cells from cache" % (html, cached, cells))
     
 
 # ---------------------------------------------------
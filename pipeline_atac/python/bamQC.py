@@ -0,0 +1,32 @@
+#!usr/bin.python
+import sys
+from argparse import ArgumentParser
+import os
+
+# add parent dir to python path
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import PipelineAtac as A
+
+####### Parse commandline arguments
+parser = ArgumentParser(prog="bamQC")
+parser.add_argument("--infile", help="BAM file", required=True)
+parser.add_argument("--flagstats", help="samtools flagstat style outfile", required=True)
+parser.add_argument("--alignment_summary", help="Picard CollectAlignmentSummaryMetrics style outfile", required=True)
+parser.add_argument("--insert_metrics", help="Picard CollectInsertSizeMetrics style outfile (PE only)", default=None)
+parser.add_argument("--insert_histogram", help="Picard insert size histogram outfile (PE only)", default=None)
+parser.add_argument("--contigs", help="samtools idxstats style outfile", default=None)
+parser.add_argument("--name", help="sample name for the contigs table", default=None)
+parser.add_argument("--threads", help="BGZF decompression threads", default=2, type=int)
+args = parser.parse_args()
+
+# run job, one pass over the BAM for all QC tables
+qc = A.collectBamQC(args.infile, args.threads)
+
+A.writeFlagstat(qc, args.flagstats)
+A.writeAlignmentSummary(qc, args.alignment_summary)
+
+if args.insert_metrics:
+    A.writeInsertSizes(qc, args.insert_metrics, args.insert_histogram)
+
+if args.contigs:
+    A.writeContigCounts(qc, args.contigs, args.name)
@@ -0,0 +1,37 @@
+#!usr/bin.python
+import sys
+from argparse import ArgumentParser
+import os
+
+# add parent dir to python path
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import PipelineAtac as A
+
+####### Parse commandline arguments
+parser = ArgumentParser(prog="countMatrix")
+parser.add_argument("--peaks", help="closestGene.bed peak file", required=True)
+parser.add_argument("--indexes", help="comma seperated Tn5 insertion index directories (insertionIndex.py)", required=True)
+parser.add_argument("--outfile", help="Name of .npz count matrix to be written", required=True)
+parser.add_argument("--table", help="also write a wide loadable table here", default=None)
+parser.add_argument("--processes", help="number of samples counted in parallel", default=4, type=int)
+parser.add_argument("--previous", help="previous .npz count matrix, only new samples & peaks are counted", default=None)
+args = parser.parse_args()
+
+indexes = [x for x in args.indexes.split(",") if len(x) > 0]
+
+# sample names are index directories without .prep.tn5, as prep BAMs
+samples = [os.path.basename(x.rstrip("/"))[:-len(".prep.tn5")] for x in indexes]
+
+# run job
+peaks = A.readPeaks(args.peaks)
+
+if args.previous:
+    counts, counted = A.updateCountMatrix(peaks, indexes, samples, args.previous, args.processes)
+    print("countMatrix: counted %i of %i peaks x samples" % (counted, counts.size))
+else:
+    counts = A.countMatrix(peaks, indexes, args.processes)
+
+A.writeCountMatrix(args.outfile, peaks, samples, counts)
+
+if args.table:
+    A.writeCountTable(args.table, peaks, samples, counts)
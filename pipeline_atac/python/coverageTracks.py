@@ -0,0 +1,29 @@
+#!usr/bin.python
+import sys
+from argparse import ArgumentParser
+import os
+
+# add parent dir to python path
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import PipelineAtac as A
+
+####### Parse commandline arguments
+parser = ArgumentParser(prog="coverageTracks")
+parser.add_argument("--index", help="Tn5 insertion index directory", required=True)
+parser.add_argument("--outprefix", help="bigwig path prefix, track suffixes are added", required=True)
+parser.add_argument("--tracks", help="comma seperated tracks (coverage,nfr,nucleosome,insertions)",
+                    default="coverage,insertions")
+parser.add_argument("--binsize", help="bin size (bp)", default=5, type=int)
+parser.add_argument("--smooth", help="moving average window (bp)", default=20, type=int)
+parser.add_argument("--nfr", help="nucleosome free fragments are < nfr bp", default=100, type=int)
+parser.add_argument("--mononuc_min", help="minimum mononucleosome fragment length (bp)", default=150, type=int)
+parser.add_argument("--mononuc_max", help="mononucleosome fragments are < mononuc_max bp", default=300, type=int)
+parser.add_argument("--extend", help="single end read extension (bp)", default=200, type=int)
+parser.add_argument("--processes", help="contigs binned in parallel", default=4, type=int)
+args = parser.parse_args()
+
+fragments = {"nfr": (0, args.nfr), "nucleosome": (args.mononuc_min, args.mononuc_max)}
+
+# run job
+A.coverageTracks(args.index, args.outprefix, args.tracks.split(","), args.binsize, args.smooth,
+                 fragments, args.extend, args.processes)
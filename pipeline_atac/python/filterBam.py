@@ -0,0 +1,30 @@
+#!usr/bin.python
+import sys
+from argparse import ArgumentParser
+import os
+
+# add parent dir to python path
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import PipelineAtac as A
+
+####### Parse commandline arguments
+parser = ArgumentParser(prog="filterBam")
+parser.add_argument("--infile", help="Coordinate sorted & indexed BAM, or - to filter a SAM/BAM stream on stdin", required=True)
+parser.add_argument("--outfile", help="Name of filtered BAM to be written, or - for uncompressed BAM on stdout", required=True)
+parser.add_argument("--mapq", help="minimum MAPQ", default=10, type=int)
+parser.add_argument("--exclude", help="comma seperated contigs to remove", default="chrM")
+parser.add_argument("--threads", help="BGZF compression threads", default=2, type=int)
+parser.add_argument("--genome", help="stream mode only, also write all (unfiltered) reads here", default=None)
+parser.add_argument("--processes", help="split by contig across n processes (requires index)", default=1, type=int)
+parser.add_argument("--tmpdir", help="directory for per contig shards", default=None)
+args = parser.parse_args()
+
+exclude = [x for x in args.exclude.split(",") if len(x) > 0]
+
+# run job
+if args.infile == "-":
+    A.filterBamStream(args.infile, args.outfile, args.mapq, exclude, args.genome)
+elif args.processes > 1:
+    A.filterBamSharded(args.infile, args.outfile, args.mapq, exclude, args.processes, args.tmpdir)
+else:
+    A.filterBam(args.infile, args.outfile, args.mapq, exclude, args.threads)
@@ -0,0 +1,36 @@
+#!usr/bin.python
+import sys
+from argparse import ArgumentParser
+import os
+
+# add parent dir to python path
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import PipelineAtac as A
+
+####### Parse commandline arguments
+parser = ArgumentParser(prog="filterPeaks")
+parser.add_argument("--infiles", help="comma seperated peak files (BED-like)", default="")
+parser.add_argument("--outfiles", help="comma seperated filtered peak files, in infile order", default="")
+parser.add_argument("--blacklists", help="comma seperated blacklist BED files (may be gzipped)", required=True)
+parser.add_argument("--cache", help="blacklist cache directory", required=True)
+parser.add_argument("--genome", help="genome the blacklists are for, e.g. mm10", required=True)
+parser.add_argument("--add", help="only add the blacklists (URLs or paths) to the cache, e.g. on a node with internet access",
+                    action="store_true")
+args = parser.parse_args()
+
+blacklists = [x for x in args.blacklists.split(",") if len(x) > 0]
+
+# run job
+if args.add:
+    for blacklist in blacklists:
+        A.cachedBlacklist(blacklist, args.cache, args.genome)
+else:
+    infiles = [x for x in args.infiles.split(",") if len(x) > 0]
+    outfiles = [x for x in args.outfiles.split(",") if len(x) > 0]
+
+    if len(infiles) != len(outfiles):
+        raise ValueError("filterPeaks: %i infiles but %i outfiles" % (len(infiles), len(outfiles)))
+
+    index_dirs = [A.blacklistIndex(x, args.cache, args.genome) for x in blacklists]
+
+    A.filterPeakFiles(infiles, outfiles, index_dirs)
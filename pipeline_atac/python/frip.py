@@ -0,0 +1,29 @@
+#!usr/bin.python
+import sys
+from argparse import ArgumentParser
+import os
+
+# add parent dir to python path
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import PipelineAtac as A
+
+####### Parse commandline arguments
+parser = ArgumentParser(prog="frip")
+parser.add_argument("--index", help="Tn5 insertion index of the samples all fragments prep BAM", required=True)
+parser.add_argument("--sample", help="sample_id written to the FRIP table", required=True)
+parser.add_argument("--all_peaks", help="peaks called on all fragments", default=None)
+parser.add_argument("--size_filt_peaks", help="peaks called on fragments < insert_size", default=None)
+parser.add_argument("--insert_size", help="maximum fragment size of the size filtered BAM (b.p.)", default=150, type=int)
+parser.add_argument("--outfile", help="Name of FRIP table rows to be written", required=True)
+args = parser.parse_args()
+
+peaksets = []
+
+if args.all_peaks:
+    peaksets.append((args.all_peaks, None, "all_fragments"))
+
+if args.size_filt_peaks:
+    peaksets.append((args.size_filt_peaks, args.insert_size, "<%ibp" % args.insert_size))
+
+# run job, both peak sets in one pass over the index
+A.writeFrip(args.index, peaksets, args.sample, args.outfile)
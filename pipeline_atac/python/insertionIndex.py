@@ -0,0 +1,18 @@
+#!usr/bin.python
+import sys
+from argparse import ArgumentParser
+import os
+
+# add parent dir to python path
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import PipelineAtac as A
+
+####### Parse commandline arguments
+parser = ArgumentParser(prog="insertionIndex")
+parser.add_argument("--infile", help="prep BAM file", required=True)
+parser.add_argument("--outdir", help="directory to write the insertion index to", required=True)
+parser.add_argument("--threads", help="BGZF decompression threads", default=2, type=int)
+args = parser.parse_args()
+
+# run job
+A.buildInsertionIndex(args.infile, args.outdir, args.threads)
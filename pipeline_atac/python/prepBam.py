@@ -0,0 +1,31 @@
+#!usr/bin.python
+import sys
+from argparse import ArgumentParser
+import os
+
+# add parent dir to python path
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import PipelineAtac as A
+
+####### Parse commandline arguments
+parser = ArgumentParser(prog="prepBam")
+parser.add_argument("--infile", help="Coordinate sorted BAM, or - for stdin", required=True)
+parser.add_argument("--outfile", help="Name of BAM with all fragments to be written", required=True)
+parser.add_argument("--size_outfile", help="Name of BAM of fragments < insert_size to be written (PE only)", default=None)
+parser.add_argument("--insert_size", help="maximum fragment size for size_outfile (b.p.)", default=150, type=int)
+parser.add_argument("--threads", help="BGZF compression threads", default=2, type=int)
+parser.add_argument("--metrics", help="remove duplicates & write Picard style duplication metrics here", default=None)
+parser.add_argument("--processes", help="split by contig across n processes (requires index)", default=1, type=int)
+parser.add_argument("--tmpdir", help="directory for per contig shards", default=None)
+args = parser.parse_args()
+
+# run job
+if args.processes > 1:
+    A.writePrepBamsSharded(args.infile, args.outfile, args.size_outfile, args.insert_size,
+                           args.metrics, args.processes, args.tmpdir)
+else:
+    metrics = A.writePrepBams(args.infile, args.outfile, args.size_outfile, args.insert_size,
+                              args.threads, args.metrics is not None)
+
+    if args.metrics:
+        A.writeDuplicationMetrics(metrics, args.metrics, args.infile)
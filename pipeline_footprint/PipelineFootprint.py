@@ -7,6 +7,9 @@ import glob
 import pandas as pd
 import sqlite3
 import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipeline_shared"))
+import PipelineShared as PS
 
 # Pipeline configuration
 P.get_parameters(
@@ -42,26 +45,19 @@ def connect():
 
 
 
-def fetch_DataFrame(query,
-                    dbhandle=db):
-    '''Fetch query results and returns them as a pandas dataframe'''
+def fetch_DataFrame(query, dbhandle=db, **kwargs):
+    '''Fetch query results and returns them as a pandas dataframe, over a
+       cached read-only connection (see PipelineShared.fetch_DataFrame)'''
 
-    dbhandle = sqlite3.connect(dbhandle)
+    return PS.fetch_DataFrame(query, dbhandle, **kwargs)
 
-    cc = dbhandle.cursor()
-    sqlresult = cc.execute(query).fetchall()
-    cc.close()
 
-    # see http://pandas.pydata.org/pandas-docs/dev/generated/
-    # pandas.DataFrame.from_records.html#pandas.DataFrame.from_records
-    # this method is design to handle sql_records with proper type
-    # conversion
+def load(infiles, outfile, **kwargs):
+    '''Load tab-separated infile(s) into the database through the
+       single-writer load queue (see PipelineShared.load)'''
 
-    field_names = [d[0] for d in cc.description]
-    pandas_DataFrame = pd.DataFrame.from_records(
-        sqlresult,
-        columns=field_names)
-    return pandas_DataFrame
+    return PS.load(infiles, outfile, PARAMS["load_queue"], db,
+                   batch=PARAMS["load_batch"], **kwargs)
 
 
 # ---------------------------------------------------
@@ -187,7 +187,7 @@ def getReadCounts(infile, outfile):
 def loadReadCounts(infile, outfile):
     '''load total read counts'''
     
-    P.load(infile, outfile, options='-H "sample,total_reads" ')
+    F.load(infile, outfile, header=["sample", "total_reads"])
 
 
 def coverageBedGenerator():
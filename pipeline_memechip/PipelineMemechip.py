@@ -49,6 +49,7 @@ Code
 """
 from ruffus import *
 
+import sys
 import os
 import math
 import glob  
@@ -59,6 +60,8 @@ import sqlite3
 import gzip
 import pandas as pd
 import pybedtools
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipeline_shared"))
+import PipelineShared as PS
 
 # -----------------------------------------------
 # Pipeline configuration
@@ -72,30 +75,45 @@ PARAMS = P.PARAMS
 
 db = PARAMS['database']['url'].split('./')[1]
 
+# columns of tomtom.txt (meme & dreme motifs vs. motif databases)
+TOMTOM_COLUMNS = ["query_id", "target_id", "optimal_offset", "p_value", "e_value", "q_value",
+                  "overlap", "query_consensus", "targe_consensus", "orientation"]
+
 
 #######################################################################
 ########### Key helper functions ######################################
 #######################################################################
-def fetch_DataFrame(query,
-                    dbhandle=db):
-    '''Fetch query results and returns them as a pandas dataframe'''
+def fetch_DataFrame(query, dbhandle=db, **kwargs):
+    '''Fetch query results and returns them as a pandas dataframe, over a
+       cached read-only connection (see PipelineShared.fetch_DataFrame)'''
 
-    dbhandle = sqlite3.connect(dbhandle)
+    return PS.fetch_DataFrame(query, dbhandle, **kwargs)
+
+
+def load(infiles, outfile, **kwargs):
+    '''Load tab-separated infile(s) into the database through the
+       single-writer load queue (see PipelineShared.load)'''
+
+    return PS.load(infiles, outfile, PARAMS["load_queue"], db,
+                   batch=PARAMS["load_batch"], **kwargs)
+
+
+def queueStatement(infiles, outfile, tablename=None, **kwargs):
+    '''Statement queueing infile(s) for loading in a cluster job, for
+       large tables (see PipelineShared.queueStatement). Run it, then
+       loadQueued(outfile) commits the table'''
+
+    if tablename is None:
+        tablename = PS.tableName(outfile)
+
+    return PS.queueStatement(infiles, outfile + ".queued", PARAMS["load_queue"], tablename, **kwargs)
 
-    cc = dbhandle.cursor()
-    sqlresult = cc.execute(query).fetchall()
-    cc.close()
 
-    # see http://pandas.pydata.org/pandas-docs/dev/generated/
-    # pandas.DataFrame.from_records.html#pandas.DataFrame.from_records
-    # this method is design to handle sql_records with proper type
-    # conversion
+def loadQueued(outfile):
+    '''Commit a table queued by a queueStatement job'''
 
-    field_names = [d[0] for d in cc.description]
-    pandas_DataFrame = pd.DataFrame.from_records(
-        sqlresult,
-        columns=field_names)
-    return pandas_DataFrame
+    return PS.loadQueued(outfile + ".queued", outfile, PARAMS["load_queue"], db,
+                         batch=PARAMS["load_batch"])
 
 
 def execute(queries, database=db, attach=False):
@@ -296,109 +314,12 @@ def writeAnnotations(annotations,outfile,ids=False):
 ####
 def writeGreat(locations,basalup,basaldown,maxext,outfile,half=False):
     ''' write out a bed file of great promoters from input gene locations
-         locations is [contig,gstart,gend,strand,gene_id] '''
+         locations is [contig,gstart,gend,strand,gene_id] or a DataFrame '''
 
-    # Gene regulatory domain definition: 
-    # Each gene is assigned a basal regulatory domain of a 
-    # minimum distance upstream and downstream of the TSS 
-    # (regardless of other nearby genes). 
-    # The gene regulatory domain is extended in both directions 
-    # to the nearest gene's basal domain but no more than the 
-    # maximum extension in one direction
+    PS.writeGreat(locations, basalup, basaldown, maxext, outfile, half,
+                  contigs=PARAMS["annotations_mm10dir"]+"/assembly.dir/contigs.bed.gz",
+                  cache=PARAMS.get("great_cache"))
 
-    genome = {}
-    for location in locations:
-        chrom, gstart, gend, strand_int, gid = location
-        if strand_int == -1: 
-            strand = "minus" 
-            tss = gend
-        else: 
-            strand = "plus"
-            tss = gstart
-        record = [tss,strand,gid]
-        if chrom[3:5]=="NT" or chrom[0:2]=="MT": continue
-        if chrom not in genome: 
-            genome[chrom] = [ record ]
-        else: genome[chrom].append(record)
-
-    #add the ends of the chromosomes
-    contigs = gzip.open(PARAMS["annotations_dir"]+"/assembly.dir/contigs.bed.gz","r")
-
-    
-    nmatched = 0
-    for contig_entry in contigs:
-        contig, start, end = contig_entry.strip().split("\t")
-        
-        if contig in genome.keys():
-            genome[contig].append([int(end),"end","end"])
-            nmatched+=1
-    if nmatched < 21:
-        raise ValueError("writeGreat: not enough chromosome ends registered")
-
-    #sort the arrays
-    for key in genome.keys():
-        genome[key].sort( key = lambda entry: entry[0] )
-        
-    #now we can walk over the regions and make the regulatory regions.
-
-    greatBed = []
-   
-    for contig in genome.keys():
-
-        locs = genome[contig]
-        contig_end = locs[-1][0]
-        for i in range(0,len(locs)):
-
-            l,strand,gid = locs[i]
-
-            if strand == "end": continue
-
-            #get the positions of the neighbouring basal domains.
-
-            # - upstream
-            if i == 0: frontstop = 0
-            else:
-                pl, pstrand, pgid = locs[i-1]
-                if pstrand == "plus": frontstop = pl + basaldown
-                else: frontstop = pl + basalup
-            # - downstream
-            nl, nstrand, ngid = locs[i+1]
-            if nstrand == "plus": backstop = nl - basalup
-            else: backstop = nl - basaldown
-
-            # define basal domain
-            if strand=="plus":
-                basalstart = l - basalup
-                basalend = min( l + basaldown, contig_end )
-            else:
-                basalstart = l - basaldown
-                basalend = min( l + basalup, contig_end )
-
-            # upstream extension
-            if frontstop > basalstart:
-                regstart = basalstart
-            else:
-                if half == True:
-                    frontext = min( maxext, (l - frontstop) / 2 )
-                else:
-                    frontext = min( maxext, l - frontstop )
-                regstart = l - frontext
-
-            # downstream extension
-            if backstop < basalend:
-                regend = basalend
-            else:
-                if half == True:
-                    backext = min( maxext, ( backstop - l ) / 2 )
-                else:
-                    backext = min( maxext, backstop - l )
-                regend = l + backext
-
-            greatBed.append(["chr"+contig,str(regstart),str(regend),gid])
-        
-    outfh = open(outfile,"w")
-    outfh.write("\n".join(["\t".join(x) for x in greatBed])+"\n")
-    outfh.close()
 
 def biomart_iterator( attributes,
                       filters,
@@ -82,6 +82,7 @@ from cgatcore import pipeline as P
 import cgat.FastaIterator
 
 import PipelineMemechip as S
+import PipelineShared as PS
 
 import sys, tempfile 
 import glob, os 
@@ -343,21 +344,13 @@ def loadMemeTomTomGenerator():
 def loadMemeTomTom(infile, outfile):
     '''load meme tomtom results'''
 
-    # cgat default is not to submit P.load() jobs to cluster
-    # this is hardcoded in P.load()
+    # the table is parsed & queued in a cluster job, then committed through the
+    # single-writer load queue (tomtom header & trailing comments start with "#")
+    statement = S.queueStatement(infile, outfile, header=S.TOMTOM_COLUMNS, comment="#")
 
-    tablename = os.path.basename(outfile).replace(".load", "").replace(".", "_")
-    options='-H "query_id,target_id,optimal_offset,p_value,e_value,q_value,overlap,query_consensus,targe_consensus,orientation" '
+    P.run(statement, job_memory="4G")
 
-    statement = []
-    statement.append('''cat %(infile)s | ''')
-    statement.append(P.build_load_statement(tablename, options=options, retry=True) )
-    statement.append(''' > %(outfile)s''')
-    statement = ' '.join(statement)
-    
-    to_cluster = True
-
-    P.run(statement)
+    S.loadQueued(outfile)
     
     
 def loadDremeTomTomGenerator():
@@ -386,18 +379,11 @@ def loadDremeTomTomGenerator():
 def loadDremeTomTom(infile, outfile):
     '''load dreme tomtom results'''
 
-    to_cluster = True
+    statement = S.queueStatement(infile, outfile, header=S.TOMTOM_COLUMNS, comment="#")
 
-    tablename = os.path.basename(outfile).replace(".load", "").replace(".", "_")
-    options = '-H "query_id,target_id,optimal_offset,p_value,e_value,q_value,overlap,query_consensus,targe_consensus,orientation" '
+    P.run(statement, job_memory="4G")
 
-    statement = []
-    statement.append('''cat %(infile)s | ''')
-    statement.append(P.build_load_statement(tablename, options=options, retry=True) )
-    statement.append(''' > %(outfile)s''')
-    statement = ' '.join(statement)
-    
-    P.run(statement)
+    S.loadQueued(outfile)
 
     
 def summarizeFimoGenerator():
@@ -464,19 +450,13 @@ def summarizeFimo(infiles, outfile):
     
 @transform(summarizeFimo, suffix(".txt"), ".load")
 def loadFimo(infile, outfile):
-    
-    to_cluster = True
+    statement = S.queueStatement(infile, outfile,
+                                 header=["pattern_name", "sequence_name", "start", "stop", "strand",
+                                         "score", "p_value", "q_value", "matched_sequence"])
 
-    tablename = os.path.basename(outfile).replace(".load", "").replace(".", "_")
-    options='-H "pattern_name,sequence_name,start,stop,strand,score,p_value,q_value,matched_sequence" '
+    P.run(statement, job_memory="4G")
 
-    statement = []
-    statement.append(f'''cat {infile} | ''')
-    statement.append(P.build_load_statement(tablename, options=options, retry=True) )
-    statement.append(f''' > {outfile}''')
-    statement = ' '.join(statement)
-    
-    P.run(statement)
+    S.loadQueued(outfile)
 
     
 @follows(runMemeChIP, loadMemeTomTom, loadDremeTomTom, loadFimo)
@@ -584,35 +564,24 @@ def runHomerAnalysis():
 @follows(runMemeAnalysis)
 @files(None, "*.nbconvert.html")
 def report(infile, outfile):
-    '''Generate html report on pipeline results from ipynb template(s)'''
+    '''Generate html report on pipeline results from ipynb template(s), run
+       concurrently with cached cell outputs (see PipelineShared.executeNotebooks)'''
 
     templates = PARAMS["report_path"]
 
     if len(templates)==0:
         print("Specify Jupyter ipynb template path in pipeline.ini for html report generation")
-        pass
+        return
 
-    for template in templates:
-        infile = os.path.basename(template)
-        outfile = infile.replace(".ipynb", ".nbconvert.html")
-        nbconvert = infile.replace(".ipynb", ".nbconvert.ipynb")
-        tmp = os.path.basename(template)
-    
-        statement = f'''cp {template} .  &&
-                        jupyter nbconvert 
-                          --to notebook 
-                          --allow-errors 
-                          --ExecutePreprocessor.timeout=None
-                          --ExecutePreprocessor.kernel_name=python3
-                          --execute {infile} &&
-                        jupyter nbconvert 
-                          --to html 
-                          --ExecutePreprocessor.timeout=None
-                          --ExecutePreprocessor.kernel_name=python3
-                          --execute {nbconvert} &&
-                        rm {tmp}'''
+    results = PS.executeNotebooks(templates, PARAMS["report_cache"],
+                                  processes=PARAMS["report_processes"],
+                                  kernel="python3",
+                                  inputs=PARAMS["report_inputs"],
+                                  outputs=PARAMS["report_outputs"],
+                                  execute=PARAMS["report_execute"])
 
-        P.run(statement)
+    for html, cached, cells in results:
+        L.info("report: %s, %i of %i code cells from cache" % (html, cached, cells))
 
         
 @follows(runMemeAnalysis, runHomerAnalysis)
@@ -817,18 +786,12 @@ def runMast(infiles, outfile):
 def loadPeaks(infile, outfile):
     '''Load input peaks to merge w/ MAST results by peak_id'''
 
-    tablename = os.path.basename(outfile).replace(".load", "").replace(".", "_")
-    options='-H "contig,start,end,peak_id,score" '
+    statement = S.queueStatement(infile, outfile, header=["contig", "start", "end", "peak_id", "score"],
+                                 usecols=list(range(5)))
 
-    statement = []
-    statement.append(f'''cat {infile} | cut -f1-5 - |''')
-    statement.append(P.build_load_statement(tablename, options=options, retry=True) )
-    statement.append(f''' > {outfile}''')
-    statement = ' '.join(statement)
-    
-    to_cluster = True
+    P.run(statement, job_memory="4G")
 
-    P.run(statement)
+    S.loadQueued(outfile)
 
     
 @follows(loadPeaks, mkdir("query_motifs.dir/mast.beds.dir/"))
@@ -841,19 +804,22 @@ def loadMast(infile, outfile):
     
     tmp_dir = "$SCRATCH_DIR"
     tablename = "MAST_" + outfile.split("/")[-2].replace(".", "_")
-    options='-H "peak_id,e_value,length" '
-
-    statement = []
-    statement.append(f'''tmp=`mktemp -p {tmp_dir}` &&
-                         sed -n '/^SECTION I:/,/^SECTION II:/p' {infile} | 
-                           grep "^[a-zA-Z0-9].*[0-9]$" - | 
-                           tr -s "[[:blank:]]" "\\t" 
-                           > $tmp &&
-                         cat $tmp ''')
-    statement.append(P.build_load_statement(tablename, options=options, retry=True))
-    statement = ' | '.join(statement) + f''' > {outfile} && rm $tmp'''
+    section = outfile.replace(".load", ".section1.txt")
 
-    P.run(statement)
+    # the section is queued for loading in the same job
+    queue = S.queueStatement(section, outfile, tablename=tablename, header=["peak_id", "e_value", "length"])
+
+    statement = f'''tmp=`mktemp -p {tmp_dir}` &&
+                    sed -n '/^SECTION I:/,/^SECTION II:/p' {infile} | 
+                      grep "^[a-zA-Z0-9].*[0-9]$" - | 
+                      tr -s "[[:blank:]]" "\\t" 
+                      > $tmp &&
+                    mv $tmp {section} &&
+                    {queue}'''
+
+    P.run(statement, job_memory="4G")
+
+    S.loadQueued(outfile)
     
     
 @transform(loadMast,
@@ -930,7 +896,7 @@ def motifTable(infile, outfile):
 
 @transform(motifTable, suffix(".txt"), r".load")
 def loadmotifTable(infile, outfile):
-    P.load(infile, outfile, options='-H "motif_id,motif_name,motif_no" ')
+    S.load(infile, outfile, header=["motif_id", "motif_name", "motif_no"])
 
     
 @follows(loadmotifTable)
@@ -981,7 +947,8 @@ def HitList_table(infile, outfile):
            r"query_motifs.dir/mast.results.dir/\1/mast.hit_list.table.load")
 def loadHitList_table(infile, outfile):
     table = "MASThitlist_" + infile.split("/")[2]
-    P.load(infile, outfile, tablename=table , options=' -H "peak_id,strand,motif_no,hit_start,hit_end,score,hit_p_value" ')
+    S.load(infile, outfile, tablename=table,
+           header=["peak_id", "strand", "motif_no", "hit_start", "hit_end", "score", "hit_p_value"])
 
     
 @follows(loadHitList_table)
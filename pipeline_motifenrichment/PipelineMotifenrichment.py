@@ -6,6 +6,8 @@ import cgatcore.experiment as E
 from cgatcore import pipeline as P
 import glob
 import pandas as pd
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipeline_shared"))
+import PipelineShared as PS
 
 # Pipeline configuration
 P.get_parameters(
@@ -31,23 +33,34 @@ def fetch(query, dbhandle=None, attach=False):
     return sqlresult
 
 
-def fetch_DataFrame(query,
-                    dbhandle=db):
-    '''Fetch query results and returns them as a pandas dataframe'''
+def fetch_DataFrame(query, dbhandle=db, **kwargs):
+    '''Fetch query results and returns them as a pandas dataframe, over a
+       cached read-only connection (see PipelineShared.fetch_DataFrame)'''
 
-    dbhandle = sqlite3.connect(dbhandle)
+    return PS.fetch_DataFrame(query, dbhandle, **kwargs)
+
+
+def load(infiles, outfile, **kwargs):
+    '''Load tab-separated infile(s) into the database through the
+       single-writer load queue (see PipelineShared.load)'''
+
+    return PS.load(infiles, outfile, PARAMS["load_queue"], db,
+                   batch=PARAMS["load_batch"], **kwargs)
+
+
+def queueStatement(infiles, outfile, tablename=None, **kwargs):
+    '''Statement queueing infile(s) for loading in a cluster job, for
+       large tables (see PipelineShared.queueStatement). Run it, then
+       loadQueued(outfile) commits the table'''
+
+    if tablename is None:
+        tablename = PS.tableName(outfile)
+
+    return PS.queueStatement(infiles, outfile + ".queued", PARAMS["load_queue"], tablename, **kwargs)
 
-    cc = dbhandle.cursor()
-    sqlresult = cc.execute(query).fetchall()
-    cc.close()
 
-    # see http://pandas.pydata.org/pandas-docs/dev/generated/
-    # pandas.DataFrame.from_records.html#pandas.DataFrame.from_records
-    # this method is design to handle sql_records with proper type
-    # conversion
+def loadQueued(outfile):
+    '''Commit a table queued by a queueStatement job'''
 
-    field_names = [d[0] for d in cc.description]
-    pandas_DataFrame = pd.DataFrame.from_records(
-        sqlresult,
-        columns=field_names)
-    return pandas_DataFrame
+    return PS.loadQueued(outfile + ".queued", outfile, PARAMS["load_queue"], db,
+                         batch=PARAMS["load_batch"])
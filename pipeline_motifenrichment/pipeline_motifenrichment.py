@@ -158,8 +158,7 @@ def offsetPeaks(infile, outfile):
 def loadPeaks(infile, outfile):
     '''load peak intervals'''
 
-    # change this task to submit statement to cluster
-    P.load(infile, outfile, options='-H "chr,start,end,peak_id" ')
+    M.load(infile, outfile, header=["chr", "start", "end", "peak_id"])
     
 
 @follows(loadPeaks)
@@ -278,7 +277,6 @@ def getMotifIDs(infile, outfile):
 
     tablename = os.path.basename(infile).replace(".txt", "").replace(".", "_")
     filename = outfile.replace(".load", ".txt")
-    options='-H "pattern_name,TF" '
 
     statement = []
     statement.append(f'''tmp=`mktemp -p {tmp_dir}` &&
@@ -293,21 +291,17 @@ def getMotifIDs(infile, outfile):
                             sed 's/_//' |
                             tr -s "[[:blank:]]" "\\t" 
                             > $tmp && 
-                            cat $tmp | ''')
+                            mv $tmp {filename}''')
 
     # use sed to remove problematic chars e.g. ".", "(" etc. from motif names
-    
-    statement.append(P.build_load_statement(tablename, options=options, retry=True) )
-    
-    statement.append(f''' > {outfile} &&
-                         mv $tmp {filename}''')
 
     statement = ' '.join(statement)
-    
-    to_cluster = True
 
     P.run(statement)
 
+    M.load(filename, outfile, tablename=tablename, header=["pattern_name", "TF"],
+           usecols=range(2))
+
         
 @follows(getMotifIDs)
 @active_if(bool(glob.glob("data.dir/*.meme")))
@@ -453,22 +447,23 @@ def loadFimo(infile, outfile):
     fimo_result = infile.replace(".fimo.log", "/fimo.txt")
 
     # escape clause if fimo fails to find motifs
-    if len(pd.read_csv(fimo_result, sep="\t"))==0:
+    if len(pd.read_csv(fimo_result, sep="\t", nrows=1))==0:
         statement = f'''echo "file {fimo_result} empty" '''
 
+        P.run(statement)
+
     else:
         tablename = '_'.join([outfile.split("/")[1], "fimo_results"]).replace(".", "_")
-        opts='-H "pattern_name,sequence_name,start,stop,strand,score,p_value,q_value,matched_sequence" '
 
-        statement = []
-        statement.append(f'''grep -v "#" {fimo_result} | ''')
-        statement.append(P.build_load_statement(tablename, options=opts, retry=True) )
-        statement.append(f''' > {outfile}''')
-        statement = ' '.join(statement)
-                    
-        to_cluster = True
+        # parsed & queued in a cluster job, the fimo header starts with "#"
+        statement = M.queueStatement(fimo_result, outfile, tablename=tablename, comment="#",
+                                     header=["pattern_name", "sequence_name", "start", "stop",
+                                             "strand", "score", "p_value", "q_value",
+                                             "matched_sequence"])
+
+        P.run(statement, job_memory="4G")
 
-    P.run(statement, job_memory="4G")
+        M.loadQueued(outfile)
     
 
 @follows(loadFimo)
@@ -2,14 +2,15 @@
 import sys
 from argparse import ArgumentParser
 import pandas as pd
+import numpy as np
 import os
 
 # import inspect
 # currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 # parentdir = os.path.dirname(currentdir)
 # sys.path.insert(0,parentdir)
-sys.path.insert(1, os.path.join(sys.path[0], '..'))
-import PipelineMotifenrichment as m
+sys.path.insert(1, os.path.join(sys.path[0], '..', '..', 'pipeline_shared'))
+import PipelineShared as PS
 
 ####### Parse commandline arguments
 parser = ArgumentParser(prog="fimoBED")
@@ -50,23 +51,30 @@ def fimoBed(infile, outfiles, db):
                    where a.sequence_name = b.peak_id '''
         # added pseudo TF column so motifs from custom meme file will be seperated
         
-    df = m.fetch_DataFrame(query, db)
+    # results are streamed in chunks, so the join is never held in memory
+    bed_columns = ["chr", "start", "end", "sequence_name", "score", "strand", "TF"]
+    motifs = []
 
-    # make sure multiple motifs for single TF aren't merged
-    df["TF"] = df.apply(lambda x: '_'.join([x.TF, x.pattern_name]) if x.TF != x.pattern_name else x.TF, axis=1) 
-    motifs = df["TF"].unique()
+    for n, df in enumerate(PS.iterQuery(query, db)):
+        # make sure multiple motifs for single TF aren't merged
+        df["TF"] = np.where(df["TF"] != df["pattern_name"], df["TF"] + "_" + df["pattern_name"], df["TF"])
 
-    if len(motifs) > 1:
-        # if multiple TFs were searched for generate seperate BED & summary file for each one
-        for motif in motifs:
-            res = df[df["TF"] == motif]
+        # seperate BED & summary file for each TF, removed below if only one was searched for
+        for motif, res in df.groupby("TF", sort=False):
             mtable = table.replace("_summary.txt", "_") + str(motif) + "_summary.txt"
             mbed = bed.replace(".bed", "_") + str(motif) + ".bed"
-            res.to_csv(mtable, sep="\t", index=False)
-            res[["chr", "start", "end", "sequence_name", "score", "strand", "TF"]].to_csv(mbed, sep="\t", header=None, index=False)
+            new = motif not in motifs
+            if new:
+                motifs.append(motif)
+            res.to_csv(mtable, sep="\t", index=False, header=new, mode="w" if new else "a")
+            res[bed_columns].to_csv(mbed, sep="\t", header=None, index=False, mode="w" if new else "a")
 
-    df.to_csv(table, sep="\t", index=False)
-    df[["chr", "start", "end", "sequence_name", "score", "strand", "TF"]].to_csv(bed, sep="\t", header=None, index=False)
+        df.to_csv(table, sep="\t", index=False, header=n == 0, mode="w" if n == 0 else "a")
+        df[bed_columns].to_csv(bed, sep="\t", header=None, index=False, mode="w" if n == 0 else "a")
+
+    if len(motifs) == 1:
+        os.remove(table.replace("_summary.txt", "_") + str(motifs[0]) + "_summary.txt")
+        os.remove(bed.replace(".bed", "_") + str(motifs[0]) + ".bed")
 
 
 # run job
@@ -0,0 +1,1261 @@
+'''Helper functions shared by the pipelines. Functions here take all
+   configuration as arguments, they do not read a pipeline.yml'''
+
+import os
+import re
+import glob
+import json
+import time
+import fcntl
+import pickle
+import fnmatch
+import hashlib
+import shlex
+import shutil
+import sqlite3
+import tempfile
+import itertools
+import contextlib
+import multiprocessing
+import urllib.parse
+import numpy as np
+import pandas as pd
+
+
+#####################################################
+####      Database access                        ####
+#####################################################
+
+# pragmas of the read-only csvdb connections: memory mapped reads (1Gb),
+# a 256Mb page cache & no writes
+DB_PRAGMAS = {"mmap_size": 2**30, "cache_size": -256 * 1024, "query_only": 1}
+
+# rows fetched per chunk, so results are never held as one list of tuples
+DB_CHUNK = 100000
+
+# open connections by (process, database path), a forked worker opens its own
+CONNECTIONS = {}
+
+
+def connect(dbfile, **pragmas):
+    '''Cached read-only connection to an sqlite database, with DB_PRAGMAS
+       (overridden by pragmas)'''
+
+    path = os.path.abspath(os.path.expanduser(dbfile))
+    key = (os.getpid(), path)
+
+    if key not in CONNECTIONS:
+        dbh = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(path), uri=True,
+                              check_same_thread=False)
+
+        for pragma, value in dict(DB_PRAGMAS, **pragmas).items():
+            dbh.execute("PRAGMA %s = %s" % (pragma, value))
+
+        CONNECTIONS[key] = dbh
+
+    return CONNECTIONS[key]
+
+
+def iterQuery(query, dbfile, columns=None, dtypes={}, chunksize=DB_CHUNK):
+    '''Yield query results as DataFrames of up to chunksize rows (at least
+       one, possibly empty), projected onto columns & cast to dtypes
+       ({column: dtype}) if given'''
+
+    if columns:
+        query = "SELECT %s FROM (%s)" % (", ".join('"%s"' % x for x in columns), query)
+
+    cc = connect(dbfile).execute(query)
+    names = [d[0] for d in cc.description]
+
+    try:
+        for n in itertools.count():
+            rows = cc.fetchmany(chunksize)
+            if n > 0 and len(rows) == 0:
+                break
+
+            df = pd.DataFrame.from_records(rows, columns=names)
+            if dtypes:
+                df = df.astype({c: t for c, t in dtypes.items() if c in df.columns})
+
+            yield df
+
+            if len(rows) < chunksize:
+                break
+    finally:
+        cc.close()
+
+
+def fetch_DataFrame(query, dbfile, columns=None, dtypes={}, chunksize=DB_CHUNK):
+    '''Fetch query results as a DataFrame, read in chunks over a cached
+       read-only connection (see iterQuery)'''
+
+    chunks = list(iterQuery(query, dbfile, columns, dtypes, chunksize))
+
+    if len(chunks) == 1:
+        return chunks[0]
+
+    # a column of only NULLs in one chunk is object, retyped once joined
+    return pd.concat(chunks, ignore_index=True).infer_objects()
+
+
+#####################################################
+####      Database loading                       ####
+#####################################################
+
+# rows inserted per executemany call of the queue writer
+LOAD_BATCH = 100000
+
+
+def tableName(outfile):
+    '''Table name of a .load outfile, as P.to_table'''
+
+    name = os.path.basename(outfile)
+    if name.endswith(".load"):
+        name = name[:-len(".load")]
+
+    return name.replace("-", "_").replace(".", "_")
+
+
+def readTable(infiles, header=None, cat=None, regex_filename=None, **kwargs):
+    '''Read & concatenate tab-separated infile(s). header names the columns
+       of files without a header line, cat adds a first column holding the
+       filename (or first group of regex_filename) of each row. kwargs are
+       passed to pandas.read_csv'''
+
+    if isinstance(infiles, str):
+        infiles = [infiles]
+
+    frames = []
+    for infile in infiles:
+        try:
+            df = pd.read_csv(infile, sep="\t", header=None if header else 0,
+                             names=header, **kwargs)
+        except pd.errors.EmptyDataError:
+            df = pd.DataFrame(columns=header or [])
+
+        if cat:
+            value = infile
+            if regex_filename:
+                value = re.search(regex_filename, infile).group(1)
+            df.insert(0, cat, value)
+
+        frames.append(df)
+
+    if len(frames) == 1:
+        return frames[0]
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def enqueue(df, table, queue, indexes=[]):
+    '''Write a table payload to the load queue, returns the payload path.
+       Payloads are renamed into place so the writer never sees a partial
+       file'''
+
+    os.makedirs(queue, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=queue, suffix=".tmp")
+    with os.fdopen(fd, "wb") as out:
+        pickle.dump({"table": table, "indexes": list(indexes), "frame": df}, out,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+
+    payload = os.path.join(queue, "%020i-%i.payload" % (time.time_ns(), os.getpid()))
+    os.rename(tmp, payload)
+
+    return payload
+
+
+def sqlType(dtype):
+    '''sqlite column type of a pandas dtype'''
+
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+
+    return "TEXT"
+
+
+def writeTable(dbh, table, df, batch=LOAD_BATCH):
+    '''(Re)create table from df on an open connection, inside the caller's
+       transaction. NaN is stored as NULL'''
+
+    dbh.execute('DROP TABLE IF EXISTS "%s"' % table)
+
+    if len(df.columns) == 0:
+        return
+
+    dbh.execute('CREATE TABLE "%s" (%s)' % (table, ", ".join(
+        '"%s" %s' % (c, sqlType(t)) for c, t in df.dtypes.items())))
+
+    insert = 'INSERT INTO "%s" VALUES (%s)' % (table, ", ".join("?" * len(df.columns)))
+
+    for start in range(0, len(df), batch):
+        chunk = df.iloc[start:start + batch]
+        # tolist gives python scalars, which sqlite3 binds (numpy ints it does not)
+        dbh.executemany(insert, zip(*[chunk[c].tolist() for c in chunk.columns]))
+
+
+@contextlib.contextmanager
+def writerLock(queue):
+    '''Hold the load queue lock, making the caller the single writer of the
+       queue's database (for tables written outside the queue)'''
+
+    os.makedirs(queue, exist_ok=True)
+
+    with open(os.path.join(queue, "writer.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+# sqlite errors of the database, not of a payload's table
+DB_ERRORS = ["locked", "busy", "disk", "unable to open", "readonly", "full"]
+
+
+def databaseError(error):
+    '''True if error is a lock/connection/storage error of the database'''
+
+    return (isinstance(error, sqlite3.OperationalError) and
+            any(x in str(error).lower() for x in DB_ERRORS))
+
+
+def failPayloads(payloads, error):
+    '''Mark payloads as failed (renamed to .failed), with the error in .error'''
+
+    for payload in payloads:
+        if os.path.exists(payload):
+            with open(payload + ".error", "w") as out:
+                out.write("%s: %s\n" % (type(error).__name__, error))
+            os.rename(payload, payload + ".failed")
+
+
+def writePayload(dbh, payload, batch=LOAD_BATCH):
+    '''Write one payload's table on an open connection, returns (table,
+       indexes)'''
+
+    with open(payload, "rb") as inf:
+        data = pickle.load(inf)
+
+    missing = [x for x in data["indexes"] if x not in data["frame"].columns]
+    if missing:
+        raise KeyError("index column(s) %s not in table %s" % (", ".join(missing), data["table"]))
+
+    writeTable(dbh, data["table"], data["frame"], batch)
+
+    return data["table"], data["indexes"]
+
+
+def drainQueue(queue, dbfile, batch=LOAD_BATCH, timeout=600, payload=None):
+    '''Commit every pending payload in the load queue to dbfile in one
+       transaction, then create the declared indexes. The queue lock makes
+       the holder the single writer: jobs queued while it writes are taken
+       by the next holder, whose batch is then larger. If payload is given
+       and an earlier writer has already taken it, nothing is written.
+
+       Each payload is written under its own savepoint, a payload that fails
+       is rolled back & marked .failed alone. If the database cannot be
+       locked or committed the payloads stay queued for the next writer,
+       only payload (the caller's) is marked .failed & the error raised.
+       Returns the committed payloads'''
+
+    with writerLock(queue):
+        if payload is not None and not os.path.exists(payload):
+            return []
+
+        payloads = sorted(glob.glob(os.path.join(queue, "*.payload")))
+        if len(payloads) == 0:
+            return []
+
+        failed = {}
+        tables = {}
+
+        try:
+            # timeout covers readers & writers outside the queue (e.g. R notebooks)
+            dbh = sqlite3.connect(dbfile, timeout=timeout, isolation_level=None)
+        except sqlite3.Error as error:
+            failPayloads([payload] if payload else [], error)
+            raise
+
+        try:
+            dbh.execute("BEGIN IMMEDIATE")
+
+            # payloads are in queue order, a table queued twice keeps the last
+            for n, queued in enumerate(payloads):
+                dbh.execute("SAVEPOINT payload%i" % n)
+                try:
+                    table, indexes = writePayload(dbh, queued, batch)
+                    tables[table] = (queued, indexes)
+                except Exception as error:
+                    if databaseError(error):
+                        raise
+                    dbh.execute("ROLLBACK TO payload%i" % n)
+                    failed[queued] = error
+                dbh.execute("RELEASE payload%i" % n)
+
+            for n, (table, (queued, indexes)) in enumerate(tables.items()):
+                dbh.execute("SAVEPOINT index%i" % n)
+                try:
+                    for i, column in enumerate(indexes):
+                        dbh.execute('CREATE INDEX IF NOT EXISTS "%s_index%i" ON "%s" ("%s")'
+                                    % (table, i, table, column))
+                except sqlite3.DatabaseError as error:
+                    if databaseError(error):
+                        raise
+                    dbh.execute("ROLLBACK TO index%i" % n)
+                    failed[queued] = error
+                dbh.execute("RELEASE index%i" % n)
+
+            dbh.execute("COMMIT")
+
+        except sqlite3.Error as error:
+            if dbh.in_transaction:
+                dbh.execute("ROLLBACK")
+            failPayloads([payload] if payload else [], error)
+            raise
+
+        finally:
+            dbh.close()
+
+        for queued, error in failed.items():
+            failPayloads([queued], error)
+
+        committed = [x for x in payloads if x not in failed]
+        for queued in committed:
+            os.unlink(queued)
+
+    return committed
+
+
+def queueTable(infiles, queue, tablename, indexes=[], **kwargs):
+    '''Read tab-separated infile(s) (kwargs are passed to readTable) into
+       the load queue as tablename, returns (payload, rows)'''
+
+    df = readTable(infiles, **kwargs)
+
+    return enqueue(df, tablename, queue, indexes), len(df)
+
+
+def commitQueued(payload, tablename, rows, outfile, queue, dbfile, batch=LOAD_BATCH):
+    '''Wait until a queued payload is committed to dbfile, writing the queue
+       if no other job is, then write the .load outfile. Raises ValueError
+       if the payload failed'''
+
+    # returns once the payload is committed, by this job or an earlier writer
+    drainQueue(queue, dbfile, batch, payload=payload)
+
+    if os.path.exists(payload + ".failed"):
+        with open(payload + ".error") as inf:
+            error = inf.read().strip()
+        raise ValueError("loading %s into %s failed (%s), see %s.failed"
+                         % (tablename, dbfile, error, payload))
+
+    with open(outfile, "w") as out:
+        out.write("table\trows\n%s\t%i\n" % (tablename, rows))
+
+
+def load(infiles, outfile, queue, dbfile, tablename=None, indexes=[],
+         batch=LOAD_BATCH, **kwargs):
+    '''Load tab-separated infile(s) into tablename (by default named from
+       outfile) of dbfile through the load queue, in place of P.load.
+       kwargs are passed to readTable'''
+
+    if tablename is None:
+        tablename = tableName(outfile)
+
+    payload, rows = queueTable(infiles, queue, tablename, indexes, **kwargs)
+
+    commitQueued(payload, tablename, rows, outfile, queue, dbfile, batch)
+
+
+def queueStatement(infiles, ticket, queue, tablename, indexes=[], **kwargs):
+    '''Shell statement queueing infile(s) as tablename in a job
+       (python/queueTable.py), so large tables are parsed & pickled off the
+       head process. The job writes a ticket for loadQueued. kwargs are
+       passed to readTable, as json'''
+
+    if isinstance(infiles, str):
+        infiles = [infiles]
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "python", "queueTable.py")
+    options = json.dumps(dict(kwargs, indexes=list(indexes)))
+
+    return f'''python {script}
+                 --infiles {" ".join(infiles)}
+                 --queue {queue}
+                 --table {tablename}
+                 --ticket {ticket}
+                 --options {shlex.quote(options)}'''
+
+
+def loadQueued(ticket, outfile, queue, dbfile, batch=LOAD_BATCH):
+    '''Commit the payload of a queueStatement job ticket (see
+       commitQueued)'''
+
+    with open(ticket) as inf:
+        queued = json.load(inf)
+
+    commitQueued(queued["payload"], queued["table"], queued["rows"], outfile, queue, dbfile, batch)
+
+    os.unlink(ticket)
+
+
+#####################################################
+####      GREAT regulatory domains               ####
+#####################################################
+
+GREAT_COLUMNS = ["contig", "start", "end", "strand", "gene_id"]
+
+
+def readContigEnds(contigs):
+    '''contig -> length from a contigs.bed(.gz) (contig, start, end) or
+       contigs.tsv (contig, length) file'''
+
+    df = pd.read_csv(contigs, sep="\t", header=None, dtype={0: str})
+
+    return dict(zip(df[0], df[df.columns[-1]].astype(np.int64)))
+
+
+def greatContig(tss, plus, contig_end, basalup, basaldown, maxext, half=False):
+    '''GREAT basal plus extension domains for all genes on one contig at
+       once. tss & plus (strand) must be sorted by tss.
+
+       Each gene is assigned a basal regulatory domain of a minimum distance
+       upstream and downstream of the TSS (regardless of other nearby genes),
+       extended in both directions to the nearest gene's basal domain but no
+       more than the maximum extension in one direction.
+       Returns (starts, ends)'''
+
+    up = np.where(plus, basalup, basaldown)
+    down = np.where(plus, basaldown, basalup)
+
+    # neighbouring basal domains, the contig start & end act as neighbours
+    frontstop = np.zeros(len(tss), dtype=np.int64)
+    frontstop[1:] = tss[:-1] + down[:-1]
+
+    backstop = np.empty(len(tss), dtype=np.int64)
+    backstop[:-1] = tss[1:] - up[1:]
+    backstop[-1:] = contig_end - basaldown
+
+    basalstart = tss - up
+    basalend = np.minimum(tss + down, contig_end)
+
+    frontext = tss - frontstop
+    backext = backstop - tss
+
+    if half:
+        frontext, backext = frontext // 2, backext // 2
+
+    starts = np.where(frontstop > basalstart, basalstart, tss - np.minimum(maxext, frontext))
+    starts = np.maximum(starts, 0)
+    ends = np.where(backstop < basalend, basalend, tss + np.minimum(maxext, backext))
+
+    return starts, ends
+
+
+def greatDomains(genes, contig_ends, basalup, basaldown, maxext, half=False):
+    '''GREAT regulatory domains for a DataFrame of genes (GREAT_COLUMNS),
+       computed per contig with NumPy, strand is +/- or 1/-1. Genes on
+       chrM/MT & NT contigs are skipped. Contigs missing from contig_ends end at their last TSS plus
+       maxext. Returns a DataFrame (contig, start, end, gene_id)'''
+
+    contig = genes["contig"]
+    genes = genes[~(contig.str[3:5].eq("NT") | contig.str[3:].eq("M") | contig.eq("MT"))]
+
+    minus = genes["strand"].isin(["-", "-1"]).values
+    genes = genes.assign(tss=np.where(minus, genes["end"], genes["start"]).astype(np.int64))
+
+    domains = []
+
+    for contig, df in genes.groupby("contig", sort=False):
+        df = df.sort_values("tss", kind="mergesort")
+        tss = df["tss"].values
+
+        contig_end = contig_ends.get(contig, tss[-1] + maxext)
+
+        starts, ends = greatContig(tss, ~df["strand"].isin(["-", "-1"]).values, contig_end,
+                                   basalup, basaldown, maxext, half)
+
+        domains.append(pd.DataFrame({"contig": contig, "start": starts, "end": ends,
+                                     "gene_id": df["gene_id"].values}))
+
+    if len(domains) == 0:
+        return pd.DataFrame(columns=["contig", "start", "end", "gene_id"])
+
+    return pd.concat(domains, ignore_index=True)
+
+
+def greatKey(genes, contig_ends, basalup, basaldown, maxext, half):
+    '''Cache key of a GREAT domain set, sha1 of the geneset, contig ends &
+       parameters'''
+
+    sha = hashlib.sha1()
+
+    sha.update(genes[GREAT_COLUMNS].to_csv(sep="\t", index=False, header=False).encode())
+    sha.update(repr(sorted(contig_ends.items())).encode())
+    sha.update(repr([int(basalup), int(basaldown), int(maxext), bool(half)]).encode())
+
+    return sha.hexdigest()
+
+
+def writeGreat(locations, basalup, basaldown, maxext, outfile, half=False,
+               contigs=None, cache=None):
+    '''Write a bed file of GREAT regulatory domains (contig, start, end,
+       gene_id) for gene locations, a list of [contig, gstart, gend, strand,
+       gene_id] or a DataFrame of GREAT_COLUMNS. contigs is a contig sizes
+       file, domains are cached in cache (if given) keyed by the geneset &
+       parameters, so identical domain sets are only built once'''
+
+    genes = pd.DataFrame(list(locations) if not isinstance(locations, pd.DataFrame) else locations)
+    genes.columns = GREAT_COLUMNS
+    genes = genes.astype({"contig": str, "start": np.int64, "end": np.int64,
+                          "strand": str, "gene_id": str})
+
+    contig_ends = readContigEnds(contigs) if contigs else {}
+
+    if cache:
+        cache = os.path.expanduser(cache)
+        cached = os.path.join(cache, greatKey(genes, contig_ends, basalup, basaldown, maxext, half) + ".bed")
+
+        if os.path.exists(cached):
+            shutil.copyfile(cached, outfile)
+            return
+
+    domains = greatDomains(genes, contig_ends, basalup, basaldown, maxext, half)
+    domains.to_csv(outfile, sep="\t", header=False, index=False)
+
+    if cache:
+        os.makedirs(cache, exist_ok=True)
+
+        # written then moved, so concurrent pipelines never read a partial file
+        tmp = tempfile.NamedTemporaryFile(dir=cache, delete=False).name
+        shutil.copyfile(outfile, tmp)
+        os.rename(tmp, cached)
+
+
+#####################################################
+####      Gene body & TSS interval index         ####
+#####################################################
+
+# ensemblGeneset.txt columns
+GENE_COLUMNS = ["gene_id", "gene_name", "contig", "start", "end", "strand"]
+
+GENE_ARRAYS = ["body_start", "body_end", "body_reach", "body_row", "tss", "tss_row"]
+
+
+def buildGeneIndex(genes, index_dir):
+    '''Save a gene body & TSS index for a DataFrame of GENE_COLUMNS. Gene
+       bodies (sorted by start, with the running max end for overlap
+       searches) & TSSs (sorted) are concatenated over contigs as .npy
+       (memory mappable), rows point into genes.tsv, contigs.tsv holds row
+       offsets. The TSS is start for + strand genes & end for - strand'''
+
+    genes = genes[GENE_COLUMNS].drop_duplicates().astype({"contig": str, "start": np.int64,
+                                                          "end": np.int64})
+    genes = genes.sort_values(["contig", "start"], kind="mergesort").reset_index(drop=True)
+
+    minus = genes["strand"].isin(["-", -1]).values
+    tss = np.where(minus, genes["end"], genes["start"]).astype(np.int64)
+    body_start = np.minimum(genes["start"], genes["end"]).values
+    body_end = np.maximum(genes["start"], genes["end"]).values
+
+    arrays = {x: [] for x in GENE_ARRAYS}
+    rows = []
+    offset = 0
+
+    for contig, idx in genes.groupby("contig", sort=False).indices.items():
+        order = idx[np.argsort(body_start[idx], kind="mergesort")]
+        arrays["body_start"].append(body_start[order])
+        arrays["body_end"].append(body_end[order])
+        arrays["body_reach"].append(np.maximum.accumulate(body_end[order]))
+        arrays["body_row"].append(order)
+
+        order = idx[np.argsort(tss[idx], kind="mergesort")]
+        arrays["tss"].append(tss[order])
+        arrays["tss_row"].append(order)
+
+        rows.append((contig, offset, len(idx)))
+        offset += len(idx)
+
+    os.makedirs(index_dir, exist_ok=True)
+
+    for name, values in arrays.items():
+        np.save(os.path.join(index_dir, name + ".npy"),
+                np.concatenate(values or [np.zeros(0, dtype=np.int64)]).astype(np.int64))
+
+    genes.assign(tss=tss).to_csv(os.path.join(index_dir, "genes.tsv"), sep="\t", index=False)
+
+    pd.DataFrame(rows, columns=["contig", "offset", "n"]).to_csv(
+        os.path.join(index_dir, "contigs.tsv"), sep="\t", index=False)
+
+
+def cachedIndex(build, key, outdir, cache=None):
+    '''Run build(index_dir) at outdir, or with a cache directory only once
+       per key (e.g. a sha1 of the inputs) in cache/key with outdir a
+       symlink to it'''
+
+    if not cache:
+        build(outdir)
+        return
+
+    cache = os.path.expanduser(cache)
+    index_dir = os.path.join(cache, key)
+
+    if not os.path.exists(os.path.join(index_dir, "contigs.tsv")):
+        os.makedirs(cache, exist_ok=True)
+
+        # built then moved, so concurrent pipelines never load a partial index
+        tmp = tempfile.mkdtemp(dir=cache)
+        build(tmp)
+
+        try:
+            os.rename(tmp, index_dir)
+        except OSError:
+            shutil.rmtree(tmp)
+
+    if os.path.lexists(outdir):
+        os.remove(outdir)
+
+    os.symlink(os.path.abspath(index_dir), outdir)
+
+
+def geneIndex(infile, outdir, cache=None):
+    '''Build the gene index for a GENE_COLUMNS table (ensemblGeneset.txt) at
+       outdir. With a cache directory the index is built once per geneset
+       (keyed by sha1 of the table) & outdir is a symlink to it, so projects
+       & pipelines on the same annotations share one index'''
+
+    genes = pd.read_csv(infile, sep="\t", dtype={"contig": str, "gene_id": str})
+
+    key = hashlib.sha1(genes[GENE_COLUMNS].to_csv(sep="\t", index=False).encode()).hexdigest()
+
+    cachedIndex(lambda index_dir: buildGeneIndex(genes, index_dir), key, outdir, cache)
+
+
+def loadGeneIndex(index_dir):
+    '''(genes, index) for a gene index, genes is the genes.tsv DataFrame &
+       index contig -> {GENE_ARRAYS name: memory mapped view}'''
+
+    genes = pd.read_csv(os.path.join(index_dir, "genes.tsv"), sep="\t",
+                        dtype={"contig": str, "gene_id": str})
+    contigs = pd.read_csv(os.path.join(index_dir, "contigs.tsv"), sep="\t", dtype={"contig": str})
+
+    arrays = {x: np.load(os.path.join(index_dir, x + ".npy"), mmap_mode="r") for x in GENE_ARRAYS}
+
+    index = {c: {x: v[o:o + n] for x, v in arrays.items()}
+             for c, o, n in contigs.itertuples(index=False)}
+
+    return genes, index
+
+
+def geneLocations(index_dir):
+    '''Gene (contig, start, end, strand, gene_id) of a gene index, as the
+       locations of writeGreat'''
+
+    genes, _ = loadGeneIndex(index_dir)
+
+    return genes[["contig", "start", "end", "strand", "gene_id"]].drop_duplicates()
+
+
+def expandRanges(lo, hi):
+    '''(query, position) pairs for all positions in [lo, hi) of each query'''
+
+    counts = np.maximum(hi - lo, 0)
+    query = np.repeat(np.arange(len(lo)), counts)
+    position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + lo[query]
+
+    return query, position
+
+
+def tssDistance(tss, plus, centre):
+    '''Signed distance of a peak centre to a TSS, +ve if the peak is upstream'''
+
+    return np.where(plus, tss - centre, centre - tss)
+
+
+def contigQueries(index, contigs):
+    '''Yield (contig, query rows, contig index) for queries on indexed contigs'''
+
+    contigs = np.asarray(contigs).astype(str)
+
+    for contig in np.unique(contigs):
+        if contig in index:
+            yield contig, np.flatnonzero(contigs == contig), index[contig]
+
+
+def overlapGenes(gene_index, contigs, starts, ends):
+    '''All (peak, gene) pairs where a peak overlaps a gene body (>= 1 b.p.),
+       peak is the query position & gene the genes.tsv row'''
+
+    genes, index = gene_index
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    pairs = []
+
+    for contig, rows, c in contigQueries(index, contigs):
+        # bodies starting before the peak end, from the first whose reach passes the start
+        lo = np.searchsorted(c["body_reach"], starts[rows], side="right")
+        hi = np.searchsorted(c["body_start"], ends[rows], side="left")
+
+        query, position = expandRanges(lo, hi)
+        hit = c["body_end"][position] > starts[rows][query]
+
+        pairs.append(pd.DataFrame({"peak": rows[query[hit]],
+                                   "gene": c["body_row"][position[hit]]}))
+
+    return pd.concat(pairs, ignore_index=True) if pairs else pd.DataFrame(columns=["peak", "gene"])
+
+
+def tssWithin(gene_index, contigs, starts, ends, distance):
+    '''All (peak, gene, TSSdist) where a gene TSS is within distance b.p. of a
+       peak, TSSdist is signed from the peak centre'''
+
+    genes, index = gene_index
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    plus = ~genes["strand"].isin(["-", -1]).values
+    pairs = []
+
+    for contig, rows, c in contigQueries(index, contigs):
+        lo = np.searchsorted(c["tss"], starts[rows] - distance, side="left")
+        hi = np.searchsorted(c["tss"], ends[rows] + distance, side="right")
+
+        query, position = expandRanges(lo, hi)
+        gene = c["tss_row"][position]
+        centre = (starts[rows][query] + ends[rows][query]) / 2
+
+        pairs.append(pd.DataFrame({"peak": rows[query], "gene": gene,
+                                   "TSSdist": tssDistance(c["tss"][position], plus[gene], centre)}))
+
+    if len(pairs) == 0:
+        return pd.DataFrame(columns=["peak", "gene", "TSSdist"])
+
+    return pd.concat(pairs, ignore_index=True)
+
+
+def nearestTSS(gene_index, contigs, starts, ends):
+    '''Nearest gene TSS to each peak centre, returns (gene, TSSdist) arrays,
+       gene is -1 for peaks on contigs without genes. Ties go upstream'''
+
+    genes, index = gene_index
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    plus = ~genes["strand"].isin(["-", -1]).values
+
+    gene = np.full(len(starts), -1)
+    dist = np.full(len(starts), np.nan)
+
+    for contig, rows, c in contigQueries(index, contigs):
+        tss = c["tss"]
+        centre = (starts[rows] + ends[rows]) / 2
+
+        right = np.searchsorted(tss, centre)
+        left = np.clip(right - 1, 0, len(tss) - 1)
+        right = np.minimum(right, len(tss) - 1)
+        nearest = np.where(np.abs(tss[right] - centre) < np.abs(tss[left] - centre), right, left)
+
+        gene[rows] = c["tss_row"][nearest]
+        dist[rows] = tssDistance(tss[nearest], plus[gene[rows]], centre)
+
+    return gene, dist
+
+
+#####################################################
+####      BED interval overlaps                  ####
+#####################################################
+
+def mergeIntervals(infile):
+    '''Read a BED file & merge overlapping or book-ended intervals,
+       returns contig -> (starts, ends), sorted'''
+
+    try:
+        bed = pd.read_csv(infile, sep="\t", header=None, usecols=[0, 1, 2], comment="#",
+                          names=["contig", "start", "end"], dtype={0: str})
+    except pd.errors.EmptyDataError:
+        return {}
+
+    bed = bed[~bed["contig"].str.match(r"^(track|browser)")]
+    bed = bed.astype({"start": np.int64, "end": np.int64})
+    bed = bed.sort_values(["contig", "start"], kind="mergesort")
+
+    intervals = {}
+
+    for contig, df in bed.groupby("contig", sort=False):
+        s, e = df["start"].values, df["end"].values
+
+        reach = np.maximum.accumulate(e)
+        first = np.ones(len(s), dtype=np.bool_)
+        first[1:] = s[1:] > reach[:-1]
+        bounds = np.flatnonzero(first)
+
+        intervals[contig] = (s[bounds], np.maximum.reduceat(e, bounds))
+
+    return intervals
+
+
+def overlapsIndex(index, contigs, starts, ends):
+    '''True for intervals overlapping (>= 1 b.p.) any indexed interval'''
+
+    hits = np.zeros(len(starts), dtype=np.bool_)
+
+    for contig in np.unique(contigs):
+        if contig not in index:
+            continue
+
+        rows = contigs == contig
+        istarts, iends = index[contig]
+
+        # first indexed interval ending after each start, overlaps if it starts before the end
+        i = np.searchsorted(iends, starts[rows], side="right")
+        found = i < len(iends)
+        hit = np.zeros(len(i), dtype=np.bool_)
+        hit[found] = istarts[i[found]] < ends[rows][found]
+
+        hits[rows] = hit
+
+    return hits
+
+
+#####################################################
+####      Genomic partition                      ####
+#####################################################
+
+# in order of precedence, a base in several features gets the first
+PARTITIONS = ["promoter", "5'UTR", "3'UTR", "exon", "TES", "intron", "intergenic"]
+
+INTERGENIC = PARTITIONS.index("intergenic")
+
+
+def partitionFeatures(gtf, promoter_up=1000, promoter_down=100, tes_up=100, tes_down=1000):
+    '''Intervals per partition from GTF exon & CDS records, a DataFrame of
+       contig, feature, start, end, strand, transcript_id (0-based half
+       open). UTRs are the exon parts either side of the transcripts CDS,
+       introns the transcript span. Returns a DataFrame contig, start, end,
+       code (PARTITIONS index)'''
+
+    exons = gtf[gtf["feature"] == "exon"]
+    cds = gtf[gtf["feature"] == "CDS"].groupby("transcript_id").agg(
+        cds_start=("start", "min"), cds_end=("end", "max"))
+
+    tx = exons.groupby("transcript_id").agg(contig=("contig", "first"), strand=("strand", "first"),
+                                            start=("start", "min"), end=("end", "max"))
+    plus = (tx["strand"] != "-").values
+
+    tss = np.where(plus, tx["start"], tx["end"])
+    tes = np.where(plus, tx["end"], tx["start"])
+
+    features = [pd.DataFrame({"contig": tx["contig"].values,
+                              "start": np.where(plus, tss - promoter_up, tss - promoter_down),
+                              "end": np.where(plus, tss + promoter_down, tss + promoter_up),
+                              "code": PARTITIONS.index("promoter")}),
+                pd.DataFrame({"contig": tx["contig"].values,
+                              "start": np.where(plus, tes - tes_up, tes - tes_down),
+                              "end": np.where(plus, tes + tes_down, tes + tes_up),
+                              "code": PARTITIONS.index("TES")}),
+                pd.DataFrame({"contig": tx["contig"].values, "start": tx["start"].values,
+                              "end": tx["end"].values, "code": PARTITIONS.index("intron")}),
+                exons[["contig", "start", "end"]].assign(code=PARTITIONS.index("exon"))]
+
+    # coding exons, the parts before/after the CDS are 5'/3' UTR by strand
+    coding = exons.join(cds, on="transcript_id", how="inner")
+    plus = (coding["strand"] != "-").values
+
+    head = coding[coding["start"] < coding["cds_start"]]
+    head = pd.DataFrame({"contig": head["contig"].values, "start": head["start"].values,
+                         "end": np.minimum(head["end"], head["cds_start"]).values,
+                         "code": np.where(plus[coding["start"] < coding["cds_start"]],
+                                          PARTITIONS.index("5'UTR"), PARTITIONS.index("3'UTR"))})
+
+    tail = coding[coding["end"] > coding["cds_end"]]
+    tail = pd.DataFrame({"contig": tail["contig"].values,
+                         "start": np.maximum(tail["start"], tail["cds_end"]).values,
+                         "end": tail["end"].values,
+                         "code": np.where(plus[coding["end"] > coding["cds_end"]],
+                                          PARTITIONS.index("3'UTR"), PARTITIONS.index("5'UTR"))})
+
+    features = pd.concat(features + [head, tail], ignore_index=True)
+    features["start"] = features["start"].clip(lower=0)
+
+    return features[features["end"] > features["start"]]
+
+
+def partitionContig(starts, ends, codes):
+    '''Run-length partition of one contig from overlapping feature intervals,
+       each base labelled with its highest precedence (lowest) code, else
+       intergenic. Returns (run starts, codes), the first run starts at 0'''
+
+    bounds = np.unique(np.concatenate([[0], starts, ends]))
+    labels = np.full(len(bounds), INTERGENIC, dtype=np.uint8)
+
+    # lowest precedence first, so higher precedence features overwrite
+    for code in sorted(np.unique(codes), reverse=True):
+        rows = codes == code
+
+        # coverage of the elementary segments [bounds[i], bounds[i + 1])
+        depth = np.zeros(len(bounds) + 1, dtype=np.int64)
+        np.add.at(depth, np.searchsorted(bounds, starts[rows]), 1)
+        np.add.at(depth, np.searchsorted(bounds, ends[rows]), -1)
+
+        labels[np.cumsum(depth)[:-1] > 0] = code
+
+    runs = np.ones(len(bounds), dtype=np.bool_)
+    runs[1:] = labels[1:] != labels[:-1]
+
+    return bounds[runs], labels[runs]
+
+
+def buildPartition(features, index_dir):
+    '''Save a genomic partition (partitionFeatures intervals) as run starts
+       & codes .npy (memory mappable), with contigs.tsv of row offsets &
+       partitions.tsv of code labels'''
+
+    runs, labels, rows = [], [], []
+    offset = 0
+
+    for contig, df in features.groupby("contig", sort=True):
+        s, c = partitionContig(df["start"].values.astype(np.int64), df["end"].values.astype(np.int64),
+                               df["code"].values)
+        runs.append(s)
+        labels.append(c)
+        rows.append((contig, offset, len(s)))
+        offset += len(s)
+
+    os.makedirs(index_dir, exist_ok=True)
+
+    np.save(os.path.join(index_dir, "starts.npy"), np.concatenate(runs or [np.zeros(0, dtype=np.int64)]))
+    np.save(os.path.join(index_dir, "codes.npy"), np.concatenate(labels or [np.zeros(0, dtype=np.uint8)]))
+
+    pd.DataFrame(rows, columns=["contig", "offset", "n"]).to_csv(
+        os.path.join(index_dir, "contigs.tsv"), sep="\t", index=False)
+
+    pd.DataFrame({"code": range(len(PARTITIONS)), "partition": PARTITIONS}).to_csv(
+        os.path.join(index_dir, "partitions.tsv"), sep="\t", index=False)
+
+
+def genomePartition(gtf, outdir, cache=None, **kwargs):
+    '''Build the genomic partition for GTF exon & CDS records at outdir,
+       once per annotation set & settings with a cache directory'''
+
+    gtf = gtf[["contig", "feature", "start", "end", "strand", "transcript_id"]]
+
+    sha = hashlib.sha1(gtf.to_csv(sep="\t", index=False).encode())
+    sha.update(repr(sorted(kwargs.items())).encode())
+
+    cachedIndex(lambda index_dir: buildPartition(partitionFeatures(gtf, **kwargs), index_dir),
+                sha.hexdigest(), outdir, cache)
+
+
+def loadPartition(index_dir):
+    '''contig -> (run starts, codes) memory mapped views of a partition'''
+
+    starts = np.load(os.path.join(index_dir, "starts.npy"), mmap_mode="r")
+    codes = np.load(os.path.join(index_dir, "codes.npy"), mmap_mode="r")
+    contigs = pd.read_csv(os.path.join(index_dir, "contigs.tsv"), sep="\t", dtype={"contig": str})
+
+    return {c: (starts[o:o + n], codes[o:o + n]) for c, o, n in contigs.itertuples(index=False)}
+
+
+def classifyPositions(partition, contigs, positions):
+    '''Partition code of each position, intergenic on unpartitioned contigs'''
+
+    positions = np.asarray(positions)
+    codes = np.full(len(positions), INTERGENIC, dtype=np.uint8)
+
+    for contig, rows, (starts, labels) in contigQueries(partition, contigs):
+        codes[rows] = labels[np.searchsorted(starts, positions[rows], side="right") - 1]
+
+    return codes
+
+
+def writePeakPartitions(peakfile, partition_dir, outfile, position=None):
+    '''Label each peak in a bed file by the genomic partition of its summit
+       (position, index of a column of absolute summit positions) or centre,
+       writes peak_id, contig, position, partition'''
+
+    peaks = pd.read_csv(peakfile, sep="\t", header=None, dtype={0: str, 3: str})
+
+    if position is None:
+        positions = ((peaks[1] + peaks[2]) // 2).values
+    else:
+        positions = peaks[position].values.astype(np.int64)
+
+    codes = classifyPositions(loadPartition(partition_dir), peaks[0].values, positions)
+
+    pd.DataFrame({"peak_id": peaks[3], "contig": peaks[0], "position": positions,
+                  "partition": np.array(PARTITIONS)[codes]}).to_csv(outfile, sep="\t", index=False)
+
+
+#####################################################
+####      Report notebooks                       ####
+#####################################################
+
+def databaseTables(database, pattern="*"):
+    '''Names of the tables of an sqlite database matching a glob'''
+
+    cc = connect(database).execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+
+    return sorted(x for x, in cc.fetchall() if fnmatch.fnmatchcase(x, pattern))
+
+
+def expandInputs(inputs):
+    '''Files & database tables named by inputs: file globs, or
+       <database>:<table glob> (e.g. csvdb:*_tomtom) for tables, listed
+       as <database>:<table>'''
+
+    expanded = set()
+
+    for pattern in inputs:
+        database, _, table = pattern.partition(":")
+
+        if table and os.path.isfile(database):
+            expanded.update("%s:%s" % (database, x) for x in databaseTables(database, table))
+        else:
+            expanded.update(x for x in glob.glob(pattern) if os.path.isfile(x))
+
+    return sorted(expanded)
+
+
+def cellInputs(source, inputs):
+    '''The inputs (of expandInputs) a code cell reads: those a string literal
+       in its source names, as a path suffix, glob or extensionless basename
+       (e.g. "data.dir/*.bed", "/meme_out/meme.txt", read_bundle("sample_info")),
+       & tables named anywhere in it (e.g. in a multi-line query).
+       Format fields (%s, {name}) in literals match anything'''
+
+    patterns = set()
+
+    for literal in re.findall(r"[\"']([^\"'\n]+)[\"']", source):
+        pattern = re.sub(r"%(\(\w+\))?[sdif]|\{[^}]*\}", "*", literal).lstrip("./")
+
+        if re.search(r"\w", pattern):
+            patterns.add(pattern)
+
+    words = set(re.findall(r"\w+", source))
+
+    return [x for x in inputs
+            if any(fnmatch.fnmatch(x, "*" + p) or fnmatch.fnmatch(os.path.splitext(os.path.basename(x))[0], p)
+                   for p in patterns)
+            or (":" in x and x.split(":", 1)[1] in words)]
+
+
+def fileSignature(infile, cache=None):
+    '''sha1 of a file's content, unchanged when a task rewrites the file
+       with the same content. With cache the hash is kept there by path, size
+       & mtime, so it is only recomputed when a file is rewritten'''
+
+    stat = os.stat(infile)
+    stamp = "%i:%i" % (stat.st_size, stat.st_mtime_ns)
+
+    if cache:
+        memo = os.path.join(cache, "files", hashlib.sha1(os.path.abspath(infile).encode()).hexdigest())
+
+        if os.path.exists(memo):
+            with open(memo) as inf:
+                previous, signature = inf.read().split()
+            if previous == stamp:
+                return signature
+
+    sha1 = hashlib.sha1()
+    with open(infile, "rb") as inf:
+        for block in iter(lambda: inf.read(2**20), b""):
+            sha1.update(block)
+    signature = sha1.hexdigest()
+
+    if cache:
+        os.makedirs(os.path.dirname(memo), exist_ok=True)
+
+        # written then moved, as concurrent notebooks hash the same files
+        tmp = tempfile.NamedTemporaryFile("w", dir=os.path.dirname(memo), suffix=".tmp", delete=False)
+        with tmp:
+            tmp.write("%s\t%s\n" % (stamp, signature))
+        os.replace(tmp.name, memo)
+
+    return signature
+
+
+def tableSignature(database, table, chunksize=DB_CHUNK):
+    '''sha1 of a database table's columns & rows'''
+
+    cc = connect(database).execute('SELECT * FROM "%s"' % table)
+
+    sha1 = hashlib.sha1(repr([d[0] for d in cc.description]).encode())
+
+    try:
+        for rows in iter(lambda: cc.fetchmany(chunksize), []):
+            sha1.update(repr(rows).encode())
+    finally:
+        cc.close()
+
+    return sha1.hexdigest()
+
+
+def inputSignature(name, cache=None):
+    '''Content signature of an expandInputs file or <database>:<table>'''
+
+    database, _, table = name.partition(":")
+
+    if table and os.path.isfile(database):
+        return tableSignature(database, table)
+
+    return fileSignature(name, cache)
+
+
+def outputExists(pattern):
+    '''Whether a notebook output exists: a file glob, or a
+       <database>:<table glob> table'''
+
+    database, _, table = pattern.partition(":")
+
+    if table:
+        return os.path.isfile(database) and len(databaseTables(database, table)) > 0
+
+    return len(glob.glob(pattern)) > 0
+
+
+def cellKeys(nb, inputs=[], cache=None):
+    '''sha1 cache key of each code cell (None for markdown & raw cells). Keys
+       are chained, a cell's key changes with its source, the content of the
+       inputs it reads & the key of the code cell before it, as cells share
+       the kernel state'''
+
+    keys = []
+    previous = ""
+    signatures = {}
+
+    for cell in nb.cells:
+        if cell.cell_type != "code":
+            keys.append(None)
+            continue
+
+        reads = cellInputs(cell.source, inputs)
+
+        for x in reads:
+            if x not in signatures:
+                signatures[x] = "%s:%s" % (x, inputSignature(x, cache))
+
+        reads = [signatures[x] for x in reads]
+
+        previous = hashlib.sha1("\n".join([previous, cell.source] + reads).encode()).hexdigest()
+        keys.append(previous)
+
+    return keys
+
+
+def readCell(cache, key):
+    '''Cached (outputs, execution_count) of a cell, None if not cached'''
+
+    cellfile = os.path.join(cache, key + ".json")
+
+    if not os.path.exists(cellfile):
+        return None
+
+    import nbformat
+
+    with open(cellfile) as inf:
+        cached = json.load(inf)
+
+    return [nbformat.from_dict(x) for x in cached["outputs"]], cached["execution_count"]
+
+
+def writeCell(cache, key, cell):
+    '''Cache a cell's outputs, unless it raised an error'''
+
+    if any(x.output_type == "error" for x in cell.outputs):
+        return
+
+    # written then moved, so concurrent notebooks never read a partial cell
+    tmp = tempfile.NamedTemporaryFile("w", dir=cache, suffix=".tmp", delete=False)
+
+    with tmp:
+        json.dump({"outputs": cell.outputs, "execution_count": cell.execution_count}, tmp)
+
+    os.replace(tmp.name, os.path.join(cache, key + ".json"))
+
+
+def executeNotebook(template, cache, kernel=None, timeout=None, inputs=[], outputs=[],
+                    execute=False):
+    '''Execute an .ipynb template in the working directory, writing
+       <name>.nbconvert.ipynb & <name>.nbconvert.html. Cell outputs are cached
+       by cellKeys in cache, over the inputs the notebooks read (file globs or
+       <database>:<table glob>, see expandInputs). If every code cell is
+       cached the notebook is assembled without starting a kernel, otherwise
+       all of it is executed (errors allowed), as later cells need the kernel
+       state: a change to one cell reruns the whole notebook, only a notebook
+       with no changed cell is replayed. Assembling skips the notebook's side
+       effects, so it is executed anyway if any of the files or tables it
+       writes (outputs, as inputs) is missing, or always with execute.
+       Returns (html, code cells replayed from cache, code cells)'''
+
+    # the Jupyter stack is only needed to render reports, not by pipeline jobs
+    import nbformat
+    from nbclient import NotebookClient
+    from nbconvert import HTMLExporter
+
+    name = os.path.basename(template).replace(".ipynb", "")
+    nb = nbformat.read(os.path.expanduser(template), as_version=4)
+
+    os.makedirs(cache, exist_ok=True)
+
+    keys = cellKeys(nb, expandInputs(inputs), cache)
+    cached = {n: readCell(cache, key) for n, key in enumerate(keys) if key is not None}
+    hits = sum(x is not None for x in cached.values())
+
+    missing = [x for x in outputs if not outputExists(x)]
+
+    if hits == len(cached) and not execute and len(missing) == 0:
+        for n, (cell_outputs, execution_count) in cached.items():
+            nb.cells[n].outputs = cell_outputs
+            nb.cells[n].execution_count = execution_count
+
+    else:
+        options = {"kernel_name": kernel} if kernel else {}
+
+        client = NotebookClient(nb, timeout=timeout, allow_errors=True,
+                                resources={"metadata": {"path": os.getcwd()}}, **options)
+        client.execute()
+
+        for n in cached:
+            writeCell(cache, keys[n], nb.cells[n])
+
+        hits = 0
+
+    nbformat.write(nb, name + ".nbconvert.ipynb")
+
+    html = name + ".nbconvert.html"
+    with open(html, "w") as outf:
+        outf.write(HTMLExporter().from_notebook_node(nb)[0])
+
+    return html, hits, len(cached)
+
+
+def executeNotebookChain(job):
+    '''Execute a list of (template, options) in order, in one worker'''
+
+    templates, kwargs = job
+
+    return [executeNotebook(x, **dict(kwargs, **options)) for x, options in templates]
+
+
+def executeNotebooks(templates, cache, processes=1, outputs={}, execute=[], **kwargs):
+    '''Execute report templates concurrently, each in its own kernel. An
+       entry may be a list of templates executed in order, for a notebook
+       reading another's output. outputs maps a template file name to the
+       files or tables it writes & execute lists the names of templates
+       always executed (e.g. with side effects outputs cannot name), see
+       executeNotebook.
+       Returns executeNotebook results in order'''
+
+    outputs, execute = outputs or {}, execute or []
+
+    def options(template):
+        name = os.path.basename(template)
+        return {"outputs": outputs.get(name, []), "execute": name in execute}
+
+    chains = [x if isinstance(x, list) else [x] for x in templates]
+    jobs = [([(x, options(x)) for x in chain], dict(cache=cache, **kwargs)) for chain in chains]
+
+    pool = multiprocessing.Pool(max(1, min(processes, len(jobs))))
+
+    try:
+        results = pool.map(executeNotebookChain, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [x for chain in results for x in chain]
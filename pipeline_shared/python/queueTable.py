@@ -0,0 +1,27 @@
+#!usr/bin.python
+import sys
+from argparse import ArgumentParser
+import os
+import json
+
+# add parent dir to python path
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import PipelineShared as PS
+
+####### Parse commandline arguments
+parser = ArgumentParser(prog="queueTable")
+parser.add_argument("--infiles", help="tab-separated file(s) to load as one table", nargs="+", required=True)
+parser.add_argument("--queue", help="load queue directory", required=True)
+parser.add_argument("--table", help="table name", required=True)
+parser.add_argument("--ticket", help="write the payload, table & rows here (json) for PipelineShared.loadQueued", required=True)
+parser.add_argument("--options", help="json of indexes & readTable options (e.g. header, comment)", default="{}")
+args = parser.parse_args()
+
+options = json.loads(args.options)
+indexes = options.pop("indexes", [])
+
+# run job
+payload, rows = PS.queueTable(args.infiles, args.queue, args.table, indexes, **options)
+
+with open(args.ticket, "w") as out:
+    json.dump({"payload": payload, "table": args.table, "rows": rows}, out)
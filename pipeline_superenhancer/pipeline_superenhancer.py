@@ -42,6 +42,7 @@ import sqlite3
 import cgatcore.experiment as E
 from cgatcore import pipeline as P
 import PipelineSuperenhancer as SE
+import PipelineShared as PS
 import glob
 import pandas as pd
 from cgat.BamTools import bamtools
@@ -116,35 +117,17 @@ def fetchEnsemblGeneset(infile,outfile):
     
 @transform(fetchEnsemblGeneset,suffix(".txt"),".load")
 def uploadEnsGenes(infile,outfile):
-    '''Load the ensembl annotation including placeholder GO ID's'''
-    P.load(infile, outfile, options='-i "gene_id" -i "go_id" ')
+    '''Load the ensembl annotation'''
+    SE.load(infile, outfile, indexes=["gene_id"])
 
     
-@follows(uploadEnsGenes)
-@transform(fetchEnsemblGeneset,
-           regex(r"(.*).txt"),
-           r"\1.bed")
-def getAllGenesBed(infile, outfile):
-    '''Make bed file of all Ensembl protein coding genes. 
-       Remove strand info and correct so start < end for bedTools'''
-
-    statement = f'''tmp=`mktemp -p {tmp_dir}` &&
-                   awk 
-                     'BEGIN {{OFS="\\t"}} 
-                     {{if ($6 == "-" && $5 < $4) print $3,$5,$4,$1,0 ; 
-                     else if ($6 == "+" && $4 < $5) print $3,$4,$5,$1,0 ;}}'
-                     <( grep "^ENS" {infile} )
-                     > $tmp &&
-                   tail -n +2 $tmp | 
-                     sort -u | 
-                     sort -k1,1 -k2,2n 
-                     > {outfile} &&
-                   rm $tmp'''
+@transform(fetchEnsemblGeneset, suffix(".txt"), ".index")
+def geneIndex(infile, outfile):
+    '''Build (or reuse from the cache) the gene body & TSS index'''
+    PS.geneIndex(infile, outfile, cache=PARAMS["gene_index_cache"])
 
-    P.run(statement)
 
-    
-@follows(getAllGenesBed)
+@follows(uploadEnsGenes, geneIndex)
 def getGeneLists():
     pass
 
@@ -153,27 +136,25 @@ def getGeneLists():
 ##########################  make great promoters  #############################
 ###############################################################################
 @follows(getGeneLists, mkdir("greatBeds.dir"))
-@files(uploadEnsGenes, "greatBeds.dir/ens_great.bed")
+@files("annotations.dir/ensemblGeneset.index", "greatBeds.dir/ens_great.bed")
 def greatPromoters(infile, outfile):
-    ''' Make great promoters for the genes retrieved from Ensembl'''
+    ''' Make great promoters for the genes retrieved from Ensembl, read from
+        the gene index'''
 
     basalup = PARAMS["great_basal_up"]
     basaldown = PARAMS["great_basal_down"]
     maxext = PARAMS["great_max"]
     half = PARAMS["great_half"]
     
-    statement = '''select distinct contig, start, end, strand, gene_id from ensemblGeneset'''
-    df = SE.fetch_DataFrame(statement, db)
-    
-    locations = [ [str(r[0]), int(r[1]), int(r[2]),str(r[3]), str(r[4])] for i, r in df.iterrows()]
-    
+    locations = PS.geneLocations(infile)
+
     SE.writeGreat(locations,basalup,basaldown,maxext,outfile,half)
 
 
 @transform(greatPromoters, suffix(".bed"),".load")
 def loadGreatPromoters(infile, outfile):
     '''Load the great promoter regions'''
-    P.load(infile, outfile, options='-H "chr,start,end,gene_id" -i "gene_id"')
+    SE.load(infile, outfile, header=["chr", "start", "end", "gene_id"], indexes=["gene_id"])
 
     
 @follows(loadGreatPromoters)
@@ -259,8 +240,10 @@ def regulatedGenes(infiles,outfile):
 def loadRegulatedGenes(infile, outfile):
     '''Load the regulated genes'''
 
-    P.load(infile, outfile, 
-           options='-H "contig,pstart,pend,peak_id,peak_score,peak_width,peak_center,gene_id" -i "gene_id"')
+    SE.load(infile, outfile,
+            header=["contig", "pstart", "pend", "peak_id", "peak_score", "peak_width",
+                    "peak_center", "gene_id"],
+            indexes=["gene_id"])
  
     
 @transform(loadRegulatedGenes,
@@ -326,8 +309,10 @@ def regulatedTables(infiles, outfile):
     
 @transform(regulatedTables, suffix(".txt"), ".load")
 def loadRegulatedTables(infile,outfile):
-    P.load(infile,outfile,
-           options='-H"peak_id,width,TSSdist,gene_id,gene_name,gene_strand,TSS,gene_start,gene_end,contig,peak_start,peak_end,peak_score" -i "peakid" ')
+    SE.load(infile, outfile,
+            header=["peak_id", "width", "TSSdist", "gene_id", "gene_name", "gene_strand", "TSS",
+                    "gene_start", "gene_end", "contig", "peak_start", "peak_end", "peak_score"],
+            indexes=["peak_id"])
            #              1         2        3        4         5        6       7      8          9      10       11        12
            
 
@@ -442,7 +427,8 @@ def getPromoterPeaks(infile, outfile):
     
 @transform(getPromoterPeaks, suffix(".bed"), r".load")
 def loadPromoterPeaks(infile, outfile):
-    P.load(infile, outfile, options='-H "contig,start,end,peak_id,peak_score,width" -i "peak_id"' )
+    SE.load(infile, outfile, header=["contig", "start", "end", "peak_id", "peak_score", "width"],
+            indexes=["peak_id"])
 
     
 def filterEnhancersAgainstPromotersGenerator():
@@ -471,27 +457,19 @@ def filterEnhancersAgainstPromoters(infiles, outfile):
        Also, filter against genes and insulators'''
 
     enhancers, promoters = infiles
-    genes = glob.glob("annotations.dir/ensemblGeneset.bed")
-    genes = ' '.join(genes)
 
-    statement = []
-    statement.append(f'''intersectBed -v -a <(sort -k1,1 -k2,2n {enhancers} )''')
-    
-    insulators = PARAMS["superenhancer_insulators"]
-    
-    if insulators != None:
-        statement.append(f'''-b <(cat {promoters} {genes} {insulators} | sort -k1,1 -k2,2n | cut -f1-5) > {outfile}''')
-    else:
-        statement.append(f'''-b <(cat {promoters} {genes} | sort -k1,1 -k2,2n | cut -f1-5) > {outfile}''')
-        
-    statement = ' '.join(statement)
-    
-    P.run(statement)
+    beds = [promoters]
+    if PARAMS["superenhancer_insulators"] != None:
+        beds.append(PARAMS["superenhancer_insulators"])
+
+    SE.filterOverlaps(enhancers, outfile, "annotations.dir/ensemblGeneset.index", beds)
 
     
 @transform(filterEnhancersAgainstPromoters, suffix(".bed"), r".load")
 def loadEnhancers(infile, outfile):
-    P.load(infile, outfile, options='-H "contig,start,end,peak_id,mean_score,width,peak_no" -i "peak_id"' ) 
+    SE.load(infile, outfile,
+            header=["contig", "start", "end", "peak_id", "mean_score", "width", "peak_no"],
+            indexes=["peak_id"])
 
     
 @follows(loadEnhancers)
@@ -516,31 +494,25 @@ def mergeEnhancers(infile, outfile):
     
 @transform(mergeEnhancers,
            regex(r"(.*).tsv"),
-           add_inputs("annotations.dir/ensemblGeneset.bed"),
+           add_inputs("annotations.dir/ensemblGeneset.index"),
            r"\1.bed")
 def filterEnhancersAgainstGenes(infiles, outfile):
     '''subtract any regions spanning genes and insulators from enhancer merged peaks'''
 
-    enhancers, genes = infiles
+    enhancers, index = infiles
 
-    statement = []
-    statement.append(f'''intersectBed -v -a <(sort -k1,1 -k2,2n {enhancers} )''')
+    beds = []
+    if PARAMS["superenhancer_insulators"] != None:
+        beds.append(PARAMS["superenhancer_insulators"])
 
-    insulators = PARAMS["superenhancer_insulators"]
-    
-    if insulators != None:
-        statement.append(f'''-b <( cat {genes} {insulators} | cut -f 1-3 | sort -k1,1 -k2,2n ) > {outfile}''')
-    else:
-        statement.append(f'''-b <( cut -f1-3 {genes} | sort -k1,1 -k2,2n ) > {outfile}''')
-
-    statement = ' '.join(statement)
-    
-    P.run(statement)
+    SE.filterOverlaps(enhancers, outfile, index, beds)
 
     
 @transform(filterEnhancersAgainstGenes, suffix(".bed"), r".load")
 def load12kbEnhancers(infile, outfile):
-    P.load(infile, outfile, options='-H "contig,start,end,peak_id,mean_score,width,peak_no" -i "peak_id"' ) 
+    SE.load(infile, outfile,
+            header=["contig", "start", "end", "peak_id", "mean_score", "width", "peak_no"],
+            indexes=["peak_id"])
 
 
 @follows(load12kbEnhancers)
@@ -619,7 +591,7 @@ def scoreIntervalsBAM(infiles, outfile):
     
 @transform(scoreIntervalsBAM, suffix(".txt"), ".load")
 def loadIntervalscoresBAM(infile, outfile):
-    P.load(infile, outfile, options='-i "gene_id"')
+    SE.load(infile, outfile, indexes=["peak_id"])
 
     
 def generator_BAMtotalcounts():
@@ -651,7 +623,7 @@ def BAMtotalcounts(infile, outfile):
 
 @transform(BAMtotalcounts, suffix(".txt"), r".load")
 def loadBAMtotalcounts(infile, outfile):
-    P.load(infile, outfile, options='-H "total_reads"')
+    SE.load(infile, outfile, header=["total_reads"])
 
     
 def normaliseBAMcountsGenerator():
@@ -735,7 +707,7 @@ def normaliseBAMcounts(infiles, outfile):
     
 @transform(normaliseBAMcounts, suffix(".txt"), ".load")
 def loadnormaliseBAMcounts(infiles, outfiles):
-    P.load(infiles, outfiles)    
+    SE.load(infiles, outfiles)
 
     
 @follows(loadnormaliseBAMcounts)